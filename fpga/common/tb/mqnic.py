@@ -1,23 +1,35 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2019-2023 The Regents of the University of California
 
+import csv
 import datetime
+import json
 from collections import deque
 
 import cocotb
 from cocotb.log import SimLog
 from cocotb.queue import Queue
-from cocotb.triggers import Event, Edge, RisingEdge
+from cocotb.triggers import Event, Edge, RisingEdge, Timer, First
+from cocotb.utils import get_sim_time, get_sim_steps
 
 from cocotbext.axi import Window
 
+from mqnic_trace import TraceRecorder
+
 import struct
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 MQNIC_MAX_EQ   = 1
 MQNIC_MAX_TXQ  = 32
 MQNIC_MAX_RXQ  = 8
 MQNIC_MAX_CQ   = MQNIC_MAX_TXQ*2
 
+MQNIC_MAX_FUNCS = 256
+
 # Register blocks
 MQNIC_RB_REG_TYPE      = 0x00
 MQNIC_RB_REG_VER       = 0x04
@@ -349,33 +361,487 @@ MQNIC_EVENT_TYPE_CPL = 0x0000
 MQNIC_DESC_SIZE = 16
 MQNIC_CPL_SIZE = 32
 MQNIC_EVENT_SIZE = 32
+
+if np is not None:
+    # completion record layout, matches struct format "<HHHxxLHHLBBHLL"
+    MQNIC_CPL_DTYPE = np.dtype({
+        'names': ['queue', 'index', 'len', 'ts_ns', 'ts_s', 'rx_csum', 'rx_hash', 'rx_hash_type', 'rsvd0', 'rsvd1', 'rsvd2', 'phase'],
+        'formats': ['<u2', '<u2', '<u2', '<u4', '<u2', '<u2', '<u4', 'u1', 'u1', '<u2', '<u4', '<u4'],
+        'offsets': [0, 2, 4, 8, 12, 14, 16, 20, 21, 22, 24, 28],
+        'itemsize': MQNIC_CPL_SIZE
+    })
+
+MQNIC_POLL_MODE_IRQ   = 0
+MQNIC_POLL_MODE_NAPI  = 1
+MQNIC_POLL_MODE_BUSY  = 2
+
+MQNIC_NAPI_WEIGHT = 64
+
+MQNIC_PKT_BUF_SIZES = [2048, 4096, 16384]
+MQNIC_PKT_POOL_CHUNK = 1024*1024
+MQNIC_PKT_CACHE_SIZE = 64
+
+MQNIC_TRACE_EQ_EVENT = 0
+
+MQNIC_TRACE_TX_XMIT = 0
+MQNIC_TRACE_TX_CPL = 1
+
+MQNIC_TRACE_RX_CPL = 0
+MQNIC_TRACE_RX_PACKET = 1
+
+MQNIC_TRACE_EQ_EVENTS = [
+    ('event', ('eqn', 'index', 'type', 'source')),
+]
+MQNIC_TRACE_TX_EVENTS = [
+    ('xmit', ('queue', 'index', 'len', 'csum_cmd')),
+    ('cpl', ('cqn', 'cq_index', 'queue', 'index')),
+]
+MQNIC_TRACE_RX_EVENTS = [
+    ('cpl', ('cqn', 'cq_index', 'queue', 'index')),
+    ('packet', ('queue', 'len', 'seq', 'rx_checksum')),
+]
+
+MQNIC_METRICS_HIST_BINS = 32
+MQNIC_METRICS_SAMPLES = 4096
     
 
+# enumerated register layouts, keyed by FW ID, build date and git hash
+reg_layout_cache = {}
+
+
+def save_reg_layout(path):
+    with open(path, 'w') as f:
+        json.dump(reg_layout_cache, f, indent=2, sort_keys=True)
+
+
+def load_reg_layout(path):
+    with open(path) as f:
+        reg_layout_cache.update(json.load(f))
+
+
+async def read_dwords(window, offset, count):
+    # burst read of consecutive registers
+    return list(struct.unpack("<%dL" % count, await window.read(offset, count*4)))
+
+
+async def gather(*coros):
+    # run coroutines concurrently, results in order
+    tasks = [cocotb.start_soon(c) for c in coros]
+    return [await t for t in tasks]
+
+
 class Resource:
-    def __init__(self, count, parent, stride):
+    def __init__(self, count, parent, stride, func=0, base=0, window_base=0):
         self.count = count
         self.parent = parent
         self.stride = stride
+        self.func = func
+        self.base = base
+        # first window index, nonzero when addressing a function's range through the PF BAR
+        self.window_base = window_base
 
         self.windows = {}
-        self.free_list = list(range(count))
+        # bitmap of free indices, lowest set bit is allocated first
+        self.free_mask = (1 << count) - 1
 
     def alloc(self):
-        return self.free_list.pop(0)
+        if not self.free_mask:
+            raise Exception("No free resources (function %d)" % self.func)
+
+        index = (self.free_mask & -self.free_mask).bit_length() - 1
+        self.free_mask ^= 1 << index
+        return index
+
+    def alloc_many(self, count):
+        if count > self.get_free_count():
+            raise Exception("Cannot allocate %d resources, %d free (function %d)" % (count, self.get_free_count(), self.func))
+
+        return [self.alloc() for k in range(count)]
 
     def free(self, index):
-        self.free_list.append(index)
-        self.free_list.sort()
+        if index < 0 or index >= self.count:
+            raise Exception("Resource index %d out of range (function %d)" % (index, self.func))
+        if (self.free_mask >> index) & 1:
+            raise Exception("Resource %d already free (function %d)" % (index, self.func))
+
+        self.free_mask |= 1 << index
+
+    def free_many(self, indices):
+        for index in indices:
+            self.free(index)
+
+    def is_allocated(self, index):
+        return not (self.free_mask >> index) & 1
+
+    def get_allocated(self):
+        return [k for k in range(self.count) if not (self.free_mask >> k) & 1]
 
     def get_count(self):
         return self.count
 
+    def get_free_count(self):
+        return bin(self.free_mask).count('1')
+
+    def get_physical_index(self, index):
+        return self.base + index
+
     def get_window(self, index):
         if index not in self.windows:
-            self.windows[index] = self.parent.create_window(index*self.stride, self.stride)
+            self.windows[index] = self.parent.create_window((self.window_base+index)*self.stride, self.stride)
         return self.windows[index]
 
 
+class ResourceMap:
+    # host-side mirror of resource_translator.v: the resource space is split into
+    # 2**FUNCTION_ID_WIDTH equal contiguous ranges, function 0 passes through untranslated
+
+    def __init__(self, total_count, num_funcs):
+        num_funcs = max(num_funcs, 1)
+
+        if num_funcs > MQNIC_MAX_FUNCS:
+            raise Exception("Too many functions: %d (max %d)" % (num_funcs, MQNIC_MAX_FUNCS))
+
+        self.total_count = total_count
+        self.num_funcs = num_funcs
+        self.func_id_width = (num_funcs-1).bit_length()
+        self.func_count = total_count >> self.func_id_width
+
+        self.resources = {}
+
+    def get_base(self, func):
+        return func*self.func_count
+
+    def get_func(self, index):
+        if not self.func_count:
+            return 0
+        return index // self.func_count
+
+    def translate(self, func, index):
+        if func == 0:
+            return index
+        if not self.func_count:
+            raise Exception("Function %d has no resources" % func)
+        return self.get_base(func) + index % self.func_count
+
+    def get_resource(self, func, parent, stride, limit=None, physical=False):
+        # physical: parent is the untranslated PF view, so windows start at the function's base
+        if func >= self.num_funcs:
+            raise Exception("Function %d out of range (%d functions)" % (func, self.num_funcs))
+
+        count = self.func_count if limit is None else min(self.func_count, limit)
+        base = self.get_base(func)
+        res = Resource(count, parent, stride, func, base, base if physical else 0)
+        self.resources[func] = res
+        return res
+
+    def check(self):
+        # every allocated index must land in its own function's range, with no overlap between functions
+        owner = {}
+        for func, res in self.resources.items():
+            for index in res.get_allocated():
+                phys = self.translate(func, index)
+                if func and self.get_func(phys) != func:
+                    raise Exception("Function %d index %d translates outside its range" % (func, index))
+                if phys in owner:
+                    raise Exception("Functions %d and %d both own resource %d" % (owner[phys], func, phys))
+                owner[phys] = func
+        return owner
+
+
+class PacketBuffer:
+    def __init__(self, pool, index, dma, mem):
+        self.pool = pool
+        self.index = index
+        self.dma = dma
+        self.mem = mem
+        self.size = len(mem)
+
+    def get_absolute_address(self, offset):
+        return self.dma + offset
+
+    def __getitem__(self, key):
+        return bytes(self.mem[key])
+
+    def __setitem__(self, key, value):
+        self.mem[key] = value
+
+    def __len__(self):
+        return self.size
+
+
+class PacketBufferPool:
+    # fixed-size packet buffers carved out of contiguous DMA arenas, tracked by index
+
+    BUF_FREE = 0
+    BUF_IN_USE = 1
+    BUF_CACHED = 2
+
+    def __init__(self, mem_pool, buf_size, chunk_size=MQNIC_PKT_POOL_CHUNK):
+        self.mem_pool = mem_pool
+        self.buf_size = buf_size
+        self.chunk_count = max(1, chunk_size // buf_size)
+
+        self.regions = []
+        self.buffers = []
+        self.state = bytearray()
+        self.free_list = []
+
+        self.in_use = 0
+        self.peak = 0
+        self.allocs = 0
+        self.frees = 0
+
+    def grow(self, count=None):
+        if count is None:
+            count = self.chunk_count
+
+        region = self.mem_pool.alloc_region(count*self.buf_size)
+        self.regions.append(region)
+
+        base = region.get_absolute_address(0)
+        mem = memoryview(region.mem)
+        start = len(self.buffers)
+
+        for k in range(count):
+            offset = k*self.buf_size
+            self.buffers.append(PacketBuffer(self, start+k, base+offset, mem[offset:offset+self.buf_size]))
+
+        self.state.extend(bytes(count))
+        # lowest index on top of the stack
+        self.free_list.extend(range(start+count-1, start-1, -1))
+
+    def reserve(self, count):
+        # make sure count buffers are available without growing again
+        if len(self.free_list) < count:
+            self.grow(max(count - len(self.free_list), self.chunk_count))
+
+    def alloc(self, state=BUF_IN_USE):
+        if not self.free_list:
+            self.grow()
+
+        index = self.free_list.pop()
+        self.state[index] = state
+
+        self.allocs += 1
+        self.in_use += 1
+        if self.in_use > self.peak:
+            self.peak = self.in_use
+
+        return self.buffers[index]
+
+    def free(self, pkt, state=BUF_IN_USE):
+        assert pkt.pool is self, "Packet buffer freed to wrong pool"
+        if self.state[pkt.index] != state:
+            raise Exception("Double free of packet buffer %d (size %d)" % (pkt.index, self.buf_size))
+
+        self.state[pkt.index] = self.BUF_FREE
+        self.free_list.append(pkt.index)
+
+        self.frees += 1
+        self.in_use -= 1
+
+    @property
+    def capacity(self):
+        return len(self.buffers)
+
+    def get_stats(self):
+        return {
+            'buf_size': self.buf_size,
+            'capacity': self.capacity,
+            'arena_bytes': self.capacity*self.buf_size,
+            'in_use': self.in_use,
+            'peak': self.peak,
+            'peak_bytes': self.peak*self.buf_size,
+            'allocs': self.allocs,
+            'frees': self.frees,
+        }
+
+
+class PacketBufferCache:
+    # per-queue stack of buffers, refilled from and spilled to the shared pool in batches
+
+    def __init__(self, pool, size=MQNIC_PKT_CACHE_SIZE):
+        self.pool = pool
+        self.size = size
+        self.bufs = []
+
+        self.hits = 0
+        self.misses = 0
+
+    def alloc(self):
+        if self.bufs:
+            self.hits += 1
+        else:
+            self.misses += 1
+            for k in range(max(1, self.size >> 1)):
+                self.bufs.append(self.pool.alloc(PacketBufferPool.BUF_CACHED))
+
+        pkt = self.bufs.pop()
+        self.pool.state[pkt.index] = PacketBufferPool.BUF_IN_USE
+        return pkt
+
+    def free(self, pkt):
+        assert pkt.pool is self.pool, "Packet buffer freed to wrong cache"
+        if self.pool.state[pkt.index] != PacketBufferPool.BUF_IN_USE:
+            raise Exception("Double free of packet buffer %d (size %d)" % (pkt.index, self.pool.buf_size))
+
+        self.pool.state[pkt.index] = PacketBufferPool.BUF_CACHED
+        self.bufs.append(pkt)
+
+        if len(self.bufs) > self.size:
+            # return the older half to the pool
+            count = len(self.bufs) - (self.size >> 1)
+            for buf in self.bufs[:count]:
+                self.pool.free(buf, PacketBufferPool.BUF_CACHED)
+            del self.bufs[:count]
+
+    def flush(self):
+        for buf in self.bufs:
+            self.pool.free(buf, PacketBufferPool.BUF_CACHED)
+        self.bufs.clear()
+
+
+class Histogram:
+    # fixed-size histogram with power-of-two buckets, bucket k counts values with bit_length k
+    def __init__(self, bins=MQNIC_METRICS_HIST_BINS):
+        self.bins = [0]*bins
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = max(int(value), 0)
+        self.bins[min(value.bit_length(), len(self.bins)-1)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for k, n in enumerate(other.bins):
+            self.bins[k] += n
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the pth percentile
+        if not self.count:
+            return 0
+        acc = 0
+        for k, n in enumerate(self.bins):
+            acc += n
+            if acc*100 >= self.count*p:
+                return min(self.get_bucket_range(k)[1], self.max)
+        return self.max
+
+    @staticmethod
+    def get_bucket_range(k):
+        if k == 0:
+            return (0, 0)
+        return (1 << (k-1), (1 << k) - 1)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'bins': list(self.bins),
+        }
+
+
+class RingMetrics:
+    COUNTERS = ('packets', 'bytes', 'doorbells', 'completions', 'blocked_ns')
+    HISTOGRAMS = ('occupancy', 'cpl_per_irq', 'blocked_time', 'refill_batch', 'latency')
+
+    def __init__(self, ring_type, func, interface=None, index=None, samples=MQNIC_METRICS_SAMPLES):
+        self.ring_type = ring_type
+        self.func = func
+        self.interface = interface
+        self.index = index
+
+        self.packets = 0
+        self.bytes = 0
+        self.doorbells = 0
+        self.completions = 0
+        self.blocked_ns = 0
+
+        # occupancy (prod_ptr - cons_ptr) at each doorbell and completion pass
+        self.occupancy = Histogram()
+        self.occupancy_series = deque(maxlen=samples)
+        # completions handled per interrupt or NAPI poll
+        self.cpl_per_irq = Histogram()
+        # time spent in start_xmit waiting for ring space
+        self.blocked_time = Histogram()
+        # descriptors posted per RX refill
+        self.refill_batch = Histogram()
+        # TX: start_xmit to completion, RX: completion to recv
+        self.latency = Histogram()
+
+    def sample_occupancy(self, occupancy):
+        self.occupancy.add(occupancy)
+        self.occupancy_series.append((get_sim_time('ns'), occupancy))
+
+    def record_completions(self, count, idle=False):
+        # idle passes (busy polling an empty CQ) are not counted as interrupts
+        self.completions += count
+        if count or not idle:
+            self.cpl_per_irq.add(count)
+
+    def record_blocked(self, time_ns):
+        self.blocked_ns += time_ns
+        self.blocked_time.add(time_ns)
+
+    def merge(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in self.HISTOGRAMS:
+            getattr(self, name).merge(getattr(other, name))
+
+    def to_dict(self):
+        d = {
+            'func': self.func,
+            'interface': self.interface,
+            'ring_type': self.ring_type,
+            'ring': self.index,
+        }
+        for name in self.COUNTERS:
+            d[name] = getattr(self, name)
+        for name in self.HISTOGRAMS:
+            d[name] = getattr(self, name).to_dict()
+        d['occupancy_series'] = [list(x) for x in self.occupancy_series]
+        return d
+
+    def to_rows(self):
+        # long format rows: func, interface, ring_type, ring, metric, key, value
+        prefix = [self.func, self.interface, self.ring_type, self.index]
+        rows = []
+        for name in self.COUNTERS:
+            rows.append(prefix + [name, '', getattr(self, name)])
+        for name in self.HISTOGRAMS:
+            for k, n in enumerate(getattr(self, name).bins):
+                if n:
+                    rows.append(prefix + [name, Histogram.get_bucket_range(k)[0], n])
+        for t, occupancy in self.occupancy_series:
+            rows.append(prefix + ['occupancy_series', t, occupancy])
+        return rows
+
+
 class RegBlock(Window):
     def __init__(self, parent, offset, size, base=0, **kwargs):
         super().__init__(parent, offset, size, base, **kwargs)
@@ -388,21 +854,30 @@ class RegBlockList:
     def __init__(self):
         self.blocks = []
 
-    async def enumerate_reg_blocks(self, window, offset=0):
-        while True:
-            rb_type = await window.read_dword(offset+MQNIC_RB_REG_TYPE)
-            rb_version = await window.read_dword(offset+MQNIC_RB_REG_VER)
-            rb = window.create_window(offset, window_type=RegBlock)
+    async def enumerate_reg_blocks(self, window, offset=0, layout=None):
+        # walk the block list reading each header in one burst; if a layout from a
+        # previous enumeration is given, the blocks are rebuilt without any reads
+        if layout is None:
+            layout = []
+            visited = set()
+
+            while True:
+                visited.add(offset)
+                rb_type, rb_version, next_ptr = await read_dwords(window, offset+MQNIC_RB_REG_TYPE, 3)
+                layout.append([offset, rb_type, rb_version])
+                if next_ptr == 0:
+                    break
+                assert next_ptr & 0x3 == 0, "Register block not aligned"
+                assert next_ptr not in visited, "Register blocks form a loop"
+                offset = next_ptr
+
+        for rb_offset, rb_type, rb_version in layout:
+            rb = window.create_window(rb_offset, window_type=RegBlock)
             rb.type = rb_type
             rb.version = rb_version
-            print(f"Block ID {rb_type:#010x} version {rb_version:#010x} at offset {offset:#010x}")
             self.blocks.append(rb)
-            offset = await window.read_dword(offset+MQNIC_RB_REG_NEXT_PTR)
-            if offset == 0:
-                return
-            assert offset & 0x3 == 0, "Register block not aligned"
-            for block in self.blocks:
-                assert block.offset != offset, "Register blocks form a loop"
+
+        return layout
 
     def find(self, rb_type, version=None, index=0):
         for block in self.blocks:
@@ -424,6 +899,8 @@ class Packet:
     def __init__(self, data=b''):
         self.data = data
         self.queue = None
+        self.seq = None
+        self.rx_time = None
         self.timestamp_s = None
         self.timestamp_ns = None
         self.rx_checksum = None
@@ -471,6 +948,11 @@ class Eq:
         self.prod_ptr = 0
         self.cons_ptr = 0
 
+        self.budget = MQNIC_NAPI_WEIGHT
+
+        self.irq_count = 0
+        self.arm_count = 0
+
         self.hw_regs = None
 
     async def open(self, irq, size):
@@ -505,7 +987,7 @@ class Eq:
         await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_ENABLE | 0)
         await self.hw_regs.write_dword(MQNIC_EQ_BASE_ADDR_VF_REG, self.buf_dma & 0xfffff000)
         await self.hw_regs.write_dword(MQNIC_EQ_BASE_ADDR_VF_REG+4, self.buf_dma >> 32)
-        await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_VF_ID | 0)
+        await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_VF_ID | self.driver.func_id)
         val = await self.hw_regs.read_dword(MQNIC_EQ_BASE_ADDR_VF_REG) & 0xff
         self.log.info(f"EQ {self.eqn} has VF {val}")
         await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_SIZE | self.log_size)
@@ -546,10 +1028,15 @@ class Eq:
     async def write_cons_ptr(self):
         await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_CONS_PTR | (self.cons_ptr & MQNIC_EQ_PTR_MASK))
 
+    async def write_cons_ptr_arm(self):
+        self.arm_count += 1
+        await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_CONS_PTR_ARM | (self.cons_ptr & MQNIC_EQ_PTR_MASK))
+
     async def arm(self):
         if not self.hw_regs:
             return
 
+        self.arm_count += 1
         await self.hw_regs.write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_EQ_CMD_SET_ARM | 1)
 
     async def process_eq(self):
@@ -564,16 +1051,17 @@ class Eq:
         while True:
             event_data = struct.unpack_from("<HHLLLLLLL", self.buf, eq_index*self.stride)
 
-            self.log.info("EQ %d index %d data: %s", self.eqn, eq_index, repr(event_data))
-
             if bool(event_data[-1] & 0x80000000) == bool(eq_cons_ptr & self.size):
                 self.log.info("EQ %d empty", self.eqn)
                 break
 
+            self.driver.trace_eq.record(MQNIC_TRACE_EQ_EVENT, self.eqn, eq_index, event_data[0], event_data[1])
+
             if event_data[0] == MQNIC_EVENT_TYPE_CPL:
                 # completion
                 cq = self.cq_table[event_data[1]]
                 await cq.handler(cq)
+                await cq.write_cons_ptr()
                 await cq.arm()
 
             eq_cons_ptr += 1
@@ -582,6 +1070,57 @@ class Eq:
         self.cons_ptr = eq_cons_ptr
         await self.write_cons_ptr()
 
+    async def poll(self, arm=True):
+        # NAPI-style processing: consume at most budget events per pass, poll
+        # each signalled CQ until it is drained, and only re-arm once empty
+        if not self.interface.port_up:
+            return
+
+        while True:
+            eq_cons_ptr = self.cons_ptr
+            eq_index = eq_cons_ptr & self.size_mask
+
+            poll_list = {}
+            done = 0
+
+            while done < self.budget:
+                event_data = struct.unpack_from("<HHLLLLLLL", self.buf, eq_index*self.stride)
+
+                if bool(event_data[-1] & 0x80000000) == bool(eq_cons_ptr & self.size):
+                    break
+
+                self.driver.trace_eq.record(MQNIC_TRACE_EQ_EVENT, self.eqn, eq_index, event_data[0], event_data[1])
+
+                if event_data[0] == MQNIC_EVENT_TYPE_CPL:
+                    # schedule CQ, coalescing repeated events
+                    cq = self.cq_table.get(event_data[1])
+                    if cq is not None:
+                        poll_list[cq.cqn] = cq
+
+                done += 1
+                eq_cons_ptr += 1
+                eq_index = eq_cons_ptr & self.size_mask
+
+            self.cons_ptr = eq_cons_ptr
+
+            self.log.info("EQ %d poll: %d events, %d CQs scheduled", self.eqn, done, len(poll_list))
+
+            while poll_list:
+                for cq in list(poll_list.values()):
+                    if await cq.poll(arm):
+                        del poll_list[cq.cqn]
+
+            if done < self.budget:
+                break
+
+            # budget exhausted, release the entries and poll again
+            await self.write_cons_ptr()
+
+        if arm:
+            await self.write_cons_ptr_arm()
+        elif done:
+            await self.write_cons_ptr()
+
 
 class Cq:
     def __init__(self, interface):
@@ -605,9 +1144,17 @@ class Cq:
         self.src_ring = None
         self.handler = None
 
+        self.cpl = None
+        self.cpl_offsets = None
+
         self.prod_ptr = 0
         self.cons_ptr = 0
 
+        self.budget = MQNIC_NAPI_WEIGHT
+
+        self.poll_count = 0
+        self.arm_count = 0
+
         self.hw_regs = None
 
     async def open(self, eq, size):
@@ -630,10 +1177,17 @@ class Cq:
 
         self.buf[0:self.buf_size] = b'\x00'*self.buf_size
 
+        if np is not None:
+            # structured view over the completion ring for bulk scanning
+            self.cpl = np.frombuffer(self.buf, dtype=MQNIC_CPL_DTYPE, count=self.size)
+            self.cpl_offsets = np.arange(self.size, dtype=np.int64)
+
         self.prod_ptr = 0
         self.cons_ptr = 0
 
-        eq.attach_cq(self)
+        # without an EQ the CQ never raises events and must be polled
+        if eq:
+            eq.attach_cq(self)
         self.eq = eq
 
         self.hw_regs = self.interface.cq_res.get_window(self.cqn)
@@ -641,9 +1195,10 @@ class Cq:
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_ENABLE | 0)
         await self.hw_regs.write_dword(MQNIC_CQ_BASE_ADDR_VF_REG, self.buf_dma & 0xfffff000)
         await self.hw_regs.write_dword(MQNIC_CQ_BASE_ADDR_VF_REG+4, self.buf_dma >> 32)
-        await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_VF_ID | 0)
+        await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_VF_ID | self.driver.func_id)
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_SIZE | self.log_size)
-        await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_EQN | self.eq.eqn)
+        if self.eq:
+            await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_EQN | self.eq.eqn)
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_PROD_PTR | (self.prod_ptr & MQNIC_CQ_PTR_MASK))
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_CONS_PTR | (self.cons_ptr & MQNIC_CQ_PTR_MASK))
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_ENABLE | 1)
@@ -658,7 +1213,8 @@ class Cq:
 
         # TODO free buffer
 
-        self.eq.detach_cq(self)
+        if self.eq:
+            self.eq.detach_cq(self)
         self.eq = None
 
         self.enabled = False
@@ -675,12 +1231,52 @@ class Cq:
     async def write_cons_ptr(self):
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_CONS_PTR | (self.cons_ptr & MQNIC_CQ_PTR_MASK))
 
+    async def write_cons_ptr_arm(self):
+        self.arm_count += 1
+        await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_CONS_PTR_ARM | (self.cons_ptr & MQNIC_CQ_PTR_MASK))
+
     async def arm(self):
         if not self.hw_regs:
             return
 
+        self.arm_count += 1
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_ARM | 1)
 
+    def scan(self, budget=None):
+        # ring indices of the valid completions from the consumer pointer onwards,
+        # found with a single vectorized phase bit comparison
+        count = self.size if budget is None else min(budget, self.size)
+
+        ptr = self.cons_ptr + self.cpl_offsets[:count]
+        index = ptr & self.size_mask
+
+        valid = ((self.cpl['phase'][index] & 0x80000000) != 0) != ((ptr & self.size) != 0)
+
+        if not valid.all():
+            count = int(valid.argmin())
+
+        return index[:count]
+
+    async def poll(self, arm=True):
+        # process up to budget completions, returns True once the CQ is drained
+        if not self.hw_regs or not self.handler:
+            return True
+
+        self.poll_count += 1
+
+        done = await self.handler(self, self.budget)
+
+        if done < self.budget:
+            if arm:
+                # drained, update consumer pointer and re-arm with a single write
+                await self.write_cons_ptr_arm()
+            elif done:
+                await self.write_cons_ptr()
+            return True
+
+        await self.write_cons_ptr()
+        return False
+
 
 class Txq:
     def __init__(self, interface):
@@ -709,8 +1305,16 @@ class Txq:
 
         self.clean_event = Event()
 
+        self.hw_prod_ptr = 0
+
         self.packets = 0
         self.bytes = 0
+        self.doorbells = 0
+
+        self.tx_time = []
+        self.metrics = None
+
+        self.pkt_cache = {}
 
         self.hw_regs = None
 
@@ -731,6 +1335,9 @@ class Txq:
         self.stride = MQNIC_DESC_SIZE*self.desc_block_size
 
         self.tx_info = [None]*self.size
+        self.tx_time = [0]*self.size
+
+        self.metrics = self.driver.new_ring_metrics('tx', self.interface.index, self.index)
 
         self.buf_size = self.size*self.stride
         self.buf_region = self.driver.pool.alloc_region(self.buf_size)
@@ -739,17 +1346,21 @@ class Txq:
 
         self.prod_ptr = 0
         self.cons_ptr = 0
+        self.hw_prod_ptr = 0
 
         self.cq = cq
         self.cq.src_ring = self
-        self.cq.handler = Txq.process_tx_cq
+        if self.driver.vectorized_cq and self.cq.cpl is not None:
+            self.cq.handler = Txq.process_tx_cq_bulk
+        else:
+            self.cq.handler = Txq.process_tx_cq
 
         self.hw_regs = self.interface.txq_res.get_window(self.index)
 
         await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
         await self.hw_regs.write_dword(MQNIC_QUEUE_BASE_ADDR_VF_REG, self.buf_dma & 0xfffff000)
         await self.hw_regs.write_dword(MQNIC_QUEUE_BASE_ADDR_VF_REG+4, self.buf_dma >> 32)
-        await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_VF_ID | 0)
+        await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_VF_ID | self.driver.func_id)
         val = await self.hw_regs.read_dword(MQNIC_QUEUE_BASE_ADDR_VF_REG)
         self.log.info(f"TXQ has Base VF value: {val & 0xff}")
         await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_SIZE | (self.log_desc_block_size << 8) | self.log_queue_size)
@@ -763,6 +1374,9 @@ class Txq:
 
         await self.disable()
 
+        self.free_buf()
+        self.driver.flush_pkt_cache(self.pkt_cache)
+
         # TODO free buffer
 
         if self.cq:
@@ -804,21 +1418,42 @@ class Txq:
         self.cons_ptr += ((val >> 16) - self.cons_ptr) & MQNIC_QUEUE_PTR_MASK
 
     async def write_prod_ptr(self):
+        self.hw_prod_ptr = self.prod_ptr
+        self.doorbells += 1
+        self.metrics.doorbells += 1
+        self.metrics.sample_occupancy(self.prod_ptr - self.cons_ptr)
         await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_PROD_PTR | (self.prod_ptr & MQNIC_QUEUE_PTR_MASK))
 
+    def doorbell_pending(self):
+        return self.hw_prod_ptr != self.prod_ptr
+
+    async def flush(self):
+        # ring the doorbell for descriptors queued with xmit_more
+        if self.doorbell_pending():
+            await self.write_prod_ptr()
+
     def free_desc(self, index):
         pkt = self.tx_info[index]
-        self.driver.free_pkt(pkt)
+        self.driver.free_pkt(pkt, self.pkt_cache)
         self.tx_info[index] = None
 
+    def advance_cons_ptr(self):
+        # move the consumer pointer past descriptors that have been freed
+        while self.cons_ptr != self.prod_ptr:
+            if self.tx_info[self.cons_ptr & self.size_mask]:
+                break
+            self.cons_ptr += 1
+
     def free_buf(self):
         while not self.empty():
             index = self.cons_ptr & self.size_mask
-            self.free_desc(index)
+            # slots completed out of order were already freed
+            if self.tx_info[index] is not None:
+                self.free_desc(index)
             self.cons_ptr += 1
 
     @staticmethod
-    async def process_tx_cq(cq):
+    async def process_tx_cq(cq, budget=None):
         interface = cq.interface
 
         interface.log.info("Process CQ %d for TXQ %d (interface %d)", cq.cqn, cq.src_ring.index, interface.index)
@@ -826,47 +1461,81 @@ class Txq:
         ring = cq.src_ring
 
         if not interface.port_up:
-            return
+            return 0
+
+        now = get_sim_time('ns')
+        trace = cq.driver.trace_txq
 
         # process completion queue
         cq_cons_ptr = cq.cons_ptr
         cq_index = cq_cons_ptr & cq.size_mask
+        done = 0
 
-        while True:
+        while budget is None or done < budget:
             cpl_data = struct.unpack_from("<HHHxxLHHLBBHLL", cq.buf, cq_index*cq.stride)
             ring_index = cpl_data[1] & ring.size_mask
 
-            interface.log.info("CQ %d index %d data: %s", cq.cqn, cq_index, repr(cpl_data))
-
             if bool(cpl_data[-1] & 0x80000000) == bool(cq_cons_ptr & cq.size):
                 interface.log.info("CQ %d empty", cq.cqn)
                 break
 
-            interface.log.info("Ring index: %d", ring_index)
+            trace.record(MQNIC_TRACE_TX_CPL, cq.cqn, cq_index, ring.index, ring_index)
 
+            ring.metrics.latency.add(now - ring.tx_time[ring_index])
             ring.free_desc(ring_index)
 
+            done += 1
             cq_cons_ptr += 1
             cq_index = cq_cons_ptr & cq.size_mask
 
         cq.cons_ptr = cq_cons_ptr
-        await cq.write_cons_ptr()
 
         # process ring
-        ring_cons_ptr = ring.cons_ptr
-        ring_index = ring_cons_ptr & ring.size_mask
+        ring.advance_cons_ptr()
 
-        while (ring_cons_ptr != ring.prod_ptr):
-            if ring.tx_info[ring_index]:
-                break
+        ring.metrics.record_completions(done, interface.poll_mode == MQNIC_POLL_MODE_BUSY)
+        ring.metrics.sample_occupancy(ring.prod_ptr - ring.cons_ptr)
+
+        ring.clean_event.set()
+
+        return done
+
+    @staticmethod
+    async def process_tx_cq_bulk(cq, budget=None):
+        interface = cq.interface
+
+        ring = cq.src_ring
+
+        if not interface.port_up:
+            return 0
+
+        now = get_sim_time('ns')
+
+        # process completion queue
+        cq_index = cq.scan(budget)
+        done = len(cq_index)
+
+        interface.log.info("Process CQ %d for TXQ %d (interface %d): %d completions", cq.cqn, ring.index, interface.index, done)
+
+        trace = cq.driver.trace_txq
+
+        for k, ring_index in zip(cq_index.tolist(), (cq.cpl['index'][cq_index] & ring.size_mask).tolist()):
+            trace.record(MQNIC_TRACE_TX_CPL, cq.cqn, k, ring.index, ring_index)
+            ring.metrics.latency.add(now - ring.tx_time[ring_index])
+            ring.free_desc(ring_index)
 
-            ring_cons_ptr += 1
-            ring_index = ring_cons_ptr & ring.size_mask
+        cq.cons_ptr += done
 
-        ring.cons_ptr = ring_cons_ptr
+        # process ring
+        ring.advance_cons_ptr()
+
+        ring.metrics.record_completions(done, interface.poll_mode == MQNIC_POLL_MODE_BUSY)
+        ring.metrics.sample_occupancy(ring.prod_ptr - ring.cons_ptr)
 
         ring.clean_event.set()
 
+        return done
+
 
 class Rxq:
     def __init__(self, interface):
@@ -896,6 +1565,13 @@ class Rxq:
         self.packets = 0
         self.bytes = 0
 
+        self.metrics = None
+
+        self.pkt_cache = {}
+
+        self.pkt_rx_queue = deque()
+        self.pkt_rx_sync = Event()
+
         self.hw_regs = None
 
     async def open(self, cq, size, desc_block_size):
@@ -916,6 +1592,8 @@ class Rxq:
 
         self.rx_info = [None]*self.size
 
+        self.metrics = self.driver.new_ring_metrics('rx', self.interface.index, self.index)
+
         self.buf_size = self.size*self.stride
         self.buf_region = self.driver.pool.alloc_region(self.buf_size)
         self.buf_dma = self.buf_region.get_absolute_address(0)
@@ -924,9 +1602,15 @@ class Rxq:
         self.prod_ptr = 0
         self.cons_ptr = 0
 
+        # preallocate buffers for a full ring
+        self.driver.get_pkt_pool(self.get_rx_buf_size()).reserve(self.size)
+
         self.cq = cq
         self.cq.src_ring = self
-        self.cq.handler = Rxq.process_rx_cq
+        if self.driver.vectorized_cq and self.cq.cpl is not None:
+            self.cq.handler = Rxq.process_rx_cq_bulk
+        else:
+            self.cq.handler = Rxq.process_rx_cq
 
         self.hw_regs = self.interface.rxq_res.get_window(self.index)
 
@@ -946,6 +1630,9 @@ class Rxq:
 
         await self.disable()
 
+        self.free_buf()
+        self.driver.flush_pkt_cache(self.pkt_cache)
+
         # TODO free buffer
 
         if self.cq:
@@ -988,21 +1675,38 @@ class Rxq:
         self.cons_ptr += ((val >> 16) - self.cons_ptr) & MQNIC_QUEUE_PTR_MASK
 
     async def write_prod_ptr(self):
+        self.metrics.doorbells += 1
+        self.metrics.sample_occupancy(self.prod_ptr - self.cons_ptr)
         await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_PROD_PTR | (self.prod_ptr & MQNIC_QUEUE_PTR_MASK))
 
     def free_desc(self, index):
         pkt = self.rx_info[index]
-        self.driver.free_pkt(pkt)
+        self.driver.free_pkt(pkt, self.pkt_cache)
         self.rx_info[index] = None
 
+    def advance_cons_ptr(self):
+        # move the consumer pointer past descriptors that have been freed
+        while self.cons_ptr != self.prod_ptr:
+            if self.rx_info[self.cons_ptr & self.size_mask]:
+                break
+            self.cons_ptr += 1
+
     def free_buf(self):
         while not self.empty():
             index = self.cons_ptr & self.size_mask
-            self.free_desc(index)
+            # slots completed out of order were already freed
+            if self.rx_info[index] is not None:
+                self.free_desc(index)
             self.cons_ptr += 1
 
+    def get_rx_buf_size(self):
+        # size class follows the current MTU
+        if self.interface.mtu:
+            return self.interface.mtu + 14
+        return None
+
     def prepare_desc(self, index):
-        pkt = self.driver.alloc_pkt()
+        pkt = self.driver.alloc_pkt(self.get_rx_buf_size(), self.pkt_cache)
         self.rx_info[index] = pkt
 
         length = pkt.size
@@ -1025,10 +1729,12 @@ class Rxq:
             self.prepare_desc(self.prod_ptr & self.size_mask)
             self.prod_ptr += 1
 
+        self.metrics.refill_batch.add(missing)
+
         await self.write_prod_ptr()
 
     @staticmethod
-    async def process_rx_cq(cq):
+    async def process_rx_cq(cq, budget=None):
         interface = cq.interface
 
         interface.log.info("Process CQ %d for RXQ %d (interface %d)", cq.cqn, cq.src_ring.index, interface.index)
@@ -1036,23 +1742,26 @@ class Rxq:
         ring = cq.src_ring
 
         if not interface.port_up:
-            return
+            return 0
+
+        now = get_sim_time('ns')
+        trace = cq.driver.trace_rxq
 
         # process completion queue
         cq_cons_ptr = cq.cons_ptr
         cq_index = cq_cons_ptr & cq.size_mask
+        done = 0
 
-        while True:
+        while budget is None or done < budget:
             cpl_data = struct.unpack_from("<HHHxxLHHLBBHLL", cq.buf, cq_index*cq.stride)
             ring_index = cpl_data[1] & ring.size_mask
 
-            interface.log.info("CQ %d index %d data: %s", cq.cqn, cq_index, repr(cpl_data))
-
             if bool(cpl_data[-1] & 0x80000000) == bool(cq_cons_ptr & cq.size):
                 interface.log.info("CQ %d empty", cq.cqn)
                 break
 
-            interface.log.info("Ring index: %d", ring_index)
+            trace.record(MQNIC_TRACE_RX_CPL, cq.cqn, cq_index, ring.index, ring_index)
+
             pkt = ring.rx_info[ring_index]
 
             length = cpl_data[2]
@@ -1064,35 +1773,108 @@ class Rxq:
             skb.timestamp_s = cpl_data[4]
             skb.rx_checksum = cpl_data[5]
 
-            interface.log.info("Packet: %s", skb)
+            skb.seq = interface.rx_seq
+            skb.rx_time = now
+            interface.rx_seq += 1
+            ring.pkt_rx_queue.append(skb)
 
-            interface.pkt_rx_queue.append(skb)
-            interface.pkt_rx_sync.set()
+            trace.record(MQNIC_TRACE_RX_PACKET, ring.index, length, skb.seq, skb.rx_checksum)
+
+            ring.packets += 1
+            ring.bytes += length
+            ring.metrics.packets += 1
+            ring.metrics.bytes += length
 
             ring.free_desc(ring_index)
 
+            done += 1
             cq_cons_ptr += 1
             cq_index = cq_cons_ptr & cq.size_mask
 
         cq.cons_ptr = cq_cons_ptr
-        await cq.write_cons_ptr()
+
+        if done:
+            # wake receivers once per pass
+            ring.pkt_rx_sync.set()
+            interface.pkt_rx_sync.set()
 
         # process ring
-        ring_cons_ptr = ring.cons_ptr
-        ring_index = ring_cons_ptr & ring.size_mask
+        ring.advance_cons_ptr()
 
-        while (ring_cons_ptr != ring.prod_ptr):
-            if ring.rx_info[ring_index]:
-                break
+        ring.metrics.record_completions(done, interface.poll_mode == MQNIC_POLL_MODE_BUSY)
+        ring.metrics.sample_occupancy(ring.prod_ptr - ring.cons_ptr)
+
+        # replenish buffers
+        await ring.refill_buffers()
+
+        return done
+
+    @staticmethod
+    async def process_rx_cq_bulk(cq, budget=None):
+        interface = cq.interface
+
+        ring = cq.src_ring
+
+        if not interface.port_up:
+            return 0
+
+        now = get_sim_time('ns')
+
+        # process completion queue
+        cq_index = cq.scan(budget)
+        done = len(cq_index)
 
-            ring_cons_ptr += 1
-            ring_index = ring_cons_ptr & ring.size_mask
+        interface.log.info("Process CQ %d for RXQ %d (interface %d): %d completions", cq.cqn, ring.index, interface.index, done)
 
-        ring.cons_ptr = ring_cons_ptr
+        cpl = cq.cpl[cq_index]
+
+        trace = cq.driver.trace_rxq
+
+        for k, ring_index, length, ts_ns, ts_s, rx_csum in zip(cq_index.tolist(), (cpl['index'] & ring.size_mask).tolist(),
+                cpl['len'].tolist(), cpl['ts_ns'].tolist(), cpl['ts_s'].tolist(), cpl['rx_csum'].tolist()):
+            trace.record(MQNIC_TRACE_RX_CPL, cq.cqn, k, ring.index, ring_index)
+
+            pkt = ring.rx_info[ring_index]
+
+            skb = Packet()
+            skb.data = pkt[:length]
+            skb.queue = ring.index
+            skb.timestamp_ns = ts_ns
+            skb.timestamp_s = ts_s
+            skb.rx_checksum = rx_csum
+
+            skb.seq = interface.rx_seq
+            skb.rx_time = now
+            interface.rx_seq += 1
+            ring.pkt_rx_queue.append(skb)
+
+            trace.record(MQNIC_TRACE_RX_PACKET, ring.index, length, skb.seq, skb.rx_checksum)
+
+            ring.packets += 1
+            ring.bytes += length
+            ring.metrics.packets += 1
+            ring.metrics.bytes += length
+
+            ring.free_desc(ring_index)
+
+        if done:
+            # wake receivers once per pass
+            ring.pkt_rx_sync.set()
+            interface.pkt_rx_sync.set()
+
+        cq.cons_ptr += done
+
+        # process ring
+        ring.advance_cons_ptr()
+
+        ring.metrics.record_completions(done, interface.poll_mode == MQNIC_POLL_MODE_BUSY)
+        ring.metrics.sample_occupancy(ring.prod_ptr - ring.cons_ptr)
 
         # replenish buffers
         await ring.refill_buffers()
 
+        return done
+
 
 class BaseScheduler:
     def __init__(self, port, index, rb):
@@ -1113,7 +1895,8 @@ class SchedulerRoundRobin(BaseScheduler):
         super().__init__(port, index, rb)
 
     async def init(self):
-        offset = await self.rb.read_dword(MQNIC_RB_SCHED_RR_REG_OFFSET)
+        offset, = await self.driver.read_static("if%d.sched%d.%d" % (self.interface.index, self.port.index, self.index),
+            self.rb, MQNIC_RB_SCHED_RR_REG_OFFSET)
         self.hw_regs = self.rb.parent.create_window(offset)
 
 
@@ -1122,7 +1905,8 @@ class SchedulerControlTdma(BaseScheduler):
         super().__init__(port, index, rb)
 
     async def init(self):
-        offset = await self.rb.read_dword(MQNIC_RB_SCHED_CTRL_TDMA_REG_OFFSET)
+        offset, = await self.driver.read_static("if%d.sched%d.%d" % (self.interface.index, self.port.index, self.index),
+            self.rb, MQNIC_RB_SCHED_CTRL_TDMA_REG_OFFSET)
         self.hw_regs = self.rb.parent.create_window(offset)
 
 
@@ -1143,8 +1927,10 @@ class SchedulerBlock:
     async def init(self):
         # Read ID registers
 
-        offset = await self.block_rb.read_dword(MQNIC_RB_SCHED_BLOCK_REG_OFFSET)
-        await self.reg_blocks.enumerate_reg_blocks(self.block_rb.parent, offset)
+        key = "if%d.sched%d" % (self.interface.index, self.index)
+
+        offset, = await self.driver.read_static(key, self.block_rb, MQNIC_RB_SCHED_BLOCK_REG_OFFSET)
+        await self.driver.enumerate_reg_blocks(key+".blocks", self.reg_blocks, self.block_rb.parent, offset)
 
         self.schedulers = []
 
@@ -1185,12 +1971,14 @@ class Port:
     async def init(self):
         # Read ID registers
 
-        offset = await self.port_rb.read_dword(MQNIC_RB_PORT_REG_OFFSET)
-        await self.reg_blocks.enumerate_reg_blocks(self.port_rb.parent, offset)
+        key = "if%d.port%d" % (self.interface.index, self.index)
+
+        offset, = await self.driver.read_static(key, self.port_rb, MQNIC_RB_PORT_REG_OFFSET)
+        await self.driver.enumerate_reg_blocks(key+".blocks", self.reg_blocks, self.port_rb.parent, offset)
 
         self.port_ctrl_rb = self.reg_blocks.find(MQNIC_RB_PORT_CTRL_TYPE, MQNIC_RB_PORT_CTRL_VER)
 
-        self.port_features = await self.port_ctrl_rb.read_dword(MQNIC_RB_PORT_CTRL_REG_FEATURES)
+        self.port_features, = await self.driver.read_static(key+".features", self.port_ctrl_rb, MQNIC_RB_PORT_CTRL_REG_FEATURES)
         self.port_feature_lfc = bool(self.port_features & MQNIC_PORT_FEATURE_LFC)
         self.port_feature_pfc = bool(self.port_features & MQNIC_PORT_FEATURE_PFC)
         self.port_feature_int_mac_ctrl = bool(self.port_features & MQNIC_PORT_FEATURE_INT_MAC_CTRL)
@@ -1255,9 +2043,15 @@ class Interface:
 
         self.max_tx_mtu = 0
         self.max_rx_mtu = 0
+        self.mtu = 0
         self.tx_fifo_depth = 0
         self.rx_fifo_depth = 0
 
+        self.eq_map = None
+        self.cq_map = None
+        self.txq_map = None
+        self.rxq_map = None
+
         self.eq_res = None
         self.cq_res = None
         self.txq_res = None
@@ -1279,24 +2073,39 @@ class Interface:
         self.interrupt_running = False
         self.interrupt_pending = 0
 
-        self.pkt_rx_queue = deque()
+        self.poll_mode = MQNIC_POLL_MODE_IRQ
+        self.busy_poll_interval = 100
+        self.busy_poll_task = None
+
+        self.rx_seq = 0
         self.pkt_rx_sync = Event()
 
+        # PcapWriter receiving every packet handed out by recv()
+        self.rx_capture = None
+
     async def init(self):
         # Read ID registers
 
+        key = "if%d" % self.index
+
         # Enumerate registers
-        await self.reg_blocks.enumerate_reg_blocks(self.hw_regs, self.driver.if_csr_offset)
+        await self.driver.enumerate_reg_blocks(key+".blocks", self.reg_blocks, self.hw_regs, self.driver.if_csr_offset)
 
         self.if_ctrl_rb = self.reg_blocks.find(MQNIC_RB_IF_CTRL_TYPE, MQNIC_RB_IF_CTRL_VER)
 
-        self.if_features = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_FEATURES)
-        self.port_count = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_PORT_COUNT)
-        self.sched_block_count = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_SCHED_COUNT)
-        self.max_tx_mtu = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_MAX_TX_MTU)
-        self.max_rx_mtu = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_MAX_RX_MTU)
-        self.tx_fifo_depth = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_TX_FIFO_DEPTH)
-        self.rx_fifo_depth = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_RX_FIFO_DEPTH)
+        # control registers 0x0C-0x24 in one burst
+        regs = await self.driver.read_static(key+".ctrl", self.if_ctrl_rb, MQNIC_RB_IF_CTRL_REG_FEATURES, 7)
+
+        def reg(offset):
+            return regs[(offset - MQNIC_RB_IF_CTRL_REG_FEATURES) // 4]
+
+        self.if_features = reg(MQNIC_RB_IF_CTRL_REG_FEATURES)
+        self.port_count = reg(MQNIC_RB_IF_CTRL_REG_PORT_COUNT)
+        self.sched_block_count = reg(MQNIC_RB_IF_CTRL_REG_SCHED_COUNT)
+        self.max_tx_mtu = reg(MQNIC_RB_IF_CTRL_REG_MAX_TX_MTU)
+        self.max_rx_mtu = reg(MQNIC_RB_IF_CTRL_REG_MAX_RX_MTU)
+        self.tx_fifo_depth = reg(MQNIC_RB_IF_CTRL_REG_TX_FIFO_DEPTH)
+        self.rx_fifo_depth = reg(MQNIC_RB_IF_CTRL_REG_RX_FIFO_DEPTH)
 
         self.if_feature_rss = bool(self.if_features & MQNIC_IF_FEATURE_RSS)
         self.if_feature_ptp_ts = bool(self.if_features & MQNIC_IF_FEATURE_PTP_TS)
@@ -1315,75 +2124,80 @@ class Interface:
         await self.set_mtu(min(self.max_tx_mtu, self.max_rx_mtu, 9214))
 
         self.eq_rb = self.reg_blocks.find(MQNIC_RB_EQM_TYPE, MQNIC_RB_EQM_VER)
+        self.cq_rb = self.reg_blocks.find(MQNIC_RB_CQM_TYPE, MQNIC_RB_CQM_VER)
+        self.txq_rb = self.reg_blocks.find(MQNIC_RB_TX_QM_TYPE, MQNIC_RB_TX_QM_VER)
+        self.rxq_rb = self.reg_blocks.find(MQNIC_RB_RX_QM_TYPE, MQNIC_RB_RX_QM_VER)
 
-        offset = await self.eq_rb.read_dword(MQNIC_RB_EQM_REG_OFFSET)
-        count = await self.eq_rb.read_dword(MQNIC_RB_EQM_REG_COUNT)
-        count = int(count / self.driver.num_funcs)
-        stride = await self.eq_rb.read_dword(MQNIC_RB_EQM_REG_STRIDE)
+        # offset, count and stride of all four queue managers, read concurrently
+        eq_cfg, cq_cfg, txq_cfg, rxq_cfg = await gather(
+            self.driver.read_static(key+".eqm", self.eq_rb, MQNIC_RB_EQM_REG_OFFSET, 3),
+            self.driver.read_static(key+".cqm", self.cq_rb, MQNIC_RB_CQM_REG_OFFSET, 3),
+            self.driver.read_static(key+".txqm", self.txq_rb, MQNIC_RB_TX_QM_REG_OFFSET, 3),
+            self.driver.read_static(key+".rxqm", self.rxq_rb, MQNIC_RB_RX_QM_REG_OFFSET, 3)
+        )
+
+        offset, count, stride = eq_cfg
+
+        self.eq_map = self.driver.get_resource_map(self.index, 'eq', count)
 
         self.log.info("EQ offset: 0x%08x", offset)
-        self.log.info("EQ count: %d", count)
+        self.log.info("EQ count: %d (%d per function)", count, self.eq_map.func_count)
         self.log.info("EQ stride: 0x%08x", stride)
 
-        count = min(count, MQNIC_MAX_EQ)
+        self.eq_res = self.eq_map.get_resource(self.driver.func_id, self.hw_regs.create_window(offset), stride, MQNIC_MAX_EQ,
+            self.driver.shared_bar)
 
-        self.eq_res = Resource(count, self.hw_regs.create_window(offset), stride)
-
-        self.cq_rb = self.reg_blocks.find(MQNIC_RB_CQM_TYPE, MQNIC_RB_CQM_VER)
+        offset, count, stride = cq_cfg
 
-        offset = await self.cq_rb.read_dword(MQNIC_RB_CQM_REG_OFFSET)
-        count = await self.cq_rb.read_dword(MQNIC_RB_CQM_REG_COUNT)
-        count = int(count / self.driver.num_funcs)
-        stride = await self.cq_rb.read_dword(MQNIC_RB_CQM_REG_STRIDE)
+        self.cq_map = self.driver.get_resource_map(self.index, 'cq', count)
 
         self.log.info("CQ offset: 0x%08x", offset)
-        self.log.info("CQ count: %d", count)
+        self.log.info("CQ count: %d (%d per function)", count, self.cq_map.func_count)
         self.log.info("CQ stride: 0x%08x", stride)
 
-        count = min(count, MQNIC_MAX_CQ)
+        self.cq_res = self.cq_map.get_resource(self.driver.func_id, self.hw_regs.create_window(offset), stride, MQNIC_MAX_CQ,
+            self.driver.shared_bar)
 
-        self.cq_res = Resource(count, self.hw_regs.create_window(offset), stride)
+        offset, count, stride = txq_cfg
 
-        self.txq_rb = self.reg_blocks.find(MQNIC_RB_TX_QM_TYPE, MQNIC_RB_TX_QM_VER)
-
-        offset = await self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_OFFSET)
-        count = await self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_COUNT)
-        count = int(count / self.driver.num_funcs)
-        stride = await self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_STRIDE)
+        self.txq_map = self.driver.get_resource_map(self.index, 'txq', count)
 
         self.log.info("TXQ offset: 0x%08x", offset)
-        self.log.info("TXQ count: %d", count)
+        self.log.info("TXQ count: %d (%d per function)", count, self.txq_map.func_count)
         self.log.info("TXQ stride: 0x%08x", stride)
 
-        count = min(count, MQNIC_MAX_TXQ)
+        self.txq_res = self.txq_map.get_resource(self.driver.func_id, self.hw_regs.create_window(offset), stride, MQNIC_MAX_TXQ,
+            self.driver.shared_bar)
 
-        self.txq_res = Resource(count, self.hw_regs.create_window(offset), stride)
+        offset, count, stride = rxq_cfg
 
-        self.rxq_rb = self.reg_blocks.find(MQNIC_RB_RX_QM_TYPE, MQNIC_RB_RX_QM_VER)
-
-        offset = await self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_OFFSET)
-        count = await self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_COUNT)
-        count = int(count / self.driver.num_funcs)
-        stride = await self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_STRIDE)
+        self.rxq_map = self.driver.get_resource_map(self.index, 'rxq', count)
 
         self.log.info("RXQ offset: 0x%08x", offset)
-        self.log.info("RXQ count: %d", count)
+        self.log.info("RXQ count: %d (%d per function)", count, self.rxq_map.func_count)
         self.log.info("RXQ stride: 0x%08x", stride)
 
-        count = min(count, MQNIC_MAX_RXQ)
-
-        self.rxq_res = Resource(count, self.hw_regs.create_window(offset), stride)
+        self.rxq_res = self.rxq_map.get_resource(self.driver.func_id, self.hw_regs.create_window(offset), stride, MQNIC_MAX_RXQ,
+            self.driver.shared_bar)
 
         self.rx_queue_map_rb = self.reg_blocks.find(MQNIC_RB_RX_QUEUE_MAP_TYPE, MQNIC_RB_RX_QUEUE_MAP_VER)
 
-        val = await self.rx_queue_map_rb.read_dword(MQNIC_RB_RX_QUEUE_MAP_REG_CFG)
+        val, = await self.driver.read_static(key+".rx_queue_map", self.rx_queue_map_rb, MQNIC_RB_RX_QUEUE_MAP_REG_CFG)
         self.rx_queue_map_indir_table_size = 2**((val >> 8) & 0xff)
         self.rx_queue_map_indir_table = []
+
+        indir_offsets = await gather(*[self.driver.read_static("%s.rx_queue_map%d" % (key, k), self.rx_queue_map_rb,
+            MQNIC_RB_RX_QUEUE_MAP_CH_OFFSET + MQNIC_RB_RX_QUEUE_MAP_CH_STRIDE*k + MQNIC_RB_RX_QUEUE_MAP_CH_REG_OFFSET)
+            for k in range(self.port_count)])
+
         for k in range(self.port_count):
-            offset = await self.rx_queue_map_rb.read_dword(MQNIC_RB_RX_QUEUE_MAP_CH_OFFSET +
-                    MQNIC_RB_RX_QUEUE_MAP_CH_STRIDE*k + MQNIC_RB_RX_QUEUE_MAP_CH_REG_OFFSET)
+            offset, = indir_offsets[k]
             self.rx_queue_map_indir_table.append(self.rx_queue_map_rb.parent.create_window(offset))
 
+            # queue map is shared, only function 0 resets it
+            if self.driver.func_id != 0:
+                continue
+
             await self.set_rx_queue_map_rss_mask(k, 0)
             await self.set_rx_queue_map_app_mask(k, 0)
             await self.set_rx_queue_map_indir_table(k, 0, 0)
@@ -1407,7 +2221,6 @@ class Interface:
             rb = self.reg_blocks.find(MQNIC_RB_PORT_TYPE, MQNIC_RB_PORT_VER, index=k)
 
             p = Port(self, k, rb)
-            await p.init()
             self.ports.append(p)
 
         # create schedulers
@@ -1416,9 +2229,11 @@ class Interface:
             rb = self.reg_blocks.find(MQNIC_RB_SCHED_BLOCK_TYPE, MQNIC_RB_SCHED_BLOCK_VER, index=k)
 
             s = SchedulerBlock(self, k, rb)
-            await s.init()
             self.sched_blocks.append(s)
 
+        # ports and scheduler blocks are independent, discover them concurrently
+        await gather(*[p.init() for p in self.ports], *[s.init() for s in self.sched_blocks])
+
         assert self.sched_block_count == len(self.sched_blocks)
 
         # create EQs
@@ -1427,7 +2242,8 @@ class Interface:
             eq = Eq(self)
             await eq.open(self.index, 1024)
             self.eq.append(eq)
-            await eq.arm()
+            if self.driver.irq_enabled:
+                await eq.arm()
 
         self.txq = []
         self.rxq = []
@@ -1435,22 +2251,29 @@ class Interface:
         # wait for all writes to complete
         await self.hw_regs.read_dword(0)
 
-    async def open(self):
-        for k in range(self.rxq_res.get_count()):
+    async def open(self, txq_count=None, rxq_count=None, ring_size=1024):
+        if rxq_count is None:
+            rxq_count = self.rxq_res.get_count()
+        if txq_count is None:
+            txq_count = self.txq_res.get_count()
+
+        for k in range(rxq_count):
             cq = Cq(self)
-            await cq.open(self.eq[k % len(self.eq)], 1024)
-            await cq.arm()
+            await cq.open(self.eq[k % len(self.eq)] if self.eq else None, ring_size)
+            if self.eq and self.driver.irq_enabled:
+                await cq.arm()
             rxq = Rxq(self)
-            await rxq.open(cq, 1024, 4)
+            await rxq.open(cq, ring_size, 4)
             await rxq.enable()
             self.rxq.append(rxq)
 
-        for k in range(self.txq_res.get_count()):
+        for k in range(txq_count):
             cq = Cq(self)
-            await cq.open(self.eq[k % len(self.eq)], 1024)
-            await cq.arm()
+            await cq.open(self.eq[k % len(self.eq)] if self.eq else None, ring_size)
+            if self.eq and self.driver.irq_enabled:
+                await cq.arm()
             txq = Txq(self)
-            await txq.open(cq, 1024, 4)
+            await txq.open(cq, ring_size, 4)
             await txq.enable()
             self.txq.append(txq)
 
@@ -1462,6 +2285,10 @@ class Interface:
 
         self.port_up = True
 
+        if not self.eq or not self.driver.irq_enabled:
+            # function has no event queues or no interrupt vectors, fall back to polling
+            await self.set_poll_mode(MQNIC_POLL_MODE_BUSY)
+
     async def close(self):
         self.port_up = False
 
@@ -1476,15 +2303,14 @@ class Interface:
         # wait for all writes to complete
         await self.hw_regs.read_dword(0)
 
+        # closing a queue frees its outstanding buffers
         for q in self.txq:
             cq = q.cq
-            await q.free_buf()
             await q.close()
             await cq.close()
 
         for q in self.rxq:
             cq = q.cq
-            await q.free_buf()
             await q.close()
             await cq.close()
 
@@ -1493,7 +2319,7 @@ class Interface:
 
         await self.ports[0].set_tx_ctrl(0)
 
-    async def start_xmit(self, skb, tx_ring=None, csum_start=None, csum_offset=None):
+    async def start_xmit(self, skb, tx_ring=None, csum_start=None, csum_offset=None, xmit_more=False):
         if not self.port_up:
             return
 
@@ -1508,21 +2334,38 @@ class Interface:
 
         ring = self.txq[ring_index]
 
+        blocked = None
+
         while True:
             # check for space in ring
             if ring.prod_ptr - ring.cons_ptr < ring.full_size:
                 break
 
+            if blocked is None:
+                blocked = get_sim_time('ns')
+
+            # hand deferred descriptors to the hardware before waiting for space
+            await ring.flush()
+
             # wait for space
             ring.clean_event.clear()
             await ring.clean_event.wait()
 
+        now = get_sim_time('ns')
+
+        if blocked is not None:
+            ring.metrics.record_blocked(now - blocked)
+
         index = ring.prod_ptr & ring.size_mask
 
         ring.packets += 1
         ring.bytes += len(data)
+        ring.metrics.packets += 1
+        ring.metrics.bytes += len(data)
+
+        ring.tx_time[index] = now
 
-        pkt = self.driver.alloc_pkt()
+        pkt = self.driver.alloc_pkt(len(data)+10, ring.pkt_cache)
 
         assert not ring.tx_info[index]
         ring.tx_info[index] = pkt
@@ -1548,11 +2391,97 @@ class Interface:
             struct.pack_into("<4xLQ", ring.buf, index*ring.stride+k*MQNIC_DESC_SIZE, seg, ptr+offset if seg else 0)
             offset += seg
 
+        self.driver.trace_txq.record(MQNIC_TRACE_TX_XMIT, ring.index, index, length, csum_cmd)
+
         ring.prod_ptr += 1
 
-        await ring.write_prod_ptr()
+        if not xmit_more:
+            await ring.write_prod_ptr()
+
+    async def start_xmit_batch(self, pkts, tx_ring=None, csum_start=None, csum_offset=None, batch_size=None):
+        # queue descriptors with xmit_more and ring each doorbell once per batch
+        # tx_ring is either a single ring index or a sequence of ring indices, one per packet
+        if not self.port_up:
+            return 0
+
+        pkts = list(pkts)
+
+        if tx_ring is None or isinstance(tx_ring, int):
+            rings = [tx_ring or 0]*len(pkts)
+        else:
+            rings = list(tx_ring)
+            assert len(rings) == len(pkts)
+
+        if not batch_size:
+            batch_size = len(pkts)
+
+        doorbells = sum(q.doorbells for q in self.txq)
+
+        for start in range(0, len(pkts), batch_size):
+            pending = set()
+
+            for skb, ring_index in zip(pkts[start:start+batch_size], rings[start:start+batch_size]):
+                await self.start_xmit(skb, ring_index, csum_start, csum_offset, xmit_more=True)
+                pending.add(ring_index)
+
+            for ring_index in sorted(pending):
+                await self.txq[ring_index].flush()
+
+        return sum(q.doorbells for q in self.txq) - doorbells
+
+    def get_tx_doorbells_per_packet(self):
+        packets = sum(q.packets for q in self.txq)
+        if not packets:
+            return 0.0
+        return sum(q.doorbells for q in self.txq) / packets
+
+    async def set_poll_mode(self, mode):
+        # switch between per-event interrupt handling, NAPI-style budgeted polling
+        # and busy polling with all interrupts left disarmed
+        if mode != MQNIC_POLL_MODE_BUSY and not self.driver.irq_enabled:
+            raise Exception("Function %d has no interrupt vectors, only busy polling" % self.driver.func_id)
+
+        prev_mode = self.poll_mode
+        self.poll_mode = mode
+
+        if mode == prev_mode:
+            return
+
+        self.log.info("Interface %d poll mode %d -> %d", self.index, prev_mode, mode)
+
+        if mode == MQNIC_POLL_MODE_BUSY:
+            self.busy_poll_task = cocotb.start_soon(self._run_busy_poll())
+            return
+
+        if self.busy_poll_task:
+            await self.busy_poll_task
+            self.busy_poll_task = None
+
+        if prev_mode == MQNIC_POLL_MODE_BUSY:
+            # drain and re-arm everything that was left disarmed while busy polling
+            for eq in self.eq:
+                for cq in list(eq.cq_table.values()):
+                    while not await cq.poll():
+                        pass
+                await eq.arm()
+
+    async def _run_busy_poll(self):
+        while self.poll_mode == MQNIC_POLL_MODE_BUSY:
+            for q in self.rxq + self.txq:
+                if q.cq:
+                    await q.cq.poll(arm=False)
+
+            await Timer(self.busy_poll_interval, 'ns')
+
+    async def wait_tx_idle(self):
+        # wait until every transmitted packet has been completed
+        for q in self.txq:
+            while not q.empty():
+                q.clean_event.clear()
+                await q.clean_event.wait()
 
     async def set_mtu(self, mtu):
+        self.mtu = mtu
         await self.if_ctrl_rb.write_dword(MQNIC_RB_IF_CTRL_REG_TX_MTU, mtu)
         await self.if_ctrl_rb.write_dword(MQNIC_RB_IF_CTRL_REG_RX_MTU, mtu)
 
@@ -1578,23 +2507,112 @@ class Interface:
     async def set_rx_queue_map_indir_table(self, port, index, val):
         await self.rx_queue_map_indir_table[port].write_dword(index*4, val)
 
-    async def recv(self):
-        if not self.pkt_rx_queue:
-            print("Scott: waiting for packet")
-            self.pkt_rx_sync.clear()
-            await self.pkt_rx_sync.wait()
-        print("Scott: received packet")
-        return self.recv_nowait()
-
-    def recv_nowait(self):
-        if self.pkt_rx_queue:
-            return self.pkt_rx_queue.popleft()
+    def get_rxq(self, queue):
+        for q in self.rxq:
+            if q.index == queue:
+                return q
+        raise Exception("RX queue %d not open" % queue)
+
+    def _get_rx_ring(self, queue=None):
+        # ring holding the next packet; without a queue, the oldest packet across all rings
+        if queue is not None:
+            ring = self.get_rxq(queue)
+            return ring if ring.pkt_rx_queue else None
+
+        ring = None
+        for q in self.rxq:
+            if q.pkt_rx_queue and (ring is None or q.pkt_rx_queue[0].seq < ring.pkt_rx_queue[0].seq):
+                ring = q
+        return ring
+
+    def _get_rx_sync(self, queue=None):
+        if queue is None:
+            return self.pkt_rx_sync
+        return self.get_rxq(queue).pkt_rx_sync
+
+    def rx_pending(self, queue=None):
+        if queue is not None:
+            return len(self.get_rxq(queue).pkt_rx_queue)
+        return sum(len(q.pkt_rx_queue) for q in self.rxq)
+
+    async def recv(self, queue=None):
+        await self.wait(queue)
+        return self.recv_nowait(queue)
+
+    def _pop_rx(self, ring):
+        skb = ring.pkt_rx_queue.popleft()
+        ring.metrics.latency.add(get_sim_time('ns') - skb.rx_time)
+        if self.rx_capture:
+            self.rx_capture.write(skb.data, skb.rx_time)
+        return skb
+
+    def recv_nowait(self, queue=None):
+        ring = self._get_rx_ring(queue)
+        if ring:
+            return self._pop_rx(ring)
         return None
 
-    async def wait(self):
-        if not self.pkt_rx_queue:
-            self.pkt_rx_sync.clear()
-            await self.pkt_rx_sync.wait()
+    def recv_many_nowait(self, n=None, queue=None):
+        if queue is not None:
+            ring = self.get_rxq(queue)
+            count = len(ring.pkt_rx_queue) if n is None else min(n, len(ring.pkt_rx_queue))
+            return [self._pop_rx(ring) for k in range(count)]
+
+        pkts = []
+        while n is None or len(pkts) < n:
+            ring = self._get_rx_ring()
+            if not ring:
+                break
+            pkts.append(self._pop_rx(ring))
+        return pkts
+
+    async def recv_many(self, n, queue=None, timeout=None, timeout_unit='ns'):
+        # receive n packets in arrival order, returns fewer if the timeout expires first
+        pkts = []
+
+        if timeout is not None:
+            deadline = get_sim_time() + get_sim_steps(timeout, timeout_unit)
+
+        while True:
+            pkts.extend(self.recv_many_nowait(n-len(pkts), queue))
+
+            if len(pkts) >= n:
+                break
+
+            sync = self._get_rx_sync(queue)
+            sync.clear()
+
+            if timeout is None:
+                await sync.wait()
+            else:
+                remaining = deadline - get_sim_time()
+                if remaining <= 0:
+                    break
+                await First(sync.wait(), Timer(remaining, 'step'))
+
+        return pkts
+
+    async def recv_batches(self, queue=None, count=None, batch_size=None):
+        # async iterator yielding lists of packets as they arrive, stops after count packets
+        received = 0
+
+        while count is None or received < count:
+            await self.wait(queue)
+
+            n = batch_size
+            if count is not None:
+                n = count-received if n is None else min(n, count-received)
+
+            batch = self.recv_many_nowait(n, queue)
+            received += len(batch)
+
+            yield batch
+
+    async def wait(self, queue=None):
+        while not self._get_rx_ring(queue):
+            sync = self._get_rx_sync(queue)
+            sync.clear()
+            await sync.wait()
 
 
 class Interrupt:
@@ -1628,8 +2646,8 @@ class Interrupt:
 
 
 class Driver:
-    def __init__(self):
-        self.log = SimLog("cocotb.mqnic")
+    def __init__(self, func_id=0):
+        self.log = SimLog("cocotb.mqnic" if func_id == 0 else "cocotb.mqnic.f%d" % func_id)
 
         self.dev = None
         self.pool = None
@@ -1669,28 +2687,67 @@ class Driver:
         self.if_count = 1
         self.interfaces = []
 
+        self.func_id = func_id
+        self.num_funcs = 1
+
+        # set for functions reached through the PF BAR, which the hardware does not translate
+        self.shared_bar = False
+        self.pf = None
+        self.vf_drivers = {}
+        # (interface index, resource type) -> ResourceMap, shared by the PF and its VF drivers
+        self.resource_maps = {}
+        # MSI-X vectors are {function, irq index}, each function owns 1 << IRQ_INDEX_WIDTH of them
+        self.irqs_per_func = 0
+        # cleared for functions whose vectors have no handler, their interfaces busy poll
+        self.irq_enabled = True
+
+        self.use_reg_layout_cache = True
+        self.reg_layout = {}
+        self.reg_layout_key = None
+
         self.pkt_buf_size = 16384
-        self.allocated_packets = []
-        self.free_packets = deque()
+        self.pkt_pools = {}
+
+        # per-ring metrics, kept after the rings are closed
+        self.ring_metrics = []
+
+        self.trace = None
+        self.set_trace(TraceRecorder(capacity=0))
 
-    async def init_pcie_dev(self, dev):
+        # scan completion rings with numpy when available, per-entry handlers otherwise
+        self.vectorized_cq = np is not None
+        self.pkt_cache_size = MQNIC_PKT_CACHE_SIZE
+
+    async def init_pcie_dev(self, dev, irq_count=None, irq_index_width=None):
+        # irq_index_width: per-function MSI-X index width (IRQ_INDEX_WIDTH), needed to route
+        # the vectors of VF drivers; irq_count vectors are registered, covering every function
+        # whose vectors start below it
         assert not self.initialized
         self.initialized = True
 
+        if irq_index_width is not None:
+            self.irqs_per_func = 1 << irq_index_width
+
         self.dev = dev
 
         self.pool = self.dev.rc.mem_pool
 
         await self.dev.enable_device()
         await self.dev.set_master()
-        await self.dev.alloc_irq_vectors(1, MQNIC_MAX_EQ)
+
+        if irq_count is None:
+            await self.dev.alloc_irq_vectors(1, MQNIC_MAX_EQ)
+            irq_count = 2
+        else:
+            # vectors for all functions, routed to VF drivers by interrupt_handler
+            await self.dev.alloc_irq_vectors(1, irq_count)
 
         self.hw_regs = self.dev.bar_window[0]
         self.app_hw_regs = self.dev.bar_window[2]
         self.ram_hw_regs = self.dev.bar_window[4]
 
         # set up MSI
-        for index in range(2):
+        for index in range(irq_count):
             self.log.info(f"Setting up IRQ index: {index}")
             irq = Interrupt(index, self.interrupt_handler)
             self.dev.request_irq(index, irq.interrupt)
@@ -1698,6 +2755,63 @@ class Driver:
 
         await self.init_common()
 
+    async def init_pcie_vf(self, pf):
+        # bring up a function on a device already initialized by the PF driver; register
+        # access goes through the PF BAR at the function's physical resource offsets
+        assert not self.initialized
+        assert self.func_id != 0
+        self.initialized = True
+
+        self.pf = pf
+        self.dev = pf.dev
+        self.resource_maps = pf.resource_maps
+        self.pool = pf.pool
+
+        self.hw_regs = pf.hw_regs
+        self.app_hw_regs = pf.app_hw_regs
+        self.ram_hw_regs = pf.ram_hw_regs
+
+        self.shared_bar = True
+        self.use_reg_layout_cache = pf.use_reg_layout_cache
+
+        self.set_trace(pf.trace)
+
+        # interrupts reach this driver through the PF handlers, if the PF registered this
+        # function's vectors
+        self.irqs_per_func = pf.irqs_per_func
+        self.irq_enabled = bool(pf.irqs_per_func) and (self.func_id+1)*pf.irqs_per_func <= len(pf.irq_list)
+        if not self.irq_enabled:
+            self.log.info("Function %d has no MSI-X vectors, using busy polling", self.func_id)
+
+        pf.vf_drivers[self.func_id] = self
+
+        await self.init_common()
+
+    def get_resource_map(self, if_index, kind, total_count):
+        # allocations of every function land in one map, so check() can see them together
+        key = (if_index, kind)
+        res_map = self.resource_maps.get(key)
+        if res_map is None:
+            res_map = ResourceMap(total_count, self.num_funcs)
+            self.resource_maps[key] = res_map
+        elif res_map.total_count != total_count:
+            raise Exception("Interface %d %s count mismatch: %d, map has %d" % (if_index, kind, total_count,
+                res_map.total_count))
+        return res_map
+
+    def check_resources(self):
+        # verify the allocations of all functions against the shared resource maps
+        for (if_index, kind), res_map in sorted(self.resource_maps.items()):
+            owner = res_map.check()
+            self.log.info("Interface %d %s: %d allocated across %d functions", if_index, kind.upper(),
+                len(owner), len(set(owner.values())))
+
+    async def create_vf_drivers(self, func_ids):
+        # instantiate and bring up one driver per function concurrently
+        drivers = [Driver(func_id) for func_id in func_ids]
+        await gather(*[d.init_pcie_vf(self) for d in drivers])
+        return drivers
+
     async def init_axi_dev(self, pool, hw_regs, app_hw_regs=None, irq=None):
         assert not self.initialized
         self.initialized = True
@@ -1722,35 +2836,48 @@ class Driver:
         if self.ram_hw_regs:
             self.log.info("RAM BAR size: %d", self.ram_hw_regs.size)
 
+        # The FW ID block comes first; its ID registers select a cached layout, if any
+        self.reg_layout = {}
+        self.reg_layout_key = None
+        fw_regs = None
+
+        rb_type, = await read_dwords(self.hw_regs, MQNIC_RB_REG_TYPE, 1)
+        if rb_type == MQNIC_RB_FW_ID_TYPE:
+            fw_regs = await read_dwords(self.hw_regs, MQNIC_RB_FW_ID_REG_FPGA_ID, 9)
+
+            if self.use_reg_layout_cache:
+                fw_id, build_date, git_hash = fw_regs[1], fw_regs[5], fw_regs[6]
+                self.reg_layout_key = "%08x-%08x-%08x" % (fw_id, build_date, git_hash)
+                if self.reg_layout_key in reg_layout_cache:
+                    self.log.info("Using cached register layout %s", self.reg_layout_key)
+                self.reg_layout = reg_layout_cache.setdefault(self.reg_layout_key, {})
+
         # Enumerate registers
-        await self.reg_blocks.enumerate_reg_blocks(self.hw_regs)
+        await self.enumerate_reg_blocks("blocks", self.reg_blocks, self.hw_regs)
 
         # Read ID registers
         self.fw_id_rb = self.reg_blocks.find(MQNIC_RB_FW_ID_TYPE, MQNIC_RB_FW_ID_VER)
 
-        self.fpga_id = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FPGA_ID)
+        if fw_regs is None or self.fw_id_rb._offset != 0:
+            fw_regs = await read_dwords(self.fw_id_rb, MQNIC_RB_FW_ID_REG_FPGA_ID, 9)
+
+        (self.fpga_id, self.fw_id, self.fw_ver, self.board_id, self.board_ver,
+            self.build_date, self.git_hash, self.rel_info, self.num_funcs) = fw_regs
+
         self.log.info("FPGA JTAG ID: 0x%08x", self.fpga_id)
-        self.fw_id = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FW_ID)
         self.log.info("FW ID: 0x%08x", self.fw_id)
-        self.fw_ver = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FW_VER)
         self.log.info("FW version: %d.%d.%d.%d", *self.fw_ver.to_bytes(4, 'big'))
-        self.board_id = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BOARD_ID)
         self.log.info("Board ID: 0x%08x", self.board_id)
-        self.board_ver = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BOARD_VER)
         self.log.info("Board version: %d.%d.%d.%d", *self.board_ver.to_bytes(4, 'big'))
-        self.build_date = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BUILD_DATE)
         self.log.info("Build date: %s UTC (raw: 0x%08x)", datetime.datetime.utcfromtimestamp(self.build_date).isoformat(' '), self.build_date)
-        self.git_hash = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_GIT_HASH)
         self.log.info("Git hash: %08x", self.git_hash)
-        self.rel_info = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_REL_INFO)
         self.log.info("Release info: %d", self.rel_info)
-        self.num_funcs = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_REL_INFO + 4)
         self.log.info("Number of functions: %d", self.num_funcs)
 
         rb = self.reg_blocks.find(MQNIC_RB_APP_INFO_TYPE, MQNIC_RB_APP_INFO_VER)
 
         if rb:
-            self.app_id = await rb.read_dword(MQNIC_RB_APP_INFO_REG_ID)
+            self.app_id, = await self.read_static("app_id", rb, MQNIC_RB_APP_INFO_REG_ID)
             self.log.info("Application ID: 0x%08x", self.app_id)
 
         self.phc_rb = self.reg_blocks.find(MQNIC_RB_PHC_TYPE, MQNIC_RB_PHC_VER)
@@ -1760,13 +2887,11 @@ class Driver:
         self.interfaces = []
 
         if self.if_rb:
-            self.if_offset = await self.if_rb.read_dword(MQNIC_RB_IF_REG_OFFSET)
+            self.if_offset, self.if_count, self.if_stride, self.if_csr_offset = await self.read_static("if",
+                self.if_rb, MQNIC_RB_IF_REG_OFFSET, 4)
             self.log.info("IF offset: %d", self.if_offset)
-            self.if_count = await self.if_rb.read_dword(MQNIC_RB_IF_REG_COUNT)
             self.log.info("IF count: %d", self.if_count)
-            self.if_stride = await self.if_rb.read_dword(MQNIC_RB_IF_REG_STRIDE)
             self.log.info("IF stride: 0x%08x", self.if_stride)
-            self.if_csr_offset = await self.if_rb.read_dword(MQNIC_RB_IF_REG_CSR_OFFSET)
             self.log.info("IF CSR offset: 0x%08x", self.if_csr_offset)
 
             for k in range(self.if_count):
@@ -1777,6 +2902,17 @@ class Driver:
         else:
             self.log.warning("No interface block found")
 
+    async def read_static(self, key, window, offset, count=1):
+        # burst read of static configuration registers, served from the layout cache when present
+        val = self.reg_layout.get(key)
+        if val is None:
+            val = await read_dwords(window, offset, count)
+            self.reg_layout[key] = val
+        return val
+
+    async def enumerate_reg_blocks(self, key, reg_blocks, window, offset=0):
+        self.reg_layout[key] = await reg_blocks.enumerate_reg_blocks(window, offset, self.reg_layout.get(key))
+
     async def _run_edge_interrupts(self, signal):
         last_val = 0
         count = len(signal)
@@ -1788,23 +2924,114 @@ class Driver:
                 await self.irq_list[index].interrupt()
 
     async def interrupt_handler(self, index):
+        if self.vf_drivers and self.irqs_per_func:
+            # vectors are {function, irq index}, route to the owning driver
+            func, irq = divmod(index, self.irqs_per_func)
+            if func in self.vf_drivers:
+                await self.vf_drivers[func].interrupt_handler(irq)
+                return
+
         self.log.info("Interrupt handler start (IRQ %d)", index)
         for i in self.interfaces:
             for eq in i.eq:
                 if eq.irq == index:
-                    await eq.process_eq()
-                    await eq.arm()
+                    eq.irq_count += 1
+                    if i.poll_mode == MQNIC_POLL_MODE_IRQ:
+                        await eq.process_eq()
+                        await eq.arm()
+                    else:
+                        # NAPI re-arms on its own once drained; busy polling leaves interrupts off
+                        await eq.poll(arm=i.poll_mode == MQNIC_POLL_MODE_NAPI)
         self.log.info("Interrupt handler end (IRQ %d)", index)
 
-    def alloc_pkt(self):
-        if self.free_packets:
-            return self.free_packets.popleft()
+    def set_trace(self, trace):
+        # per-entry EQ/CQ/packet records go to the binary trace rather than the log
+        self.trace = trace
+        name = "mqnic.f%d" % self.func_id
+        self.trace_eq = trace.component(name+".eq", MQNIC_TRACE_EQ_EVENTS)
+        self.trace_txq = trace.component(name+".txq", MQNIC_TRACE_TX_EVENTS)
+        self.trace_rxq = trace.component(name+".rxq", MQNIC_TRACE_RX_EVENTS)
 
-        pkt = self.pool.alloc_region(self.pkt_buf_size)
-        self.allocated_packets.append(pkt)
-        return pkt
+    def get_pkt_pool(self, size=None):
+        if size is None:
+            size = self.pkt_buf_size
 
-    def free_pkt(self, pkt):
+        for buf_size in MQNIC_PKT_BUF_SIZES:
+            if size <= buf_size:
+                break
+        else:
+            raise Exception("No packet buffer size class for %d bytes" % size)
+
+        pool = self.pkt_pools.get(buf_size)
+        if pool is None:
+            pool = PacketBufferPool(self.pool, buf_size)
+            self.pkt_pools[buf_size] = pool
+        return pool
+
+    def get_pkt_cache(self, cache, pool):
+        c = cache.get(pool.buf_size)
+        if c is None:
+            c = PacketBufferCache(pool, self.pkt_cache_size)
+            cache[pool.buf_size] = c
+        return c
+
+    def alloc_pkt(self, size=None, cache=None):
+        pool = self.get_pkt_pool(size)
+
+        if cache is None:
+            return pool.alloc()
+
+        return self.get_pkt_cache(cache, pool).alloc()
+
+    def free_pkt(self, pkt, cache=None):
         assert pkt is not None
-        assert pkt in self.allocated_packets
-        self.free_packets.append(pkt)
+
+        if cache is None:
+            pkt.pool.free(pkt)
+        else:
+            self.get_pkt_cache(cache, pkt.pool).free(pkt)
+
+    def flush_pkt_cache(self, cache):
+        for c in cache.values():
+            c.flush()
+
+    def get_pkt_pool_stats(self):
+        return [pool.get_stats() for size, pool in sorted(self.pkt_pools.items())]
+
+    def new_ring_metrics(self, ring_type, interface, index):
+        metrics = RingMetrics(ring_type, self.func_id, interface, index)
+        self.ring_metrics.append(metrics)
+        return metrics
+
+    def get_ring_metrics(self):
+        metrics = list(self.ring_metrics)
+        for func in sorted(self.vf_drivers):
+            metrics.extend(self.vf_drivers[func].ring_metrics)
+        return metrics
+
+    def get_func_metrics(self):
+        # per function totals, one entry for each ring type
+        funcs = {}
+        for m in self.get_ring_metrics():
+            key = (m.func, m.ring_type)
+            if key not in funcs:
+                funcs[key] = RingMetrics(m.ring_type, m.func)
+            funcs[key].merge(m)
+        return [funcs[key] for key in sorted(funcs)]
+
+    def get_metrics(self):
+        return {
+            'rings': [m.to_dict() for m in self.get_ring_metrics()],
+            'functions': [m.to_dict() for m in self.get_func_metrics()],
+        }
+
+    def export_metrics_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.get_metrics(), f, indent=2)
+
+    def export_metrics_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['func', 'interface', 'ring_type', 'ring', 'metric', 'key', 'value'])
+            for m in self.get_ring_metrics():
+                w.writerows(m.to_rows())
@@ -0,0 +1 @@
+../mqnic_scoreboard.py
\ No newline at end of file
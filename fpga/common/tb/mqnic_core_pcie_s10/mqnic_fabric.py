@@ -0,0 +1 @@
+../mqnic_fabric.py
\ No newline at end of file
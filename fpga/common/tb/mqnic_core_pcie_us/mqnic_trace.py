@@ -0,0 +1 @@
+../mqnic_trace.py
\ No newline at end of file
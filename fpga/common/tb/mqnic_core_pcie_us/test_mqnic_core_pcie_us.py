@@ -26,11 +26,13 @@ from cocotbext.pcie.xilinx.us import UltraScalePlusPcieDevice
 
 try:
     import mqnic
+    import mqnic_fabric
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_fabric
     finally:
         del sys.path[0]
 
@@ -217,6 +219,9 @@ class TB(object):
         self.log = SimLog("cocotb.tb")
         self.log.setLevel(logging.DEBUG)
 
+        # binary trace of driver events, configured with MQNIC_TRACE*
+        self.trace = mqnic.TraceRecorder.from_env()
+
         for iface in self.dut.core_pcie_inst.core_inst.iface:
             cocotb.start_soon(self.monitor_rx_engine_desc_table_dequeue(iface.interface_inst.interface_rx_inst.rx_engine_inst))
             cocotb.start_soon(self.monitor_rx_engine_desc_table_store(iface.interface_inst.interface_rx_inst.rx_engine_inst))
@@ -495,6 +500,7 @@ class TB(object):
         self.rc.make_port().connect(self.dev)
 
         self.driver = mqnic.Driver()
+        self.driver.set_trace(self.trace)
 
         self.dev.functions[0].configure_bar(0, 2**len(dut.core_pcie_inst.axil_ctrl_araddr), ext=True, prefetch=True)
         if hasattr(dut.core_pcie_inst, 'pcie_app_ctrl'):
@@ -600,8 +606,11 @@ class TB(object):
         dut.s_axis_stat_tid.setimmediatevalue(0)
         dut.s_axis_stat_tvalid.setimmediatevalue(0)
 
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
+        # event driven fabric between the port MACs, loopback by default, MQNIC_FABRIC=switch
+        # forwards by destination MAC between all ports
+        self.fabric = mqnic_fabric.EthFabric(os.getenv("MQNIC_FABRIC", mqnic_fabric.FABRIC_LOOPBACK))
+        for mac in self.port_mac:
+            self.fabric.add_port(mac)
 
     async def init(self):
 
@@ -642,14 +651,13 @@ class TB(object):
 
         await self.rc.enumerate()
 
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk)
+    @property
+    def loopback_enable(self):
+        return self.fabric.enabled
 
-            if self.loopback_enable:
-                for mac in self.port_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+    @loopback_enable.setter
+    def loopback_enable(self, value):
+        self.fabric.enabled = value
 
 
 @cocotb.test()
@@ -954,6 +962,8 @@ async def run_test_nic(dut):
 
     #     tb.loopback_enable = False
 
+    tb.trace.close()
+
     # tb.log.info("Read statistics counters")
 
     # await Timer(2000, 'ns')
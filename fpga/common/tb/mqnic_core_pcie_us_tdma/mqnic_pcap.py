@@ -0,0 +1 @@
+../mqnic_pcap.py
\ No newline at end of file
@@ -26,11 +26,13 @@ from cocotbext.pcie.xilinx.us import UltraScalePlusPcieDevice
 
 try:
     import mqnic
+    import mqnic_fabric
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_fabric
     finally:
         del sys.path[0]
 
@@ -374,8 +376,11 @@ class TB(object):
         dut.s_axis_stat_tid.setimmediatevalue(0)
         dut.s_axis_stat_tvalid.setimmediatevalue(0)
 
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
+        # event driven fabric between the port MACs, loopback by default, MQNIC_FABRIC=switch
+        # forwards by destination MAC between all ports
+        self.fabric = mqnic_fabric.EthFabric(os.getenv("MQNIC_FABRIC", mqnic_fabric.FABRIC_LOOPBACK))
+        for mac in self.port_mac:
+            self.fabric.add_port(mac)
 
     async def init(self):
 
@@ -417,14 +422,13 @@ class TB(object):
 
         await self.rc.enumerate()
 
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk)
+    @property
+    def loopback_enable(self):
+        return self.fabric.enabled
 
-            if self.loopback_enable:
-                for mac in self.port_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+    @loopback_enable.setter
+    def loopback_enable(self, value):
+        self.fabric.enabled = value
 
 
 @cocotb.test()
@@ -0,0 +1 @@
+../mqnic_monitor.py
\ No newline at end of file
@@ -0,0 +1,227 @@
+import abc
+import asyncio
+import heapq
+import math
+import random
+
+try :
+    from cocotb.triggers import Timer, ClockCycles
+    from cocotb.utils import get_sim_time, get_sim_steps
+except ImportError :
+    Timer = None
+    ClockCycles = None
+    get_sim_time = None
+    get_sim_steps = None
+
+# preamble, start of frame delimiter, FCS and minimum inter-frame gap on the wire
+ETH_WIRE_OVERHEAD = 24
+
+def stream_rng(seed, *stream) -> random.Random :
+# independent, reproducible RNG stream per (seed, VM, purpose); string seeds are hashed deterministically
+    return random.Random(':'.join(str(x) for x in (seed,) + stream))
+
+def wire_time_ns(size : int, rate_gbps : float, overhead : int = ETH_WIRE_OVERHEAD) -> float :
+    return (size + overhead) * 8 / rate_gbps
+
+def split_load(total_gbps : float, weights : 'list[float]') -> 'list[float]' :
+# split an aggregate offered load across VMs in proportion to weights
+    total_weight = sum(weights)
+    return [total_gbps * w / total_weight for w in weights]
+
+class SizeMix :
+# weighted packet size distribution, e.g. SizeMix([(7, 64), (4, 576), (1, 1500)], rng)
+    def __init__(self, sizes : 'list[tuple[float, int]]', rng : random.Random) :
+        self.weights = [w for w, s in sizes]
+        self.sizes = [s for w, s in sizes]
+        self.rng = rng
+        self.mean = sum(w * s for w, s in sizes) / sum(self.weights)
+
+    def sample(self) -> int :
+        return self.rng.choices(self.sizes, self.weights)[0]
+
+def _size_sampler(size) :
+    if isinstance(size, SizeMix) :
+        return size.sample, size.mean
+    return (lambda : size), size
+
+class ArrivalProcess(abc.ABC) :
+# iterating yields (arrival time in ns from the start, packet size) in time order
+    @abc.abstractmethod
+    def __iter__(self) :
+        pass
+
+class CbrArrival(ArrivalProcess) :
+# constant bit rate: back-to-back frames paced to rate_gbps on the wire
+    def __init__(self, rate_gbps : float, size = 1512, overhead : int = ETH_WIRE_OVERHEAD, start_ns : float = 0) :
+        self.rate_gbps = rate_gbps
+        self.size = size
+        self.overhead = overhead
+        self.start_ns = start_ns
+
+    def __iter__(self) :
+        sample, mean = _size_sampler(self.size)
+        t = self.start_ns
+        while True :
+            size = sample()
+            yield t, size
+            t += wire_time_ns(size, self.rate_gbps, self.overhead)
+
+class PoissonArrival(ArrivalProcess) :
+# exponentially distributed gaps with a mean offered load of rate_gbps
+    def __init__(self, rate_gbps : float, rng : random.Random, size = 1512, overhead : int = ETH_WIRE_OVERHEAD,
+                start_ns : float = 0) :
+        self.rate_gbps = rate_gbps
+        self.rng = rng
+        self.size = size
+        self.overhead = overhead
+        self.start_ns = start_ns
+
+    def __iter__(self) :
+        sample, mean = _size_sampler(self.size)
+        rate = 1 / wire_time_ns(mean, self.rate_gbps, self.overhead)
+        t = self.start_ns + self.rng.expovariate(rate)
+        while True :
+            yield t, sample()
+            t += self.rng.expovariate(rate)
+
+class OnOffArrival(ArrivalProcess) :
+# bursts at peak_gbps for on periods separated by silent off periods; period lengths are
+# exponential with the given means, or fixed when exponential is False
+    def __init__(self, peak_gbps : float, on_ns : float, off_ns : float, rng : random.Random, size = 1512,
+                exponential : bool = True, overhead : int = ETH_WIRE_OVERHEAD, start_ns : float = 0) :
+        self.peak_gbps = peak_gbps
+        self.on_ns = on_ns
+        self.off_ns = off_ns
+        self.rng = rng
+        self.size = size
+        self.exponential = exponential
+        self.overhead = overhead
+        self.start_ns = start_ns
+
+    @property
+    def rate_gbps(self) -> float :
+        return self.peak_gbps * self.on_ns / (self.on_ns + self.off_ns)
+
+    def _period(self, mean : float) -> float :
+        if self.exponential :
+            return self.rng.expovariate(1 / mean)
+        return mean
+
+    def __iter__(self) :
+        sample, mean = _size_sampler(self.size)
+        t = self.start_ns
+        while True :
+            burst_end = t + self._period(self.on_ns)
+            while t < burst_end :
+                size = sample()
+                yield t, size
+                t += wire_time_ns(size, self.peak_gbps, self.overhead)
+            t += self._period(self.off_ns)
+
+class MixArrival(ArrivalProcess) :
+# superposition of several processes, e.g. a CBR background plus Poisson or bursty traffic
+    def __init__(self, processes : 'list[ArrivalProcess]') :
+        self.processes = processes
+
+    def __iter__(self) :
+        return heapq.merge(*self.processes, key=lambda x : x[0])
+
+class SimTimer :
+# waits on simulation time through cocotb Timers, scheduling against absolute times so
+# rounding to simulator steps never accumulates
+    def __init__(self) :
+        if Timer is None :
+            raise RuntimeError('SimTimer needs cocotb, use WallTimer to run without a simulator')
+        self.steps_per_ns = get_sim_steps(1, 'ns')
+
+    def now(self) -> float :
+        return get_sim_time() / self.steps_per_ns
+
+    async def wait_until(self, t_ns : float) :
+        steps = round(t_ns * self.steps_per_ns) - get_sim_time()
+        if steps > 0 :
+            await Timer(steps, 'step')
+
+class CycleTimer :
+# waits in whole cycles of clk, arrivals land on the first edge at or after their time
+    def __init__(self, clk, period_ns : float) :
+        if ClockCycles is None :
+            raise RuntimeError('CycleTimer needs cocotb, use WallTimer to run without a simulator')
+        self.clk = clk
+        self.period_ns = period_ns
+
+    def now(self) -> float :
+        return get_sim_time('ns')
+
+    async def wait_until(self, t_ns : float) :
+        cycles = math.ceil((t_ns - self.now()) / self.period_ns)
+        if cycles > 0 :
+            await ClockCycles(self.clk, cycles)
+
+class WallTimer :
+# wall-clock fallback for running the VMs without a simulator; time_scale wall seconds per simulated ns
+    def __init__(self, time_scale : float = 1e-9) :
+        self.time_scale = time_scale
+        self.start = asyncio.get_event_loop().time()
+
+    def now(self) -> float :
+        return (asyncio.get_event_loop().time() - self.start) / self.time_scale
+
+    async def wait_until(self, t_ns : float) :
+        delay = (t_ns - self.now()) * self.time_scale
+        if delay > 0 :
+            await asyncio.sleep(delay)
+
+def default_timer() :
+# simulation time under cocotb, the wall clock when running standalone
+    if Timer is None :
+        return WallTimer()
+    return SimTimer()
+
+class ArrivalStats :
+    def __init__(self) :
+        self.packets = 0
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.start_ns = 0.0
+        self.end_ns = 0.0
+        # time sends started after their scheduled arrival, e.g. while blocked on a full ring
+        self.late_ns = 0.0
+        self.max_late_ns = 0.0
+
+    def offered_gbps(self) -> float :
+        if self.end_ns <= self.start_ns :
+            return 0.0
+        return self.wire_bytes * 8 / (self.end_ns - self.start_ns)
+
+async def run_arrivals(process : ArrivalProcess, send, packet_source, timer = None,
+                duration_ns : float = None, count : int = None, overhead : int = ETH_WIRE_OVERHEAD) -> ArrivalStats :
+# await each arrival on timer, then send(packet_source(size)); stops after duration_ns or count packets
+    if timer is None :
+        timer = default_timer()
+    stats = ArrivalStats()
+    start = timer.now()
+    stats.start_ns = start
+    for t, size in process :
+        if duration_ns is not None and t >= duration_ns :
+            break
+        if count is not None and stats.packets >= count :
+            break
+        await timer.wait_until(start + t)
+        late = timer.now() - (start + t)
+        if late > 0 :
+            stats.late_ns += late
+            stats.max_late_ns = max(stats.max_late_ns, late)
+        await send(packet_source(size))
+        stats.packets += 1
+        stats.bytes += size
+        stats.wire_bytes += size + overhead
+    stats.end_ns = start + duration_ns if duration_ns is not None else timer.now()
+    return stats
+
+async def offer_load(interface, tx_ring : int, process : ArrivalProcess, packet_source, timer = None,
+                duration_ns : float = None, count : int = None) -> ArrivalStats :
+# feed an mqnic Interface directly, one call to start_xmit per arrival
+    async def send(pkt) :
+        await interface.start_xmit(pkt, tx_ring)
+    return await run_arrivals(process, send, packet_source, timer, duration_ns, count)
@@ -1,13 +1,231 @@
 import asyncio
+import logging
+from collections import deque
+
+# default capacity of every inter-component queue, in messages
+DEFAULT_QUEUE_SIZE = 1024
+
+class CommunicationQueue :
+# bounded FIFO channel between two components; when full, puts either block until the
+# consumer makes room or drop the new message (drop tail), and both cases are counted
+    def __init__(self, maxsize : int = DEFAULT_QUEUE_SIZE, drop_when_full : bool = False, name : str = '') :
+        if maxsize <= 0 :
+            raise ValueError(f'queue size must be positive, got {maxsize}')
+        self.maxsize = maxsize
+        self.drop_when_full = drop_when_full
+        self.name = name
+        self.items = deque()
+        self.getters = deque()
+        self.putters = deque()
+
+        self.put_count = 0
+        self.get_count = 0
+        self.drop_count = 0
+        # puts that had to wait for room, i.e. backpressure applied to the producer
+        self.block_count = 0
+        self.high_water = 0
+        # occupancy seen by each arriving message, for the mean
+        self.occupancy_sum = 0
+
+    def qsize(self) -> int :
+        return len(self.items)
+
+    def empty(self) -> bool :
+        return not self.items
+
+    def full(self) -> bool :
+        return len(self.items) >= self.maxsize
+
+    def free(self) -> int :
+        return self.maxsize - len(self.items)
+
+    def _wakeup(self, waiters : deque) :
+        while waiters :
+            waiter = waiters.popleft()
+            if not waiter.done() :
+                waiter.set_result(None)
+                break
+
+    def _wakeup_getters(self) :
+    # wake the oldest getter whose min_items are queued, a get_many still short of its
+    # minimum keeps its place without using up the wakeup
+        for entry in self.getters :
+            min_items, waiter = entry
+            if not waiter.done() and len(self.items) >= min_items :
+                self.getters.remove(entry)
+                waiter.set_result(None)
+                return
+
+    async def _wait(self, waiters : deque, min_items : int = None) :
+    # getters wait with the number of items they need, putters with None
+        waiter = asyncio.get_running_loop().create_future()
+        entry = waiter if min_items is None else (min_items, waiter)
+        waiters.append(entry)
+        try :
+            await waiter
+        except asyncio.CancelledError :
+            waiter.cancel()
+            try :
+                waiters.remove(entry)
+            except ValueError :
+                pass
+            # hand a wakeup this waiter already received on to the next one
+            if not waiter.cancelled() :
+                if min_items is None :
+                    self._wakeup(waiters)
+                else :
+                    self._wakeup_getters()
+            raise
+
+    async def _wait_items(self, min_items : int) :
+        while len(self.items) < min_items :
+            await self._wait(self.getters, min_items)
+            if len(self.items) < min_items :
+                # another getter ran first and took the items, pass the wakeup on to
+                # whichever waiting getter the remaining items satisfy
+                self._wakeup_getters()
+
+    def _push(self, item) :
+        self.occupancy_sum += len(self.items)
+        self.items.append(item)
+        self.put_count += 1
+        if len(self.items) > self.high_water :
+            self.high_water = len(self.items)
+        self._wakeup_getters()
+
+    def _pop(self) :
+        item = self.items.popleft()
+        self.get_count += 1
+        self._wakeup(self.putters)
+        return item
+
+    def put_nowait(self, item) -> bool :
+    # returns False if the message was dropped, raises asyncio.QueueFull on a full blocking queue
+        if self.full() :
+            if self.drop_when_full :
+                self.drop_count += 1
+                return False
+            raise asyncio.QueueFull
+        self._push(item)
+        return True
+
+    async def put(self, item) -> bool :
+        if self.full() :
+            if self.drop_when_full :
+                self.drop_count += 1
+                return False
+            self.block_count += 1
+            while self.full() :
+                await self._wait(self.putters)
+        self._push(item)
+        return True
+
+    async def put_many(self, items) -> int :
+    # enqueue a batch, returns how many were accepted; blocking queues accept everything,
+    # waiting for room as often as needed, drop tail queues drop whatever does not fit
+        accepted = 0
+        blocked = False
+        for item in items :
+            if self.full() :
+                if self.drop_when_full :
+                    self.drop_count += 1
+                    continue
+                if not blocked :
+                    self.block_count += 1
+                    blocked = True
+                while self.full() :
+                    await self._wait(self.putters)
+            self._push(item)
+            accepted += 1
+        return accepted
+
+    def get_nowait(self) :
+        if not self.items :
+            raise asyncio.QueueEmpty
+        return self._pop()
+
+    async def get(self) :
+        await self._wait_items(1)
+        return self._pop()
+
+    def get_many_nowait(self, max_items : int = None) -> list :
+        count = len(self.items) if max_items is None else min(max_items, len(self.items))
+        return [self._pop() for i in range(count)]
+
+    async def get_many(self, max_items : int = None, min_items : int = 1) -> list :
+    # waits until at least min_items are queued, then drains up to max_items in one go
+        min_items = min(min_items, self.maxsize)
+        await self._wait_items(min_items)
+        return self.get_many_nowait(max_items)
+
+    # message-style aliases
+    async def send_message(self, item) -> bool :
+        return await self.put(item)
+
+    async def receive_message(self) :
+        return await self.get()
+
+    def mean_occupancy(self) -> float :
+        if not self.put_count :
+            return 0.0
+        return self.occupancy_sum / self.put_count
+
+    def stats(self) -> dict :
+        return {
+            'name': self.name,
+            'size': self.maxsize,
+            'occupancy': len(self.items),
+            'high_water': self.high_water,
+            'mean_occupancy': self.mean_occupancy(),
+            'puts': self.put_count,
+            'gets': self.get_count,
+            'drops': self.drop_count,
+            'blocked': self.block_count,
+        }
 
 class CommunicationQueues :
-    def __init__(self, send_queue : asyncio.Queue, receive_queue : asyncio.Queue) :
+    def __init__(self, send_queue : CommunicationQueue, receive_queue : CommunicationQueue) :
         self.send_queue = send_queue
         self.receive_queue = receive_queue
-        
-def create_communication_queue_pair() -> 'tuple[CommunicationQueues, CommunicationQueues]':
-    first_to_second = asyncio.Queue()
-    second_to_first = asyncio.Queue()
+
+    async def send_message(self, item) -> bool :
+        return await self.send_queue.put(item)
+
+    async def receive_message(self) :
+        return await self.receive_queue.get()
+
+def create_communication_queue(drop_when_full : bool = False, maxsize : int = DEFAULT_QUEUE_SIZE,
+                name : str = '') -> CommunicationQueue :
+    return CommunicationQueue(maxsize, drop_when_full, name)
+
+def create_communication_queue_pair(maxsize : int = DEFAULT_QUEUE_SIZE, drop_when_full : bool = False,
+                name : str = '') -> 'tuple[CommunicationQueues, CommunicationQueues]':
+    first_to_second = CommunicationQueue(maxsize, drop_when_full, f'{name}.tx' if name else '')
+    second_to_first = CommunicationQueue(maxsize, drop_when_full, f'{name}.rx' if name else '')
     first_queue = CommunicationQueues(first_to_second, second_to_first)
     second_queue = CommunicationQueues(second_to_first, first_to_second)
     return (first_queue, second_queue)
+
+def pair_queues(pair : 'tuple[CommunicationQueues, CommunicationQueues]') -> 'list[CommunicationQueue]' :
+    return [pair[0].send_queue, pair[0].receive_queue]
+
+def log_queue_stats(queues : 'list[CommunicationQueue]', logger : logging.Logger = None) :
+# one summary line for all queues, plus a line per queue that dropped or blocked
+    logger = logger if logger is not None else logging.getLogger()
+    if not queues :
+        return
+    drops = sum(q.drop_count for q in queues)
+    blocked = sum(q.block_count for q in queues)
+    full = sum(1 for q in queues if q.full())
+    worst = max(queues, key=lambda q : q.high_water)
+    logger.info(f'{len(queues)} queues: {sum(q.qsize() for q in queues)} messages queued, {full} full, '
+        f'{drops} dropped, {blocked} blocked puts, highest high-water mark {worst.high_water}/{worst.maxsize} ({worst.name})')
+    for q in queues :
+        if q.drop_count or q.block_count :
+            logger.debug(f'queue {q.name}: {q.stats()}')
+
+async def queue_monitor(queues : 'list[CommunicationQueue]', interval : float, logger : logging.Logger = None) :
+# periodically log queue occupancy so backpressure shows up while a run is in progress
+    while True :
+        await asyncio.sleep(interval)
+        log_queue_stats(queues, logger)
@@ -1,11 +1,8 @@
-import asyncio
-import time
-import numpy as np
 
-from scapy.layers.l2 import Ether
-from scapy.layers.inet import IP, UDP, TCP
-import scapy.utils
 import communication
+import packet_template
+import arrival
+import pregen
 import ipaddress
 import random
 import logging
@@ -13,57 +10,38 @@ import logging
 class ApplicationDetails :
     
     def __init__(self, my_address : ipaddress.IPv4Address, destination_addresses : 'list[ipaddress.IPv4Address]',
-                address_mac_dict : dict, application_driver_queues : communication.CommunicationQueues) :
+                address_mac_dict : dict, application_driver_queues : communication.CommunicationQueues,
+                packet_generator : packet_template.PacketGenerator = None,
+                arrival_process : arrival.ArrivalProcess = None, timer = None, seed : int = 0) :
         self.my_address = my_address
         self.destination_addresses = destination_addresses
         self.address_mac_dict = address_mac_dict
         self.application_driver_queues = application_driver_queues
+        # flow templates and payload pool, may be shared between VMs
+        self.packet_generator = packet_generator if packet_generator is not None else pregen.make_packet_generator(
+            address_mac_dict, seed)
+        # packet arrivals in simulation time, 1 Gbps Poisson unless given; seeded per VM
+        self.arrival_process = arrival_process if arrival_process is not None else arrival.PoissonArrival(1.0,
+            arrival.stream_rng(seed, my_address, 'arrival'))
+        self.timer = timer
+        self.rng = arrival.stream_rng(seed, my_address, 'destination')
         
-def random_payload_application(packet_size : int = 256) :
-    payload = bytes([random.randint(0, 255) for i in range(packet_size)])
-    return payload
-
-def udp_protocol(src_port : int, dst_port : int) :
-    return UDP(sport=src_port, dport=dst_port)
-
-#TODO: probably doesnt work as is.
-def tcp_protocol(src_port : int, dst_port : int) :
-    return TCP(sport=src_port, dport=dst_port)
-
-def ethernet_protocol(src_mac : str, dst_mac : str) :
-    return Ether(src=src_mac, dst=dst_mac)
-
-def choose_random_destination(destination_addresses : list) :
-    return destination_addresses[random.randint(0, len(destination_addresses)-1)]
-
-def ip_protocol(src_address : str, dst_address : str) :
-    return IP(src=src_address, dst=dst_address)
-
-async def gaussian_delay(center : float = 1, deviation : float = 1, max_range : float = 3) -> float :
-# waits for a random amount of time. The random number is based on a gaussian distribution
-    sleep_time = np.random.normal(center, deviation)
-    sleep_time = max(sleep_time, 0, center - max_range)
-    sleep_time = min(sleep_time, center + max_range)
-    await asyncio.sleep(sleep_time)
+def choose_random_destination(destination_addresses : list, rng : random.Random = random) :
+    return destination_addresses[rng.randint(0, len(destination_addresses)-1)]
 
 async def application_coroutine(application_details : ApplicationDetails) -> bytes:
     
     logger = logging.getLogger()
     
-    while True :
-        await gaussian_delay(1, 1, 3)
-        payload = random_payload_application(1470)
-        dst_address = choose_random_destination(application_details.destination_addresses)
-        layer_4 = udp_protocol(1, 1)
-        layer_3 = ip_protocol(application_details.my_address, dst_address)
-        src_mac = application_details.address_mac_dict[application_details.my_address]
-        dst_mac = application_details.address_mac_dict[dst_address]
-        layer_2 = ethernet_protocol(src_mac, dst_mac)
-        
-        test_pkt = layer_2 / layer_3 / layer_4 / payload
-        test_pkt[UDP].chksum = scapy.utils.checksum(bytes(test_pkt))
-        
-        final_packet = test_pkt.build()
+    packet_generator = application_details.packet_generator
+    timer = application_details.timer if application_details.timer is not None else arrival.default_timer()
+    start = timer.now()
+    
+    for t, size in application_details.arrival_process :
+        await timer.wait_until(start + t)
+        dst_address = choose_random_destination(application_details.destination_addresses, application_details.rng)
+        # headers come from the cached flow template, only per-packet fields are patched
+        final_packet = packet_generator.build(application_details.my_address, dst_address, 1, 1, size - packet_template.HEADER_SIZE)
         
         await application_details.application_driver_queues.send_message(final_packet)
         logger.info(f'{application_details.my_address} generated a packet of size {len(final_packet)} with destination {dst_address}')
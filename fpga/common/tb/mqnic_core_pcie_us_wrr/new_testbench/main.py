@@ -6,9 +6,11 @@ import argparse
 import logging
 import virtual_machine
 import communication
+import arrival
+import pregen
 
 
-def parse_args() -> 'tuple[int, str, str, str]':
+def parse_args() -> argparse.Namespace :
 # parse input arguments to main
     parser = argparse.ArgumentParser(
         prog = 'SRIOVTestbench',
@@ -20,12 +22,25 @@ def parse_args() -> 'tuple[int, str, str, str]':
     parser.add_argument('address', type=str, help='The starting IP address for the drivers.')
     parser.add_argument('--log', dest='log', required=False, type=str,
                         help='The minimum logging level. Options are DEBUG, INFO, WARNING, or ERROR', default='DEBUG')
+    parser.add_argument('--load', dest='load', required=False, type=float,
+                        help='Total offered load in Gbps, split evenly across the VMs', default=1.0)
+    parser.add_argument('--seed', dest='seed', required=False, type=int,
+                        help='Seed for the per-VM arrival and destination RNG streams', default=0)
+    parser.add_argument('--queue-size', dest='queue_size', required=False, type=int,
+                        help='Capacity of every inter-component queue in messages', default=communication.DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--drop', dest='drop', action='store_true',
+                        help='Drop new messages when a queue is full instead of blocking the producer')
+    parser.add_argument('--pregen', dest='pregen', required=False, type=int,
+                        help='Worker processes prebuilding packets into shared memory, 0 to build in-process', default=0)
+    parser.add_argument('--stats-interval', dest='stats_interval', required=False, type=float,
+                        help='Seconds between queue occupancy reports, 0 to disable', default=10.0)
     args = parser.parse_args()
-    return args.count, args.mac, args.address, args.log
+    return args
 
 async def main() :
-    num_vms, base_mac, base_address, log_level = parse_args()
-    logging.basicConfig(filename='mqnic.log', level=getattr(logging, log_level.upper()), format='%(levelname)s:%(message)s')
+    args = parse_args()
+    num_vms, base_mac, base_address, load, seed = args.count, args.mac, args.address, args.load, args.seed
+    logging.basicConfig(filename='mqnic.log', level=getattr(logging, args.log.upper()), format='%(levelname)s:%(message)s')
     logger = logging.getLogger()
     logger.info(f'Starting testbench with {num_vms} total VMs....')
     base_mac_int = int(base_mac.replace(':', ''), 16)
@@ -50,22 +65,63 @@ async def main() :
     hardware_driver_queues : 'list[tuple[communication.CommunicationQueues, communication.CommunicationQueues]]'= []
     hardware_buffer_queues : 'list[tuple[communication.CommunicationQueues, communication.CommunicationQueues]]'= []
     for i in range(0, num_vms) :
-        hardware_driver_queues.append(communication.create_communication_queue_pair())
-        hardware_buffer_queues.append(communication.create_communication_queue_pair())
+        hardware_driver_queues.append(communication.create_communication_queue_pair(args.queue_size, args.drop,
+            f'{all_addresses[i]}.hardware_driver'))
+        hardware_buffer_queues.append(communication.create_communication_queue_pair(args.queue_size, args.drop,
+            f'{all_addresses[i]}.hardware_buffer'))
         
-    virtual_machines : 'list[virtual_machine.VirtualMachine]'= []
+    # flow templates and the payload pool are shared by all VMs
+    packet_generator = pregen.make_packet_generator(address_mac_dict, seed)
+        
+    # standalone runs have no simulator, pace the arrival processes on the wall clock
+    timer = arrival.WallTimer()
+    vm_loads = arrival.split_load(load, [1] * num_vms)
+        
+    vm_specs : 'list[pregen.VmSpec]' = []
     for i in range(0, num_vms) :
         destination_address = all_addresses.copy()
         destination_address.remove(all_addresses[i])
-        new_vm = virtual_machine.VirtualMachine(all_addresses[i], destination_address,
-            address_mac_dict, hardware_driver_queues[i], hardware_buffer_queues[i])
+        vm_arrival = arrival.PoissonArrival(vm_loads[i], arrival.stream_rng(seed, all_addresses[i], 'arrival'))
+        vm_specs.append(pregen.VmSpec(all_addresses[i], destination_address, address_mac_dict, vm_arrival, seed))
+        
+    # optionally move packet building out of this process
+    pipeline = None
+    if args.pregen > 0 :
+        pipeline = pregen.PregenPipeline(vm_specs, args.pregen)
+        pipeline.start()
+        
+    virtual_machines : 'list[virtual_machine.VirtualMachine]'= []
+    for i, spec in enumerate(vm_specs) :
+        new_vm = virtual_machine.VirtualMachine(spec.my_address, spec.destination_addresses,
+            address_mac_dict, hardware_driver_queues[i], hardware_buffer_queues[i], packet_generator,
+            spec.arrival_process, timer, seed, args.queue_size, args.drop,
+            pipeline.source(i) if pipeline is not None else None)
         virtual_machines.append(new_vm)
+        
+    all_queues : 'list[communication.CommunicationQueue]' = []
+    for i in range(0, num_vms) :
+        all_queues += communication.pair_queues(hardware_driver_queues[i])
+        all_queues += communication.pair_queues(hardware_buffer_queues[i])
+        all_queues += virtual_machines[i].queues
     
     vm_tasks = []
     for i in range(0, num_vms) :
         vm_tasks.append(asyncio.create_task(virtual_machines[i].run_simulation()))
+        
+    monitor_task = None
+    if args.stats_interval > 0 :
+        monitor_task = asyncio.create_task(communication.queue_monitor(all_queues, args.stats_interval, logger))
     
-    await asyncio.gather(*vm_tasks)
+    try :
+        await asyncio.gather(*vm_tasks)
+    finally :
+        if monitor_task is not None :
+            monitor_task.cancel()
+        communication.log_queue_stats(all_queues, logger)
+        if pipeline is not None :
+            stalls, stall_time = pipeline.stall_stats()
+            logger.info(f'Packet pregeneration: {stalls} stalls waiting on workers, {stall_time:.3f} s total')
+            pipeline.close()
     
     
 
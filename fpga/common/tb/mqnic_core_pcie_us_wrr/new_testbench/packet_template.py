@@ -0,0 +1,142 @@
+import array
+import ipaddress
+import itertools
+import random
+import struct
+
+ETH_HEADER_SIZE = 14
+IP_HEADER_SIZE = 20
+UDP_HEADER_SIZE = 8
+HEADER_SIZE = ETH_HEADER_SIZE + IP_HEADER_SIZE + UDP_HEADER_SIZE
+
+# sequence number carried at the start of every UDP payload
+SEQ_SIZE = 8
+
+IP_PROTO_UDP = 17
+
+def ones_complement_fold(value : int) -> int :
+# fold a wide sum of 16-bit words down to 16 bits with end-around carry
+    while value >> 16 :
+        value = (value & 0xffff) + (value >> 16)
+    return value
+
+def word_sum(data : bytes) -> int :
+# plain integer sum of big-endian 16-bit words, odd lengths are zero padded
+    if len(data) & 1 :
+        data = bytes(data) + b'\x00'
+    return sum(struct.unpack(f'>{len(data) // 2}H', data))
+
+def mac_to_bytes(mac : str) -> bytes :
+    return int(str(mac).replace(':', ''), 16).to_bytes(6, 'big')
+
+class PayloadPool :
+# pregenerated random payload bytes handed out as zero-copy memoryview slices, with
+# prefix sums of the 16-bit words so a slice's checksum contribution costs one subtraction
+    def __init__(self, size : int = 1 << 20, seed : int = None) :
+        size &= ~1
+        rng = random.Random(seed)
+        self.data = rng.getrandbits(size * 8).to_bytes(size, 'little')
+        self.view = memoryview(self.data)
+        self.word_prefix = array.array('Q', itertools.accumulate(struct.unpack(f'>{size // 2}H', self.data), initial=0))
+        self.offset = 0
+
+    def __len__(self) -> int :
+        return len(self.data)
+
+    def get(self, length : int) -> 'tuple[memoryview, int]' :
+    # returns the next slice of the pool and the sum of its 16-bit words
+        if length > len(self.data) :
+            raise ValueError(f'payload of {length} bytes exceeds pool size {len(self.data)}')
+        if self.offset + length > len(self.data) :
+            self.offset = 0
+        start = self.offset
+        end = start + length
+        # keep slices word aligned so the prefix sums line up
+        self.offset = (end + 1) & ~1
+        total = self.word_prefix[end // 2] - self.word_prefix[start // 2]
+        if length & 1 :
+            total += self.data[end - 1] << 8
+        return self.view[start:end], total
+
+class FlowTemplate :
+# Ethernet/IP/UDP header built once per flow; per packet only the IP ID, lengths, sequence
+# number and checksums are patched, with the checksums updated incrementally from sums of
+# the fixed header fields
+    def __init__(self, src_mac : str, dst_mac : str, src_address : str, dst_address : str,
+                src_port : int, dst_port : int, ttl : int = 64) :
+        self.src_address = str(src_address)
+        self.dst_address = str(dst_address)
+        self.src_port = src_port
+        self.dst_port = dst_port
+        src_ip = ipaddress.ip_address(self.src_address).packed
+        dst_ip = ipaddress.ip_address(self.dst_address).packed
+
+        self.header = bytearray(HEADER_SIZE)
+        struct.pack_into('>6s6sH', self.header, 0, mac_to_bytes(dst_mac), mac_to_bytes(src_mac), 0x0800)
+        struct.pack_into('>BBHHHBBH4s4s', self.header, ETH_HEADER_SIZE,
+            0x45, 0, 0, 0, 0, ttl, IP_PROTO_UDP, 0, src_ip, dst_ip)
+        struct.pack_into('>HHHH', self.header, ETH_HEADER_SIZE + IP_HEADER_SIZE, src_port, dst_port, 0, 0)
+
+        # checksum sums with the per-packet fields left at zero
+        self.ip_sum = word_sum(self.header[ETH_HEADER_SIZE:ETH_HEADER_SIZE + IP_HEADER_SIZE])
+        self.udp_sum = word_sum(src_ip + dst_ip) + IP_PROTO_UDP + src_port + dst_port
+
+        self.ip_id = 0
+        self.seq = 0
+
+    def build(self, payload : memoryview, payload_sum : int) -> 'tuple[bytearray, bytes, memoryview]' :
+    # returns the packet as (header, sequence number, payload) buffers without copying the payload
+        udp_length = UDP_HEADER_SIZE + SEQ_SIZE + len(payload)
+        ip_length = IP_HEADER_SIZE + udp_length
+        ip_id = self.ip_id
+        self.ip_id = (ip_id + 1) & 0xffff
+
+        seq = struct.pack('>Q', self.seq)
+        seq_sum = (self.seq >> 48) + ((self.seq >> 32) & 0xffff) + ((self.seq >> 16) & 0xffff) + (self.seq & 0xffff)
+        self.seq += 1
+
+        ip_csum = ~ones_complement_fold(self.ip_sum + ip_length + ip_id) & 0xffff
+        # UDP length appears in both the pseudo header and the UDP header
+        udp_csum = ~ones_complement_fold(self.udp_sum + 2 * udp_length + seq_sum + payload_sum) & 0xffff
+        if udp_csum == 0 :
+            udp_csum = 0xffff
+
+        header = self.header[:]
+        struct.pack_into('>HH', header, ETH_HEADER_SIZE + 2, ip_length, ip_id)
+        struct.pack_into('>H', header, ETH_HEADER_SIZE + 10, ip_csum)
+        struct.pack_into('>HH', header, ETH_HEADER_SIZE + IP_HEADER_SIZE + 4, udp_length, udp_csum)
+        return header, seq, payload
+
+_default_payload_pool = None
+
+def get_default_payload_pool() -> PayloadPool :
+# one pool shared by every generator that is not given its own
+    global _default_payload_pool
+    if _default_payload_pool is None :
+        _default_payload_pool = PayloadPool()
+    return _default_payload_pool
+
+class PacketGenerator :
+# caches one FlowTemplate per (src, dst, ports) flow and draws payloads from a shared pool
+    def __init__(self, address_mac_dict : 'dict[str, str]', payload_pool : PayloadPool = None) :
+        self.address_mac_dict = address_mac_dict
+        self.payload_pool = payload_pool if payload_pool is not None else get_default_payload_pool()
+        self.flows : 'dict[tuple[str, str, int, int], FlowTemplate]' = {}
+
+    def get_flow(self, src_address : str, dst_address : str, src_port : int, dst_port : int) -> FlowTemplate :
+        key = (str(src_address), str(dst_address), src_port, dst_port)
+        flow = self.flows.get(key)
+        if flow is None :
+            flow = FlowTemplate(self.address_mac_dict[key[0]], self.address_mac_dict[key[1]], *key)
+            self.flows[key] = flow
+        return flow
+
+    def build_parts(self, src_address : str, dst_address : str, src_port : int, dst_port : int,
+                payload_size : int) -> 'tuple[bytearray, bytes, memoryview]' :
+    # payload_size counts the whole UDP payload, including the sequence number
+        payload, payload_sum = self.payload_pool.get(payload_size - SEQ_SIZE)
+        return self.get_flow(src_address, dst_address, src_port, dst_port).build(payload, payload_sum)
+
+    def build(self, src_address : str, dst_address : str, src_port : int, dst_port : int,
+                payload_size : int) -> bytes :
+        return b''.join(self.build_parts(src_address, dst_address, src_port, dst_port, payload_size))
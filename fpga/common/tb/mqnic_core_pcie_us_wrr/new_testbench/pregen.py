@@ -0,0 +1,365 @@
+import asyncio
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+import arrival
+import packet_template
+
+# producer position, consumer position and a closed flag, each on its own cache line
+RING_HEAD_OFFSET = 0
+RING_TAIL_OFFSET = 64
+RING_CLOSED_OFFSET = 128
+RING_HEADER_SIZE = 192
+RING_POS = struct.Struct('<Q')
+RING_CLOSED = 1
+RING_FAILED = 2
+
+# per record: packet length, destination index, arrival time in ns
+RECORD_HEADER = struct.Struct('<IId')
+RECORD_ALIGN = 8
+RECORD_WRAP = 0xffffffff
+
+DEFAULT_RING_SIZE = 1 << 22
+DEFAULT_BATCH = 64
+
+# wall seconds the simulator sleeps between polls of an empty ring, doubling up to the max
+STALL_BACKOFF_MIN = 1e-5
+STALL_BACKOFF_MAX = 1e-3
+
+def _align(n : int) -> int :
+    return (n + RECORD_ALIGN - 1) & ~(RECORD_ALIGN - 1)
+
+class SharedPacketRing :
+# single-producer single-consumer byte ring in shared memory; records are written first and
+# the head published after, so the consumer only ever sees complete records. head and tail
+# are free-running byte counters, the ring offset is the counter modulo the data size
+    def __init__(self, name : str = None, size : int = DEFAULT_RING_SIZE, create : bool = True) :
+        self.data_size = _align(size)
+        if create :
+            self.shm = shared_memory.SharedMemory(name, create=True, size=RING_HEADER_SIZE + self.data_size)
+            self.shm.buf[:RING_HEADER_SIZE] = bytes(RING_HEADER_SIZE)
+        else :
+            self.shm = shared_memory.SharedMemory(name)
+            self.data_size = self.shm.size - RING_HEADER_SIZE
+        # only the creating process unlinks, forked workers inherit this object as well
+        self.owner = os.getpid() if create else None
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.data = self.buf[RING_HEADER_SIZE:RING_HEADER_SIZE + self.data_size]
+        # largest packet a record can hold, even in an empty ring
+        self.max_packet = self.data_size - RECORD_HEADER.size
+        # local copies, the shared counters are only read when these run out
+        self.head = RING_POS.unpack_from(self.buf, RING_HEAD_OFFSET)[0]
+        self.tail = RING_POS.unpack_from(self.buf, RING_TAIL_OFFSET)[0]
+
+    def __getstate__(self) :
+        return {'name' : self.name, 'size' : self.data_size}
+
+    def __setstate__(self, state) :
+        self.__init__(state['name'], state['size'], create=False)
+
+    def _load_head(self) -> int :
+        return RING_POS.unpack_from(self.buf, RING_HEAD_OFFSET)[0]
+
+    def _load_tail(self) -> int :
+        return RING_POS.unpack_from(self.buf, RING_TAIL_OFFSET)[0]
+
+    def free(self) -> int :
+        return self.data_size - (self.head - self._load_tail())
+
+    def pending(self) -> int :
+        return self._load_head() - self.tail
+
+    def _space_for(self, length : int) -> int :
+    # bytes of ring used by a record, counting the skip to the start when it would wrap
+        size = RECORD_HEADER.size + _align(length)
+        offset = self.head % self.data_size
+        if offset + size > self.data_size :
+            return self.data_size - offset + size
+        return size
+
+    def _wrap(self) :
+    # mark the skip to the start, the consumer skips on its own when not even a header fits
+        offset = self.head % self.data_size
+        if offset + RECORD_HEADER.size <= self.data_size :
+            RECORD_HEADER.pack_into(self.data, offset, RECORD_WRAP, 0, 0)
+        self.head += self.data_size - offset
+
+    def _write(self, packet, dst_index : int, t_ns : float) :
+        offset = self.head % self.data_size
+        size = RECORD_HEADER.size + _align(len(packet))
+        if offset + size > self.data_size :
+            self._wrap()
+            offset = 0
+        RECORD_HEADER.pack_into(self.data, offset, len(packet), dst_index, t_ns)
+        self.data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + len(packet)] = packet
+        self.head += size
+
+    def put_batch(self, records) -> int :
+    # records: (packet, destination index, t_ns); writes as many as fit and publishes the
+    # head once for the batch, returns how many were written
+        tail = self._load_tail()
+        head = self.head
+        written = 0
+        for packet, dst_index, t_ns in records :
+            if len(packet) > self.max_packet :
+                raise ValueError(f'packet of {len(packet)} bytes exceeds ring capacity of {self.max_packet}')
+            if self.head - tail + self._space_for(len(packet)) > self.data_size :
+                # publish the skip to the start on its own when that fits, otherwise a record
+                # larger than the space on either side of the wrap would never fit
+                offset = self.head % self.data_size
+                if (offset + RECORD_HEADER.size + _align(len(packet)) > self.data_size and
+                        self.head - tail + self.data_size - offset <= self.data_size) :
+                    self._wrap()
+                break
+            self._write(packet, dst_index, t_ns)
+            written += 1
+        if self.head != head :
+            RING_POS.pack_into(self.buf, RING_HEAD_OFFSET, self.head)
+        return written
+
+    def get_batch(self, max_records : int = None) -> 'list[tuple[bytes, int, float]]' :
+    # copies ready records out and releases their space with one tail update
+        head = self._load_head()
+        tail = self.tail
+        records = []
+        while self.tail < head and (max_records is None or len(records) < max_records) :
+            offset = self.tail % self.data_size
+            if offset + RECORD_HEADER.size > self.data_size :
+                self.tail += self.data_size - offset
+                continue
+            length, dst_index, t_ns = RECORD_HEADER.unpack_from(self.data, offset)
+            if length == RECORD_WRAP :
+                self.tail += self.data_size - offset
+                continue
+            start = offset + RECORD_HEADER.size
+            records.append((bytes(self.data[start:start + length]), dst_index, t_ns))
+            self.tail += RECORD_HEADER.size + _align(length)
+        if self.tail != tail :
+            RING_POS.pack_into(self.buf, RING_TAIL_OFFSET, self.tail)
+        return records
+
+    def set_closed(self) :
+        self.buf[RING_CLOSED_OFFSET] = RING_CLOSED
+
+    def set_failed(self) :
+        self.buf[RING_CLOSED_OFFSET] = RING_FAILED
+
+    def closed(self) -> bool :
+    # a failed ring counts as closed, no more records will arrive
+        return bool(self.buf[RING_CLOSED_OFFSET])
+
+    def failed(self) -> bool :
+        return self.buf[RING_CLOSED_OFFSET] == RING_FAILED
+
+    def close(self) :
+        if self.shm is None :
+            return
+        self.data.release()
+        self.buf = None
+        self.data = None
+        self.shm.close()
+        if self.owner == os.getpid() :
+            self.shm.unlink()
+        self.shm = None
+
+class VmSpec :
+# everything a worker needs to rebuild one VM's traffic; the arrival process and RNG streams
+# are seeded per VM, so a worker produces the same arrival times, sizes and destinations the
+# VM would draw in-process
+    def __init__(self, my_address : str, destination_addresses : 'list[str]', address_mac_dict : 'dict[str, str]',
+                arrival_process : arrival.ArrivalProcess = None, seed : int = 0, count : int = None) :
+        self.my_address = my_address
+        self.destination_addresses = destination_addresses
+        self.address_mac_dict = address_mac_dict
+        self.arrival_process = arrival_process if arrival_process is not None else arrival.PoissonArrival(1.0,
+            arrival.stream_rng(seed, my_address, 'arrival'))
+        self.seed = seed
+        self.count = count
+
+def make_packet_generator(address_mac_dict : 'dict[str, str]', seed : int = 0) -> packet_template.PacketGenerator :
+# payload bytes come from their own stream of the run seed, so a seeded run is reproducible
+    payload_pool = packet_template.PayloadPool(seed=arrival.stream_rng(seed, 'payload').getrandbits(64))
+    return packet_template.PacketGenerator(address_mac_dict, payload_pool)
+
+def build_packets(spec : VmSpec, packet_generator : packet_template.PacketGenerator) :
+# in-process generation of a VM's stream, yields (t_ns, destination index, packet)
+    rng = arrival.stream_rng(spec.seed, spec.my_address, 'destination')
+    destinations = spec.destination_addresses
+    for k, (t, size) in enumerate(spec.arrival_process) :
+        if spec.count is not None and k >= spec.count :
+            return
+        # same draw as generator.choose_random_destination
+        dst_index = rng.randint(0, len(destinations)-1)
+        yield t, dst_index, packet_generator.build(spec.my_address, destinations[dst_index], 1, 1,
+            size - packet_template.HEADER_SIZE)
+
+class _VmStream :
+    def __init__(self, spec : VmSpec, ring : SharedPacketRing, packet_generator : packet_template.PacketGenerator) :
+        self.spec = spec
+        self.ring = ring
+        self.packets = build_packets(spec, packet_generator)
+        self.finished = False
+        self.produced = 0
+        # records built but not yet accepted by a full ring
+        self.pending = []
+
+    def done(self) -> bool :
+        return self.finished and not self.pending
+
+    def fill(self, batch : int) -> int :
+        if not self.pending and not self.finished :
+            for k in range(batch) :
+                record = next(self.packets, None)
+                if record is None :
+                    self.finished = True
+                    break
+                t, dst_index, packet = record
+                self.pending.append((packet, dst_index, t))
+        written = self.ring.put_batch(self.pending)
+        del self.pending[:written]
+        self.produced += written
+        return written
+
+def _worker(specs : 'list[VmSpec]', rings : 'list[SharedPacketRing]', stop, batch : int) :
+# fills the rings of its VMs round robin, backing off briefly when every ring is full; on an
+# error its open rings are marked failed so the simulator raises instead of waiting forever
+    packet_generator = make_packet_generator(specs[0].address_mac_dict, specs[0].seed) if specs else None
+    streams = [_VmStream(spec, ring, packet_generator) for spec, ring in zip(specs, rings)]
+    try :
+        while not stop.is_set() and streams :
+            progress = 0
+            for stream in streams :
+                progress += stream.fill(batch)
+            for stream in [s for s in streams if s.done()] :
+                stream.ring.set_closed()
+                streams.remove(stream)
+            if not progress :
+                time.sleep(0.0005)
+    except Exception :
+        for stream in streams :
+            stream.ring.set_failed()
+        raise
+    finally :
+        for ring in rings :
+            ring.close()
+
+class PregenSource :
+# sim-side view of one VM's ring: async iteration yields (t_ns, destination address, packet)
+# and waits for the workers without blocking the event loop; plain iteration is for
+# consumers running outside an event loop, e.g. pregen_bench
+    def __init__(self, spec : VmSpec, ring : SharedPacketRing, batch : int = DEFAULT_BATCH) :
+        self.spec = spec
+        self.ring = ring
+        self.batch = batch
+        self.buffer = []
+        self.index = 0
+        # times the simulator had to wait on the workers, and how long in wall seconds
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def _poll(self) -> 'list[tuple[float, str, bytes]]' :
+    # the next batch, an empty list once the ring is closed and drained, None while the
+    # workers have nothing ready
+        records = self.ring.get_batch(self.batch)
+        if not records :
+            if not self.ring.closed() :
+                return None
+            # closed is set after the final head update, so one last look is enough
+            records = self.ring.get_batch(self.batch)
+            if not records and self.ring.failed() :
+                raise RuntimeError(f'pregen worker for {self.spec.my_address} failed, see its traceback')
+        destinations = self.spec.destination_addresses
+        return [(t_ns, destinations[dst_index], packet) for packet, dst_index, t_ns in records]
+
+    async def next_batch(self) -> 'list[tuple[float, str, bytes]]' :
+        batch = self._poll()
+        if batch is None :
+            self.stalls += 1
+            start = time.perf_counter()
+            delay = STALL_BACKOFF_MIN
+            while batch is None :
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, STALL_BACKOFF_MAX)
+                batch = self._poll()
+            self.stall_time += time.perf_counter() - start
+        return batch
+
+    def __aiter__(self) :
+        return self
+
+    async def __anext__(self) -> 'tuple[float, str, bytes]' :
+        if self.index >= len(self.buffer) :
+            self.buffer = await self.next_batch()
+            self.index = 0
+            if not self.buffer :
+                raise StopAsyncIteration
+        self.index += 1
+        return self.buffer[self.index - 1]
+
+    def __iter__(self) :
+        return self
+
+    def __next__(self) -> 'tuple[float, str, bytes]' :
+        if self.index >= len(self.buffer) :
+            batch = self._poll()
+            if batch is None :
+                self.stalls += 1
+                start = time.perf_counter()
+                delay = STALL_BACKOFF_MIN
+                while batch is None :
+                    time.sleep(delay)
+                    delay = min(delay * 2, STALL_BACKOFF_MAX)
+                    batch = self._poll()
+                self.stall_time += time.perf_counter() - start
+            self.buffer = batch
+            self.index = 0
+            if not self.buffer :
+                raise StopIteration
+        self.index += 1
+        return self.buffer[self.index - 1]
+
+class PregenPipeline :
+# worker processes build each VM's packets ahead of the simulation into one shared-memory
+# ring per VM, so the simulator thread only copies finished bytes out
+    def __init__(self, specs : 'list[VmSpec]', processes : int = None, ring_size : int = DEFAULT_RING_SIZE,
+                batch : int = DEFAULT_BATCH) :
+        self.specs = specs
+        self.processes = min(processes or os.cpu_count() or 1, len(specs))
+        self.batch = batch
+        self.rings = [SharedPacketRing(size=ring_size) for spec in specs]
+        self.stop_event = multiprocessing.Event()
+        self.workers = []
+        self.sources = [PregenSource(spec, ring, batch) for spec, ring in zip(specs, self.rings)]
+
+    def __enter__(self) :
+        self.start()
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
+
+    def start(self) :
+        for k in range(self.processes) :
+            # VMs are dealt out round robin so each worker gets an even share
+            worker = multiprocessing.Process(target=_worker, daemon=True,
+                args=(self.specs[k::self.processes], self.rings[k::self.processes], self.stop_event, self.batch))
+            worker.start()
+            self.workers.append(worker)
+
+    def source(self, index : int) -> PregenSource :
+        return self.sources[index]
+
+    def stall_stats(self) -> 'tuple[int, float]' :
+        return sum(s.stalls for s in self.sources), sum(s.stall_time for s in self.sources)
+
+    def close(self) :
+        self.stop_event.set()
+        for worker in self.workers :
+            worker.join()
+        self.workers = []
+        for ring in self.rings :
+            ring.close()
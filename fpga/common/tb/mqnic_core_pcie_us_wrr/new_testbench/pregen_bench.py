@@ -0,0 +1,82 @@
+import argparse
+import heapq
+import ipaddress
+import time
+
+import arrival
+import pregen
+
+
+def parse_args() -> argparse.Namespace :
+# parse input arguments to the benchmark
+    parser = argparse.ArgumentParser(
+        prog = 'PregenBenchmark',
+        description='Compares simulated ns per wall-clock second with in-process and offloaded packet generation.'
+    )
+    parser.add_argument('--vms', dest='vms', type=int, help='Number of VMs', default=16)
+    parser.add_argument('--load', dest='load', type=float, help='Total offered load in Gbps', default=100.0)
+    parser.add_argument('--duration', dest='duration', type=float, help='Simulated time per run in us', default=2000.0)
+    parser.add_argument('--sim-cost', dest='sim_cost', type=float,
+                        help='Wall ns the simulator spends per simulated ns driving the DUT, 0 to time generation alone', default=0.0)
+    parser.add_argument('--processes', dest='processes', type=int, help='Worker processes for the offloaded run', default=None)
+    parser.add_argument('--seed', dest='seed', type=int, help='Seed for the arrival and destination streams', default=0)
+    return parser.parse_args()
+
+def make_specs(num_vms : int, load : float, seed : int) -> 'list[pregen.VmSpec]' :
+    addresses = [str(ipaddress.ip_address('10.0.0.1') + i) for i in range(num_vms)]
+    address_mac_dict = {a : '02:00:00:00:%02x:%02x' % (i >> 8, i & 0xff) for i, a in enumerate(addresses)}
+    loads = arrival.split_load(load, [1] * num_vms)
+    specs = []
+    for i, address in enumerate(addresses) :
+        destinations = [a for a in addresses if a != address]
+        specs.append(pregen.VmSpec(address, destinations, address_mac_dict,
+            arrival.PoissonArrival(loads[i], arrival.stream_rng(seed, address, 'arrival')), seed))
+    return specs
+
+def spin(seconds : float) :
+# stands in for the simulator advancing the DUT, busy like a real simulator would be
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end :
+        pass
+
+def run(streams, duration_ns : float, sim_cost : float) -> 'tuple[float, int, int]' :
+# consumes the merged per-VM streams in arrival order up to duration_ns of simulated time
+    packets = 0
+    total_bytes = 0
+    now = 0.0
+    start = time.perf_counter()
+    for t, dst, packet in heapq.merge(*streams, key=lambda r : r[0]) :
+        if t >= duration_ns :
+            break
+        if sim_cost :
+            spin((t - now) * sim_cost * 1e-9)
+        now = t
+        packets += 1
+        total_bytes += len(packet)
+    return time.perf_counter() - start, packets, total_bytes
+
+def main() :
+    args = parse_args()
+    duration_ns = args.duration * 1000
+    vm_count = max(args.vms, 2)
+
+    specs = make_specs(vm_count, args.load, args.seed)
+    packet_generator = pregen.make_packet_generator(specs[0].address_mac_dict, args.seed)
+    wall, packets, total_bytes = run([pregen.build_packets(spec, packet_generator) for spec in specs], duration_ns, args.sim_cost)
+    in_process = duration_ns / wall
+    print(f'in-process: {packets} packets, {total_bytes} bytes in {wall:.3f} s, {in_process:.0f} simulated ns per wall second')
+
+    specs = make_specs(vm_count, args.load, args.seed)
+    with pregen.PregenPipeline(specs, args.processes) as pipeline :
+        # let the workers get ahead, as they would while the simulator boots the DUT
+        time.sleep(0.5)
+        wall, packets, total_bytes = run(pipeline.sources, duration_ns, args.sim_cost)
+        stalls, stall_time = pipeline.stall_stats()
+        processes = pipeline.processes
+    offloaded = duration_ns / wall
+    print(f'offloaded ({processes} workers): {packets} packets, {total_bytes} bytes in {wall:.3f} s, '
+        f'{offloaded:.0f} simulated ns per wall second, {stalls} stalls ({stall_time:.3f} s)')
+    print(f'speedup: {offloaded / in_process:.2f}x')
+
+if __name__ == "__main__" :
+    main()
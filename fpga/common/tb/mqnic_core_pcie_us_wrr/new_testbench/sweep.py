@@ -0,0 +1,158 @@
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+tb_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+tb_file = os.path.join(tb_dir, 'test_mqnic_core_pcie_us.py')
+
+# pytest parameter set of test_mqnic_core_pcie_us used for every run unless overridden
+DEFAULT_CONFIG = '1-1-256-64-64-1'
+
+# scenario fields that may be given as a list of alternatives in the matrix
+SCENARIO_FIELDS = ['vms', 'weights', 'sizes', 'load_gbps', 'duration_us', 'process', 'seed']
+
+def parse_args() -> argparse.Namespace :
+# parse input arguments to the sweep runner
+    parser = argparse.ArgumentParser(
+        prog = 'SRIOVSweep',
+        description='Runs a matrix of SR-IOV traffic scenarios in parallel simulator processes and merges the results.',
+        epilog='See the README for more details'
+    )
+    parser.add_argument('matrix', type=str, help='JSON file describing the scenarios')
+    parser.add_argument('--out', dest='out', type=str, help='Output directory', default='sweep')
+    parser.add_argument('--jobs', dest='jobs', type=int, help='Concurrent simulator processes', default=os.cpu_count())
+    parser.add_argument('--config', dest='config', type=str, help='pytest parameter set of the testbench', default=DEFAULT_CONFIG)
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Only list the expanded scenarios')
+    return parser.parse_args()
+
+def expand_scenarios(spec : dict) -> 'list[dict]' :
+# "matrix" maps each field to a list of alternatives and expands to their cross product,
+# "scenarios" lists extra scenarios as is; both are layered over "defaults"
+    defaults = spec.get('defaults', {})
+    scenarios = []
+
+    matrix = spec.get('matrix', {})
+    if matrix :
+        for key in matrix :
+            if key not in SCENARIO_FIELDS :
+                raise ValueError(f'unknown scenario field {key!r}')
+        keys = list(matrix)
+        for values in itertools.product(*(matrix[k] for k in keys)) :
+            scenarios.append({**defaults, **dict(zip(keys, values))})
+
+    for scenario in spec.get('scenarios', []) :
+        scenarios.append({**defaults, **scenario})
+
+    for k, scenario in enumerate(scenarios) :
+        scenario.setdefault('name', f'{k:04d}')
+    return scenarios
+
+def run_scenario(scenario : dict, out_dir : str, config : str) -> dict :
+# one simulator process with its own sim_build, returns the run's JSON results
+    run_dir = os.path.join(out_dir, scenario['name'])
+    os.makedirs(run_dir, exist_ok=True)
+    results_file = os.path.join(run_dir, 'results.json')
+
+    env = dict(os.environ)
+    env['SCENARIO'] = json.dumps(scenario)
+    env['SCENARIO_RESULTS'] = results_file
+    env['SIM_BUILD'] = os.path.join(run_dir, 'sim_build')
+    env['TESTCASE'] = 'run_test_scenario'
+
+    cmd = [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider',
+        f'{tb_file}::test_mqnic_core_pcie_us[{config}]']
+
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, 'run.log'), 'w') as log :
+        ret = subprocess.run(cmd, cwd=tb_dir, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    wall = time.perf_counter() - start
+
+    if ret == 0 and os.path.exists(results_file) :
+        with open(results_file) as f :
+            results = json.load(f)
+    else :
+        results = {'scenario' : scenario, 'error' : f'exit status {ret}, see {os.path.join(run_dir, "run.log")}'}
+    results['name'] = scenario['name']
+    results['run_time_s'] = wall
+    return results
+
+TABLE_COLUMNS = ['name', 'vms', 'weights', 'sizes', 'load_gbps', 'offered_gbps', 'throughput_gbps',
+    'min_gbps', 'max_gbps', 'jain', 'weighted_jain', 'lost', 'run_time_s', 'error']
+
+def table_row(results : dict) -> dict :
+    scenario = results['scenario']
+    funcs = results.get('funcs', [])
+    throughput = [f['throughput_gbps'] for f in funcs]
+    return {
+        'name' : results['name'],
+        'vms' : scenario.get('vms'),
+        'weights' : json.dumps(scenario.get('weights')),
+        'sizes' : json.dumps(scenario.get('sizes')),
+        'load_gbps' : scenario.get('load_gbps'),
+        'offered_gbps' : results.get('offered_gbps'),
+        'throughput_gbps' : results.get('throughput_gbps'),
+        'min_gbps' : min(throughput) if throughput else None,
+        'max_gbps' : max(throughput) if throughput else None,
+        'jain' : results.get('jain'),
+        'weighted_jain' : results.get('weighted_jain'),
+        'lost' : sum(f['lost'] for f in funcs) if funcs else None,
+        'run_time_s' : results.get('run_time_s'),
+        'error' : results.get('error', ''),
+    }
+
+def format_value(value) -> str :
+    if isinstance(value, float) :
+        return f'{value:.3f}'
+    return '' if value is None else str(value)
+
+def print_table(rows : 'list[dict]') :
+    cells = [[format_value(row[c]) for c in TABLE_COLUMNS] for row in rows]
+    widths = [max([len(c)] + [len(r[i]) for r in cells]) for i, c in enumerate(TABLE_COLUMNS)]
+    print('  '.join(c.ljust(w) for c, w in zip(TABLE_COLUMNS, widths)))
+    for r in cells :
+        print('  '.join(v.ljust(w) for v, w in zip(r, widths)))
+
+def main() :
+    args = parse_args()
+    with open(args.matrix) as f :
+        scenarios = expand_scenarios(json.load(f))
+
+    if args.dry_run :
+        for scenario in scenarios :
+            print(json.dumps(scenario))
+        return
+
+    out_dir = os.path.abspath(args.out)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f'Running {len(scenarios)} scenarios with {args.jobs} concurrent simulators....')
+
+    # the simulators are separate processes, threads only wait on them
+    all_results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor :
+        futures = [executor.submit(run_scenario, s, out_dir, args.config) for s in scenarios]
+        for future in concurrent.futures.as_completed(futures) :
+            results = future.result()
+            status = results.get('error') or f'{results["throughput_gbps"]:.3f} Gbps'
+            print(f'{results["name"]}: {status} ({results["run_time_s"]:.1f} s)')
+            all_results.append(results)
+
+    all_results.sort(key=lambda r : r['name'])
+    rows = [table_row(r) for r in all_results]
+
+    with open(os.path.join(out_dir, 'results.json'), 'w') as f :
+        json.dump(all_results, f, indent=2)
+    with open(os.path.join(out_dir, 'results.csv'), 'w', newline='') as f :
+        w = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+        w.writeheader()
+        w.writerows(rows)
+
+    print_table(rows)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+import pregen
+
+
+def make_ring(size : int) :
+    ring = pregen.SharedPacketRing(size=size)
+    # a second view of the same memory, as a worker process would have
+    peer = pregen.SharedPacketRing(ring.name, create=False)
+    return ring, peer
+
+@pytest.fixture
+def rings() :
+    created = []
+    def factory(size : int = 256) :
+        pair = make_ring(size)
+        created.extend(pair)
+        return pair
+    yield factory
+    for ring in reversed(created) :
+        ring.close()
+
+def make_source(ring : pregen.SharedPacketRing, batch : int = 4) -> pregen.PregenSource :
+    spec = pregen.VmSpec('10.0.0.1', ['10.0.0.2', '10.0.0.3'], {})
+    return pregen.PregenSource(spec, ring, batch)
+
+def test_ring_wraparound(rings) :
+    producer, consumer = rings(256)
+    # odd lengths leave the head at varying offsets, so records both wrap with a marker and
+    # with too little room left for a header
+    sent = []
+    received = []
+    for k in range(200) :
+        packet = bytes([k & 0xff]) * (17 + k % 23)
+        assert producer.put_batch([(packet, k % 3, float(k))]) == 1
+        sent.append((packet, k % 3, float(k)))
+        if k % 2 :
+            received += consumer.get_batch()
+    received += consumer.get_batch()
+    assert received == sent
+    assert producer.head > 4 * producer.data_size
+    assert consumer.pending() == 0
+    assert producer.free() == producer.data_size
+
+def test_ring_partial_batch(rings) :
+    producer, consumer = rings(256)
+    records = [(bytes([k]) * 40, k, float(k)) for k in range(10)]
+    # 16 byte header plus 40 bytes of packet, only four fit
+    written = producer.put_batch(records)
+    assert written == 4
+    assert producer.put_batch(records[written:]) == 0
+
+    assert consumer.get_batch(3) == records[:3]
+    # three records freed, the first new one skips the 32 bytes left at the end
+    assert producer.put_batch(records[written:]) == 3
+    assert producer.free() == 0
+    assert consumer.get_batch() == records[3:7]
+    assert consumer.get_batch() == []
+
+def test_ring_closed(rings) :
+    producer, consumer = rings(256)
+    records = [(bytes([k]) * 8, k % 2, float(k)) for k in range(6)]
+    assert producer.put_batch(records) == 6
+    producer.set_closed()
+    assert consumer.closed()
+
+    # records published before the close are still delivered, then iteration stops
+    source = make_source(consumer)
+    assert list(source) == [(t, ['10.0.0.2', '10.0.0.3'][dst], packet) for packet, dst, t in records]
+    assert source.stalls == 0
+
+def test_source_async_closed(rings) :
+    producer, consumer = rings(256)
+    records = [(bytes([k]) * 8, k % 2, float(k)) for k in range(6)]
+    source = make_source(consumer)
+
+    async def consume() :
+        return [record async for record in source]
+
+    async def produce() :
+        # the consumer starts on an empty ring and has to wait for the producer
+        await asyncio.sleep(0.01)
+        producer.put_batch(records)
+        producer.set_closed()
+
+    async def run() :
+        received, _ = await asyncio.gather(consume(), produce())
+        return received
+
+    received = asyncio.run(run())
+    assert [packet for t, dst, packet in received] == [packet for packet, dst, t in records]
+    assert source.stalls == 1
+
+def test_ring_oversize(rings) :
+    producer, consumer = rings(256)
+    assert producer.max_packet == 240
+    with pytest.raises(ValueError) :
+        producer.put_batch([(bytes(241), 0, 0.0)])
+
+    # a record that fits on neither side of the wrap point goes in once the consumer catches up
+    assert producer.put_batch([(bytes(96), 0, 0.0)]) == 1
+    assert consumer.get_batch() == [(bytes(96), 0, 0.0)]
+    assert producer.put_batch([(bytes(200), 1, 1.0)]) == 0
+    assert consumer.get_batch() == []
+    assert producer.put_batch([(bytes(200), 1, 1.0)]) == 1
+    assert consumer.get_batch() == [(bytes(200), 1, 1.0)]
+
+def test_source_failed(rings) :
+    producer, consumer = rings(256)
+    records = [(bytes([k]) * 8, 0, float(k)) for k in range(3)]
+    producer.put_batch(records)
+    producer.set_failed()
+
+    # what the worker published is delivered before the failure is raised
+    source = make_source(consumer)
+    assert [next(source) for k in range(3)] == [(t, '10.0.0.2', packet) for packet, dst, t in records]
+    with pytest.raises(RuntimeError) :
+        next(source)
@@ -2,6 +2,9 @@ import driver
 import generator
 import ring_buffer
 import communication
+import packet_template
+import arrival
+import pregen
 import asyncio
 
 class VirtualMachine() :
@@ -11,17 +14,26 @@ class VirtualMachine() :
     
     def __init__(self, my_address : str, destination_addresses : 'list[str]',
                 address_mac_dict : 'dict[str, str]', hardware_driver_queue : communication.CommunicationQueues,
-                hardware_buffer_queue : communication.CommunicationQueues) :
+                hardware_buffer_queue : communication.CommunicationQueues,
+                packet_generator : packet_template.PacketGenerator = None,
+                arrival_process : arrival.ArrivalProcess = None, timer = None, seed : int = 0,
+                queue_size : int = communication.DEFAULT_QUEUE_SIZE, drop_when_full : bool = False,
+                pregen_source : pregen.PregenSource = None) :
         
         # initialize Generator-Driver Queues
-        generator_driver_queue_pair = communication.create_communication_queue_pair()
+        generator_driver_queue_pair = communication.create_communication_queue_pair(queue_size, drop_when_full,
+            f'{my_address}.generator_driver')
             
         # initialize RingBuffer-Driver Queues
-        buffer_driver_queue_pair = communication.create_communication_queue_pair()
+        buffer_driver_queue_pair = communication.create_communication_queue_pair(queue_size, drop_when_full,
+            f'{my_address}.buffer_driver')
+        
+        self.queues = communication.pair_queues(generator_driver_queue_pair) + communication.pair_queues(buffer_driver_queue_pair)
             
         # initialize Generator Data Structure
         self.generator_details = generator.GeneratorDetails(my_address, destination_addresses,
-            address_mac_dict, generator_driver_queue_pair[0])
+            address_mac_dict, generator_driver_queue_pair[0], packet_generator, arrival_process, timer, seed,
+            pregen_source)
         
         self.driver_details = None
         self.buffer_details = None
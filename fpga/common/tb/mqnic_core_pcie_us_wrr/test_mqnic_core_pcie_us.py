@@ -1,10 +1,13 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2021-2023 The Regents of the University of California
 
+import itertools
+import json
 import logging
 import os
 import struct
 import sys
+import time
 
 import scapy.utils
 from scapy.layers.l2 import Ether
@@ -16,7 +19,8 @@ import pytest
 import cocotb
 from cocotb.log import SimLog
 from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, FallingEdge, Timer
+from cocotb.triggers import RisingEdge, FallingEdge, Timer, with_timeout
+from cocotb.utils import get_sim_time, get_time_from_sim_steps
 
 from cocotbext.axi import AxiStreamBus
 from cocotbext.axi import AxiSlave, AxiBus, SparseMemoryRegion
@@ -26,148 +30,156 @@ from cocotbext.pcie.xilinx.us import UltraScalePlusPcieDevice
 
 try:
     import mqnic
+    import mqnic_fabric
+    import mqnic_monitor
+    import mqnic_pcap
+    import mqnic_scoreboard
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_fabric
+        import mqnic_monitor
+        import mqnic_pcap
+        import mqnic_scoreboard
     finally:
         del sys.path[0]
 
+from mqnic_monitor import Rise, field_slice
 
-class TB(object):
-
-    async def monitor_rx_engine_desc_table_dequeue(self, rx_engine_inst) :
-        while True :
-            await RisingEdge(rx_engine_inst.desc_table_dequeue_en)
-            self.log.info(f"RX Engine Information... Dequeue Update of Descriptor Table[{rx_engine_inst.desc_table_store_queue_ptr.value.integer}] - Function ID: {rx_engine_inst.desc_table_dequeue_function_id.value.integer}; RX Completion Queue: {rx_engine_inst.desc_table_dequeue_cpl_queue.value.integer}")
-
-    async def monitor_rx_engine_desc_table_store(self, rx_engine_inst) :
-        while True :
-            await RisingEdge(rx_engine_inst.desc_table_store_queue_en)
-            self.log.info(f"RX Engine Information... Store Queue Update of Descriptor Table[{rx_engine_inst.desc_table_store_queue_ptr.value.integer}] - RX Queue: {rx_engine_inst.desc_table_store_queue.value.integer}")
-
-
-    async def monitor_rx_engine_desc_request(self, rx_engine_inst) :
-        while True :
-            await RisingEdge(rx_engine_inst.m_axis_desc_req_valid)
-            self.log.info(f"RX Engine Information...  Descriptor Request to Desc Fetch - m_axis_desc_req_queue: {rx_engine_inst.m_axis_desc_req_queue.value.integer} m_axis_desc_req_tag: {rx_engine_inst.m_axis_desc_req_tag.value.integer}")
-            await RisingEdge(rx_engine_inst.s_axis_desc_req_status_valid)
-            self.log.info(f"RX Engine Information... Descriptor Request Status from Desc Fetch - s_axis_desc_req_status_queue: {rx_engine_inst.s_axis_desc_req_status_queue.value.integer} s_axis_desc_req_status_ptr: {rx_engine_inst.s_axis_desc_req_status_ptr} s_axis_desc_req_status_cpl: {rx_engine_inst.s_axis_desc_req_status_cpl.value.integer} s_axis_desc_req_status_tag: {rx_engine_inst.s_axis_desc_req_status_tag.value.integer} s_axis_desc_req_status_function_id: {rx_engine_inst.s_axis_desc_req_status_function_id.value.integer} s_axis_desc_req_status_error: {rx_engine_inst.s_axis_desc_req_status_error} s_axis_desc_req_status_empty: {rx_engine_inst.s_axis_desc_req_status_empty}")
-
-    async def monitor_desc_fetch_dma_status(self, desc_fetch_inst) :
-        while True :
-            await RisingEdge(desc_fetch_inst.m_axis_req_status_valid)
-            self.log.info(f"Desc Fetch Information... DMA Status to TX/RX Engine- Queue: {desc_fetch_inst.m_axis_req_status_queue.value.integer} Func ID: {desc_fetch_inst.m_axis_req_status_function_id.value.integer}; Error: {desc_fetch_inst.m_axis_req_status_error}; Empty: {desc_fetch_inst.m_axis_req_status_empty}; CPL Queue: {desc_fetch_inst.m_axis_req_status_cpl.value.integer}")
-
-    async def monitor_desc_fetch_rx_dma_request_to_queue_manager(self, mqnic_interface_inst) :
-        while True :
-            await RisingEdge(mqnic_interface_inst.rx_desc_dequeue_req_valid)
-            self.log.info(f"Desc Fetch Information... RX DMA Request to Queue Manager - Queue: {mqnic_interface_inst.rx_desc_dequeue_req_queue.value.integer}; Tag: {mqnic_interface_inst.rx_desc_dequeue_req_tag.value.integer}")
-
-    async def monitor_desc_fetch_tx_dma_request_to_queue_manager(self, mqnic_interface_inst) :
-        while True :
-            await RisingEdge(mqnic_interface_inst.tx_desc_dequeue_req_valid)
-            self.log.info(f"Desc Fetch Information... TX DMA Request to Queue Manager - Queue: {mqnic_interface_inst.tx_desc_dequeue_req_queue.value.integer}; Tag: {mqnic_interface_inst.tx_desc_dequeue_req_tag.value.integer}")
-
-
-    async def monitor_desc_fetch_dma_request_to_queue_manager_response(self, desc_fetch_inst) :
-        while True :
-            await RisingEdge(desc_fetch_inst.s_axis_desc_dequeue_resp_valid)
-            self.log.info(f"Desc Fetch Information... DMA Request Response from Queue Manager - Queue: {desc_fetch_inst.s_axis_desc_dequeue_resp_queue.value.integer}; Tag: {desc_fetch_inst.s_axis_desc_dequeue_resp_tag.value.integer}; Function ID {desc_fetch_inst.s_axis_desc_dequeue_resp_function_id.value.integer}; Empty: {desc_fetch_inst.s_axis_desc_dequeue_resp_empty}; Error: {desc_fetch_inst.s_axis_desc_dequeue_resp_error}")
-
-    async def monitor_desc_fetch_dma_read(self, desc_fetch_inst) :
-        while True :
-            await RisingEdge(desc_fetch_inst.m_axis_dma_read_desc_valid)
-            self.log.info(f"Desc Fetch Information... Control to DMA Engine - Addr: {desc_fetch_inst.m_axis_dma_read_desc_dma_addr} Func ID: {desc_fetch_inst.m_axis_dma_read_desc_function_id.value.integer}")
-
-
-    
-    async def monitor_queue_dequeue_request_input(self, queue_manager, type) :
-        while True :
-            await RisingEdge(queue_manager.s_axis_dequeue_req_valid)
-            self.log.info(f"{type} Queue Manager Information for Dequeue Request Input - Queue: {queue_manager.s_axis_dequeue_req_queue.value.integer}; Tag: {queue_manager.s_axis_dequeue_req_tag}")
-
-    async def monitor_queue_dequeue_request_output(self, queue_manager, type) :
-        while True :
-            await RisingEdge(queue_manager.m_axis_dequeue_resp_valid)
-            self.log.info(f"{type} Queue Manager Information for Dequeue Request Output - Queue: {queue_manager.m_axis_dequeue_resp_queue.value.integer}; Tag: {queue_manager.m_axis_dequeue_resp_op_tag}; Function ID: {queue_manager.m_axis_dequeue_resp_function_id}; Empty: {queue_manager.m_axis_dequeue_resp_empty}; Error: {queue_manager.m_axis_dequeue_resp_error}")
-
-    async def monitor_pcie_msix_irq_request_in(self, msix) :
-        while True :
-            await RisingEdge(msix.irq_valid)
-            self.log.info(f"PCIe MSIx IRQ Information... IRQ Request Input - IRQ {msix.irq_index};")
-
-    async def monitor_pcie_msix_irq_axil_write_in(self, msix) :
-        self.log.info(f"Scott this did run...")
-        while True: 
-            await RisingEdge(msix.s_axil_awvalid)
-            self.log.info(f"PCIe MSIx IRQ information... AXIL Write Input - Addr {msix.s_axil_awaddr}; User: {msix.s_axil_awuser}")
-
-    async def monitor_pcie_msix_irq_axil_read_in(self, msix) :
-        while True: 
-            await RisingEdge(msix.s_axil_arvalid)
-            self.log.info(f"PCIe MSIx IRQ information... AXIL Read Input - Addr {msix.s_axil_araddr}; User: {msix.s_axil_aruser}")
-
-    async def monitor_pcie_msix_irq_request_out(self, msix) :
-        while True :
-            await RisingEdge(msix.tx_wr_req_tlp_valid)
-            self.log.info(f"PCIe MSIx IRQ Information... IRQ Request Output - TLP HDR: {msix.tx_wr_req_tlp_hdr.value.binstr}; Data: {msix.tx_wr_req_tlp_data}")
-
-    async def monitor_pcie_msix_irq_request_out_ready(self, msix) :
-        while True: 
-            await RisingEdge(msix.tx_wr_req_tlp_ready)
-            self.log.info(f"Scott temp: CLOG_NUM_ENTRIES_PER_FUNC: {msix.CLOG_NUM_ENTRIES_PER_FUNC}; NUM_TABLE_ENTRIES: {msix.NUM_TABLE_ENTRIES}; NUM_ENTRIES_PER_FUNC: {msix.NUM_ENTRIES_PER_FUNC}")
-            self.log.info(f"PCIe MSIx IRQ Information... IRQ Request Output marked as ready: {msix.tx_wr_req_tlp_ready.value.integer}")
-
-    async def monitor_pcie_if_inst_irq_in(self, pcie_us_if) :
-        while True :
-            await RisingEdge(pcie_us_if.tx_msix_wr_req_tlp_valid)
-            self.log.info(f"PCIe US_IF Information... IRQ request in - HDR: {pcie_us_if.tx_msix_wr_req_tlp_hdr.value.binstr}; TLP Data: {pcie_us_if.tx_msix_wr_req_tlp_data.value.binstr}; Ready: {pcie_us_if.tx_msix_wr_req_tlp_ready}")
-            if pcie_us_if.tx_msix_wr_req_tlp_ready.value.integer == 0 :
-                await RisingEdge(pcie_us_if.tx_msix_wr_req_tlp_ready)
-                self.log.info("Scott: it went ready later...")
-
-    async def monitor_pcie_if_inst_irq_out(self, pcie_us_if) :
-        while True :
-            await RisingEdge(pcie_us_if.cfg_interrupt_msix_int)
-            self.log.info(f"PCIe US_IF Information... IRQ request out - Address: {pcie_us_if.cfg_interrupt_msix_address.value.binstr}; Data: {pcie_us_if.cfg_interrupt_msix_data.value.binstr}; Function Number: {pcie_us_if.cfg_interrupt_msi_function_number_msix.value.integer}")
+# entries between the MSI-X table and PBA offsets of the PF
+MSIX_MAX_TABLE_SIZE = 2048
 
 
-    def __init__(self, dut, msix_count=32):
-        self.dut = dut
+def msix_count_for(dut, funcs):
+    # vectors are {function, irq index}, so covering funcs functions takes funcs full strides
+    return min(funcs << len(dut.core_pcie_inst.irq_index), MSIX_MAX_TABLE_SIZE)
 
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
 
-        for iface in self.dut.core_pcie_inst.core_inst.iface:
-            cocotb.start_soon(self.monitor_rx_engine_desc_table_dequeue(iface.interface_inst.interface_rx_inst.rx_engine_inst))
-            cocotb.start_soon(self.monitor_rx_engine_desc_table_store(iface.interface_inst.interface_rx_inst.rx_engine_inst))
+class TB(object):
 
-            cocotb.start_soon(self.monitor_rx_engine_desc_request(iface.interface_inst.interface_rx_inst.rx_engine_inst))
+    def add_monitors(self):
+        # declarative monitors of the interface and PCIe internals, each trace component only
+        # gets monitors for its enabled events and all of them share one coroutine on dut.clk
+        clk = self.dut.clk
+
+        for k, iface in enumerate(self.dut.core_pcie_inst.core_inst.iface):
+            rx_engine_inst = iface.interface_inst.interface_rx_inst.rx_engine_inst
+            self.monitors.add_trace(self.trace, "iface%d.rx_engine" % k, clk, [
+                ('desc_table_dequeue', Rise(rx_engine_inst.desc_table_dequeue_en), [
+                    ('ptr', rx_engine_inst.desc_table_dequeue_ptr),
+                    ('func', rx_engine_inst.desc_table_dequeue_function_id),
+                    ('cpl_queue', rx_engine_inst.desc_table_dequeue_cpl_queue)]),
+                ('desc_table_store', Rise(rx_engine_inst.desc_table_store_queue_en), [
+                    ('ptr', rx_engine_inst.desc_table_store_queue_ptr),
+                    ('queue', rx_engine_inst.desc_table_store_queue)]),
+                ('desc_req', Rise(rx_engine_inst.m_axis_desc_req_valid), [
+                    ('queue', rx_engine_inst.m_axis_desc_req_queue),
+                    ('tag', rx_engine_inst.m_axis_desc_req_tag)]),
+                ('desc_req_status', Rise(rx_engine_inst.s_axis_desc_req_status_valid), [
+                    ('queue', rx_engine_inst.s_axis_desc_req_status_queue),
+                    ('ptr', rx_engine_inst.s_axis_desc_req_status_ptr),
+                    ('cpl', rx_engine_inst.s_axis_desc_req_status_cpl),
+                    ('tag', rx_engine_inst.s_axis_desc_req_status_tag),
+                    ('func', rx_engine_inst.s_axis_desc_req_status_function_id),
+                    ('error', rx_engine_inst.s_axis_desc_req_status_error),
+                    ('empty', rx_engine_inst.s_axis_desc_req_status_empty)]),
+            ])
+
+        for k, iface in enumerate(self.dut.core_pcie_inst.core_inst.iface) :
+            interface_inst = iface.interface_inst
+            desc_fetch_inst = interface_inst.desc_fetch_inst
+            self.monitors.add_trace(self.trace, "iface%d.desc_fetch" % k, clk, [
+                ('dma_read', Rise(desc_fetch_inst.m_axis_dma_read_desc_valid), [
+                    ('addr', desc_fetch_inst.m_axis_dma_read_desc_dma_addr),
+                    ('func', desc_fetch_inst.m_axis_dma_read_desc_function_id)]),
+                ('dma_status', Rise(desc_fetch_inst.m_axis_req_status_valid), [
+                    ('queue', desc_fetch_inst.m_axis_req_status_queue),
+                    ('func', desc_fetch_inst.m_axis_req_status_function_id),
+                    ('error', desc_fetch_inst.m_axis_req_status_error),
+                    ('empty', desc_fetch_inst.m_axis_req_status_empty),
+                    ('cpl', desc_fetch_inst.m_axis_req_status_cpl)]),
+                ('rx_dequeue_req', Rise(interface_inst.rx_desc_dequeue_req_valid), [
+                    ('queue', interface_inst.rx_desc_dequeue_req_queue),
+                    ('tag', interface_inst.rx_desc_dequeue_req_tag)]),
+                ('tx_dequeue_req', Rise(interface_inst.tx_desc_dequeue_req_valid), [
+                    ('queue', interface_inst.tx_desc_dequeue_req_queue),
+                    ('tag', interface_inst.tx_desc_dequeue_req_tag)]),
+                ('dequeue_resp', Rise(desc_fetch_inst.s_axis_desc_dequeue_resp_valid), [
+                    ('queue', desc_fetch_inst.s_axis_desc_dequeue_resp_queue),
+                    ('tag', desc_fetch_inst.s_axis_desc_dequeue_resp_tag),
+                    ('func', desc_fetch_inst.s_axis_desc_dequeue_resp_function_id),
+                    ('empty', desc_fetch_inst.s_axis_desc_dequeue_resp_empty),
+                    ('error', desc_fetch_inst.s_axis_desc_dequeue_resp_error)]),
+            ])
+
+        for k, iface in enumerate(self.dut.core_pcie_inst.core_inst.iface) :
+            for name, queue_manager in [("iface%d.rx_qm" % k, iface.interface_inst.rx_qm_inst),
+                    ("iface%d.tx_qm" % k, iface.interface_inst.tx_qm_inst)]:
+                self.monitors.add_trace(self.trace, name, clk, [
+                    ('dequeue_req', Rise(queue_manager.s_axis_dequeue_req_valid), [
+                        ('queue', queue_manager.s_axis_dequeue_req_queue),
+                        ('tag', queue_manager.s_axis_dequeue_req_tag)]),
+                    ('dequeue_resp', Rise(queue_manager.m_axis_dequeue_resp_valid), [
+                        ('queue', queue_manager.m_axis_dequeue_resp_queue),
+                        ('tag', queue_manager.m_axis_dequeue_resp_op_tag),
+                        ('func', queue_manager.m_axis_dequeue_resp_function_id),
+                        ('empty', queue_manager.m_axis_dequeue_resp_empty),
+                        ('error', queue_manager.m_axis_dequeue_resp_error)]),
+                ])
+
+        msix = self.dut.core_pcie_inst.pcie_msix_inst
+        if self.monitors.add_trace(self.trace, "pcie_msix", clk, [
+                    ('irq_req', Rise(msix.irq_valid), [
+                        ('irq', msix.irq_index)]),
+                    ('axil_write', Rise(msix.s_axil_awvalid), [
+                        ('addr', msix.s_axil_awaddr),
+                        ('user', msix.s_axil_awuser)]),
+                    ('axil_read', Rise(msix.s_axil_arvalid), [
+                        ('addr', msix.s_axil_araddr),
+                        ('user', msix.s_axil_aruser)]),
+                    ('tlp_out', Rise(msix.tx_wr_req_tlp_valid), [
+                        ('hdr_lo', field_slice(msix.tx_wr_req_tlp_hdr, 0, 64)),
+                        ('hdr_hi', field_slice(msix.tx_wr_req_tlp_hdr, 64)),
+                        ('data', msix.tx_wr_req_tlp_data)]),
+                    ('tlp_out_ready', Rise(msix.tx_wr_req_tlp_ready), [
+                        ('ready', msix.tx_wr_req_tlp_ready)]),
+                ]):
+            self.log.info("PCIe MSI-X: CLOG_NUM_ENTRIES_PER_FUNC %d NUM_TABLE_ENTRIES %d NUM_ENTRIES_PER_FUNC %d",
+                msix.CLOG_NUM_ENTRIES_PER_FUNC.value, msix.NUM_TABLE_ENTRIES.value, msix.NUM_ENTRIES_PER_FUNC.value)
+
+        pcie_us_if = self.dut.pcie_if_inst
+        self.monitors.add_trace(self.trace, "pcie_if", clk, [
+            ('irq_in', Rise(pcie_us_if.tx_msix_wr_req_tlp_valid), [
+                ('hdr_lo', field_slice(pcie_us_if.tx_msix_wr_req_tlp_hdr, 0, 64)),
+                ('hdr_hi', field_slice(pcie_us_if.tx_msix_wr_req_tlp_hdr, 64)),
+                ('data', pcie_us_if.tx_msix_wr_req_tlp_data),
+                ('ready', pcie_us_if.tx_msix_wr_req_tlp_ready)]),
+            # a stalled MSI-X write being accepted
+            ('irq_in_ready', Rise(pcie_us_if.tx_msix_wr_req_tlp_ready, pcie_us_if.tx_msix_wr_req_tlp_valid), []),
+            ('irq_out', Rise(pcie_us_if.cfg_interrupt_msix_int), [
+                ('addr', pcie_us_if.cfg_interrupt_msix_address),
+                ('data', pcie_us_if.cfg_interrupt_msix_data),
+                ('func', pcie_us_if.cfg_interrupt_msi_function_number_msix)]),
+        ])
 
-        for iface in self.dut.core_pcie_inst.core_inst.iface :
-            cocotb.start_soon(self.monitor_desc_fetch_dma_read(iface.interface_inst.desc_fetch_inst))
-            cocotb.start_soon(self.monitor_desc_fetch_dma_status(iface.interface_inst.desc_fetch_inst))
-            cocotb.start_soon(self.monitor_desc_fetch_rx_dma_request_to_queue_manager(iface.interface_inst))
-            cocotb.start_soon(self.monitor_desc_fetch_tx_dma_request_to_queue_manager(iface.interface_inst))
+    def __init__(self, dut, msix_count=32):
+        self.dut = dut
 
-            cocotb.start_soon(self.monitor_desc_fetch_dma_request_to_queue_manager_response(iface.interface_inst.desc_fetch_inst))
+        self.msix_count = msix_count
+        self.irq_index_width = len(dut.core_pcie_inst.irq_index)
 
-        for iface in self.dut.core_pcie_inst.core_inst.iface :
-            cocotb.start_soon(self.monitor_queue_dequeue_request_output(iface.interface_inst.rx_qm_inst, "RX"))
-            cocotb.start_soon(self.monitor_queue_dequeue_request_input(iface.interface_inst.rx_qm_inst, "RX"))
-            cocotb.start_soon(self.monitor_queue_dequeue_request_output(iface.interface_inst.tx_qm_inst, "TX"))
-            cocotb.start_soon(self.monitor_queue_dequeue_request_input(iface.interface_inst.tx_qm_inst, "TX"))
+        self.log = SimLog("cocotb.tb")
+        self.log.setLevel(logging.DEBUG)
 
-        cocotb.start_soon(self.monitor_pcie_msix_irq_request_in(self.dut.core_pcie_inst.pcie_msix_inst))
-        cocotb.start_soon(self.monitor_pcie_msix_irq_request_out(self.dut.core_pcie_inst.pcie_msix_inst))
-        cocotb.start_soon(self.monitor_pcie_msix_irq_request_out_ready(self.dut.core_pcie_inst.pcie_msix_inst))
-        cocotb.start_soon(self.monitor_pcie_msix_irq_axil_write_in(self.dut.core_pcie_inst.pcie_msix_inst))
-        cocotb.start_soon(self.monitor_pcie_msix_irq_axil_read_in(self.dut.core_pcie_inst.pcie_msix_inst))
+        # binary trace of monitor and driver events, configured with MQNIC_TRACE*
+        self.trace = mqnic.TraceRecorder.from_env()
 
-        cocotb.start_soon(self.monitor_pcie_if_inst_irq_in(self.dut.pcie_if_inst))
-        cocotb.start_soon(self.monitor_pcie_if_inst_irq_out(self.dut.pcie_if_inst))
+        # tests may add their own monitors (counters, histograms, buffers) before or after start
+        self.monitors = mqnic_monitor.MonitorRegistry()
+        self.add_monitors()
+        self.monitors.start()
 
         # PCIe
         self.rc = RootComplex()
@@ -396,6 +408,7 @@ class TB(object):
         self.rc.make_port().connect(self.dev)
 
         self.driver = mqnic.Driver()
+        self.driver.set_trace(self.trace)
 
         self.dev.functions[0].configure_bar(0, 2**len(dut.core_pcie_inst.axil_ctrl_araddr), ext=True, prefetch=True)
         if hasattr(dut.core_pcie_inst, 'pcie_app_ctrl'):
@@ -423,6 +436,8 @@ class TB(object):
             eth_clock_period = 3.102
             eth_speed = 100e9
 
+        self.eth_speed = eth_speed
+
         for iface in core_inst.iface:
             for k in range(len(iface.port)):
                 cocotb.start_soon(Clock(iface.port[k].port_rx_clk, eth_clock_period, units="ns").start())
@@ -501,8 +516,11 @@ class TB(object):
         dut.s_axis_stat_tid.setimmediatevalue(0)
         dut.s_axis_stat_tvalid.setimmediatevalue(0)
 
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
+        # event driven fabric between the port MACs, loopback by default, MQNIC_FABRIC=switch
+        # forwards by destination MAC between all ports
+        self.fabric = mqnic_fabric.EthFabric(os.getenv("MQNIC_FABRIC", mqnic_fabric.FABRIC_LOOPBACK))
+        for mac in self.port_mac:
+            self.fabric.add_port(mac)
 
     async def init(self):
 
@@ -543,14 +561,57 @@ class TB(object):
 
         await self.rc.enumerate()
 
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk)
-
-            if self.loopback_enable:
-                for mac in self.port_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+    def start_capture(self, path, drivers=None):
+        # pcap per MAC TX output and per driver interface RX, timestamped in sim time
+        os.makedirs(path, exist_ok=True)
+        self.captures = []
+        for k, mac in enumerate(self.port_mac):
+            writer = mqnic_pcap.PcapWriter(os.path.join(path, "port%d_tx.pcap" % k))
+            mqnic_pcap.tap_mac_tx(mac, writer)
+            self.captures.append(writer)
+        for d in drivers or [self.driver]:
+            for interface in d.interfaces:
+                writer = mqnic_pcap.PcapWriter(os.path.join(path, "f%d_if%d_rx.pcap" % (d.func_id, interface.index)))
+                interface.rx_capture = writer
+                self.captures.append(writer)
+
+    def stop_capture(self):
+        for writer in getattr(self, 'captures', []):
+            writer.close()
+        self.captures = []
+
+    async def recv_port_frames(self, count, idle_timeout=100000):
+        # frames can still be in the MAC pipeline after the driver reports TX idle, so collect
+        # from every port until count frames arrived or none has for idle_timeout ns; returns
+        # a list of frames per port
+        frames = [[] for mac in self.port_mac]
+        received = 0
+        idle_start = get_sim_time('ns')
+        while received < count and get_sim_time('ns') - idle_start < idle_timeout:
+            n = received
+            for mac, port_frames in zip(self.port_mac, frames):
+                while not mac.tx.empty():
+                    port_frames.append(mac.tx.recv_nowait())
+                    received += 1
+            if received > n:
+                idle_start = get_sim_time('ns')
+            elif received < count:
+                await Timer(1, 'us')
+        return frames
+
+    async def init_driver(self):
+        # register every vector of the PF's MSI-X table, so VF drivers whose vectors fall
+        # inside it take interrupts and the rest busy poll
+        await self.driver.init_pcie_dev(self.rc.find_device(self.dev.functions[0].pcie_id),
+            irq_count=self.msix_count, irq_index_width=self.irq_index_width)
+
+    @property
+    def loopback_enable(self):
+        return self.fabric.enabled
+
+    @loopback_enable.setter
+    def loopback_enable(self, value):
+        self.fabric.enabled = value
 
 
 @cocotb.test()
@@ -680,9 +741,11 @@ async def run_test_nic(dut):
             else:
                 await tb.driver.interfaces[0].start_xmit(test_pkt.build(), 0)
 
-        for k in range(64):
-            pkt = await tb.driver.interfaces[0].recv()
+        pkts = await tb.driver.interfaces[0].recv_many(64, timeout=1, timeout_unit='ms')
+
+        assert len(pkts) == 64
 
+        for pkt in pkts:
             tb.log.info("Packet: %s", pkt)
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
@@ -690,6 +753,7 @@ async def run_test_nic(dut):
             queues.add(pkt.queue)
 
         assert len(queues) == 4
+        assert [pkt.seq for pkt in pkts] == sorted(pkt.seq for pkt in pkts)
 
         tb.loopback_enable = False
 
@@ -720,10 +784,16 @@ async def run_test_nic(dut):
 
     count = 1024
 
+    interface = tb.driver.interfaces[0]
+    tx_rings = [k % len(interface.txq) for k in range(count)]
+
+    # one scoreboard flow per TX ring, order is only guaranteed within a ring
+    sb = mqnic_scoreboard.Scoreboard()
+
     pkts = []
 
     for k in range(count) :
-        payload = bytes([x % 256 for x in range(256)])
+        payload = sb.make_payload(0, tx_rings[k], 256)
         eth = Ether(src='5A:51:52:53:54:55', dst='DA:D1:D2:D3:D4:00')
         ip = IP(src='192.168.1.100', dst='192.168.1.101')
         udp = UDP(sport=1, dport=k+0)
@@ -732,19 +802,69 @@ async def run_test_nic(dut):
 
     tb.loopback_enable = True
 
-    for k in range(len(pkts)):
-        tb.log.info(f"Sent Packet ({k}): to Queue {k % len(tb.driver.interfaces[0].txq)}")
-        await tb.driver.interfaces[0].start_xmit(pkts[k], k % len(tb.driver.interfaces[0].txq))
+    doorbells_start = sum(q.doorbells for q in interface.txq)
+    packets_start = sum(q.packets for q in interface.txq)
+    sim_time_start = get_sim_time('ns')
+    wall_time_start = time.perf_counter()
 
-    for k in range(count):
-        pkt = await tb.driver.interfaces[0].recv()
+    await interface.start_xmit_batch(pkts, tx_rings, batch_size=32)
 
-        tb.log.info(f"Packet ({k}):{pkt}")
-        if tb.driver.interfaces[0].if_feature_rx_csum:
-            assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
+    k = 0
+    async for batch in interface.recv_batches(count=count):
+        for pkt in batch:
+            tb.log.info(f"Packet ({k}):{pkt}")
+            if interface.if_feature_rx_csum:
+                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
+            k += 1
+        sb.receive_many(batch)
+
+    sim_time = get_sim_time('ns') - sim_time_start
+    wall_time = time.perf_counter() - wall_time_start
+    doorbells = sum(q.doorbells for q in interface.txq) - doorbells_start
+    packets = sum(q.packets for q in interface.txq) - packets_start
+
+    tb.log.info("TX batch: %d packets, %d doorbells (%.3f doorbells per packet)", packets, doorbells, doorbells / packets)
+    tb.log.info("TX batch: %.1f ns simulated per packet, %.3f ms wall clock per packet", sim_time / packets, wall_time*1e3 / packets)
+
+    sb.log_report(tb.log)
+    sb.check()
+
+    assert doorbells < packets
 
     tb.loopback_enable = False
 
+    for mode in [mqnic.MQNIC_POLL_MODE_NAPI, mqnic.MQNIC_POLL_MODE_BUSY]:
+        tb.log.info("Multiple TX queues, poll mode %d", mode)
+
+        await interface.set_poll_mode(mode)
+
+        irqs_start = sum(eq.irq_count for eq in interface.eq)
+        arms_start = sum(cq.arm_count for eq in interface.eq for cq in eq.cq_table.values())
+        sim_time_start = get_sim_time('ns')
+
+        tb.loopback_enable = True
+
+        await interface.start_xmit_batch(pkts, tx_rings, batch_size=32)
+
+        for pkt in await interface.recv_many(count):
+            if interface.if_feature_rx_csum:
+                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
+
+        tb.loopback_enable = False
+
+        sim_time = get_sim_time('ns') - sim_time_start
+        irqs = sum(eq.irq_count for eq in interface.eq) - irqs_start
+        arms = sum(cq.arm_count for eq in interface.eq for cq in eq.cq_table.values()) - arms_start
+
+        tb.log.info("Poll mode %d: %d interrupts, %d CQ arms, %.1f ns simulated per packet", mode, irqs, arms, sim_time / count)
+
+        await interface.set_poll_mode(mqnic.MQNIC_POLL_MODE_IRQ)
+
+    for stats in tb.driver.get_pkt_pool_stats():
+        tb.log.info("Packet buffer pool: %s", stats)
+
+        assert stats['in_use'] <= stats['capacity']
+
     tb.log.info("Multiple large packets")
 
     count = 1024
@@ -837,6 +957,18 @@ async def run_test_nic(dut):
 
     #     tb.loopback_enable = False
 
+    for m in tb.driver.get_func_metrics():
+        tb.log.info("Function %d %s: %d packets, %d doorbells, latency mean %.1f ns p99 %d ns, blocked %d ns, occupancy p99 %d",
+            m.func, m.ring_type, m.packets, m.doorbells, m.latency.mean(), m.latency.percentile(99),
+            m.blocked_ns, m.occupancy.percentile(99))
+
+    metrics_dir = os.getenv("MQNIC_METRICS_DIR")
+    if metrics_dir:
+        tb.driver.export_metrics_json(os.path.join(metrics_dir, "ring_metrics.json"))
+        tb.driver.export_metrics_csv(os.path.join(metrics_dir, "ring_metrics.csv"))
+
+    tb.trace.close()
+
     # tb.log.info("Read statistics counters")
 
     # await Timer(2000, 'ns')
@@ -852,6 +984,593 @@ async def run_test_nic(dut):
     # await RisingEdge(dut.clk)
 
 
+@cocotb.test()
+async def run_test_close_reordered(dut):
+
+    tb = TB(dut, msix_count=2**len(dut.core_pcie_inst.irq_index))
+
+    await tb.init()
+
+    tb.log.info("Init driver")
+    await tb.driver.init_pcie_dev(tb.rc.find_device(tb.dev.functions[0].pcie_id))
+
+    in_use = sum(stats['in_use'] for stats in tb.driver.get_pkt_pool_stats())
+
+    interface = tb.driver.interfaces[0]
+    await interface.open()
+
+    tb.log.info("Close with reordered completions outstanding")
+
+    # descriptors are queued without a doorbell, so the hardware never completes them
+    ring = interface.txq[0]
+    for k in range(8):
+        await interface.start_xmit(bytes([k])*64, 0, xmit_more=True)
+
+    # completions for slots 1 and 3 arrive ahead of slot 0
+    for index in [1, 3]:
+        ring.free_desc((ring.cons_ptr + index) & ring.size_mask)
+    ring.advance_cons_ptr()
+
+    assert ring.prod_ptr - ring.cons_ptr == 8
+
+    await interface.close()
+
+    assert sum(stats['in_use'] for stats in tb.driver.get_pkt_pool_stats()) == in_use
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+@cocotb.test()
+async def run_test_vf_irq(dut):
+
+    tb = TB(dut, msix_count=msix_count_for(dut, 2))
+
+    await tb.init()
+
+    tb.log.info("Init PF driver")
+    await tb.init_driver()
+
+    if tb.driver.num_funcs < 2:
+        tb.log.info("Single function design, no VF to interrupt")
+        return
+
+    vf = (await tb.driver.create_vf_drivers([1]))[0]
+    interface = vf.interfaces[0]
+
+    if not interface.eq:
+        tb.log.info("VF has no event queues, nothing to interrupt")
+        return
+
+    # the VF's vectors start one stride in, past the PF's
+    assert vf.irq_enabled
+    assert tb.driver.irqs_per_func == 1 << tb.irq_index_width
+
+    await interface.open(txq_count=1, rxq_count=1, ring_size=256)
+    assert interface.poll_mode == mqnic.MQNIC_POLL_MODE_IRQ
+
+    sched = tb.driver.interfaces[0].sched_blocks[0].schedulers[0]
+    await sched.rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
+    await sched.hw_regs.write_dword(4*interface.txq_res.get_physical_index(interface.txq[0].index), 0x00000003)
+    await tb.driver.hw_regs.read_dword(0)
+
+    pf_irqs = sum(eq.irq_count for i in tb.driver.interfaces for eq in i.eq)
+    vf_irqs = sum(eq.irq_count for eq in interface.eq)
+
+    tb.log.info("Send packet from VF")
+
+    eth = Ether(src='5A:51:52:53:00:01', dst='DA:D1:D2:D3:D4:00')
+    ip = IP(src='192.168.1.100', dst='192.168.1.101')
+    udp = UDP(sport=1, dport=0)
+    test_pkt = (eth / ip / udp / bytes(range(64))).build()
+
+    await interface.start_xmit(test_pkt, 0)
+
+    pkt = await tb.port_mac[0].tx.recv()
+    assert bytes(pkt.get_payload()) == test_pkt
+
+    # the TX completion is only processed by the VF's interrupt handler
+    await with_timeout(interface.wait_tx_idle(), 100, 'us')
+
+    assert sum(eq.irq_count for eq in interface.eq) > vf_irqs
+    assert sum(eq.irq_count for i in tb.driver.interfaces for eq in i.eq) == pf_irqs
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+@cocotb.test(skip=os.getenv("VF_SCALING_FUNCS") is None)
+async def run_test_vf_scaling(dut):
+
+    # VF_SCALING_FUNCS: comma-separated function counts, e.g. "1,8,64,252"
+    func_counts = [int(x) for x in os.getenv("VF_SCALING_FUNCS", "1").split(',')]
+    pkt_count = int(os.getenv("VF_SCALING_PACKETS", "16"))
+    pkt_len = int(os.getenv("VF_SCALING_PKT_LEN", "1024"))
+
+    tb = TB(dut, msix_count=msix_count_for(dut, max(func_counts)))
+
+    await tb.init()
+
+    tb.log.info("Init PF driver")
+    await tb.init_driver()
+
+    func_counts = [min(n, tb.driver.num_funcs) for n in func_counts]
+
+    tb.log.info("Init %d VF drivers", max(func_counts)-1)
+
+    sim_time_start = get_sim_time('ns')
+    wall_time_start = time.perf_counter()
+
+    vf_drivers = await tb.driver.create_vf_drivers(range(1, max(func_counts)))
+
+    tb.log.info("VF bring-up: %.1f us simulated, %.3f s wall clock",
+        (get_sim_time('ns') - sim_time_start) / 1000, time.perf_counter() - wall_time_start)
+
+    drivers = [tb.driver] + vf_drivers
+
+    # one TX and one RX queue per function
+    await mqnic.gather(*[d.interfaces[0].open(txq_count=1, rxq_count=1, ring_size=256) for d in drivers])
+
+    # no two functions may own the same EQ, CQ, TXQ or RXQ
+    tb.driver.check_resources()
+
+    for d in drivers:
+        d.interfaces[0].busy_poll_interval = 1000
+
+    sched = tb.driver.interfaces[0].sched_blocks[0].schedulers[0]
+    await sched.rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
+    for d in drivers:
+        interface = d.interfaces[0]
+        for q in interface.txq:
+            await sched.hw_regs.write_dword(4*interface.txq_res.get_physical_index(q.index), 0x00000003)
+
+    # wait for all writes to complete
+    await tb.driver.hw_regs.read_dword(0)
+
+    for n in func_counts:
+        tb.log.info("TX scaling: %d functions, %d packets of %d bytes each", n, pkt_count, pkt_len)
+
+        times = {}
+
+        # one flow per function, latency measured from build to the start of frame on the wire
+        sb = mqnic_scoreboard.Scoreboard()
+
+        async def run_func(d):
+            interface = d.interfaces[0]
+
+            pkts = []
+            for k in range(pkt_count):
+                eth = Ether(src='5A:51:52:53:%02X:%02X' % (d.func_id >> 8, d.func_id & 0xff), dst='DA:D1:D2:D3:D4:00')
+                ip = IP(src='192.168.1.100', dst='192.168.1.101')
+                udp = UDP(sport=d.func_id, dport=k)
+                pkts.append((eth / ip / udp / sb.make_payload(d.func_id, 0, pkt_len-42)).build())
+
+            start = get_sim_time('ns')
+            await interface.start_xmit_batch(pkts, 0)
+            await interface.wait_tx_idle()
+            times[d.func_id] = (start, get_sim_time('ns'))
+
+        await mqnic.gather(*[run_func(d) for d in drivers[:n]])
+
+        start = min(t[0] for t in times.values())
+        end = max(t[1] for t in times.values())
+
+        func_gbps = [pkt_count*pkt_len*8 / (t[1]-t[0]) for t in times.values()]
+        agg_gbps = n*pkt_count*pkt_len*8 / (end-start)
+
+        tb.log.info("TX scaling: %d functions: aggregate %.3f Gbps, per function min %.3f mean %.3f max %.3f Gbps",
+            n, agg_gbps, min(func_gbps), sum(func_gbps)/len(func_gbps), max(func_gbps))
+
+        for func_id in sorted(times):
+            t = times[func_id]
+            tb.log.info("TX scaling: %d functions: function %d %.3f Gbps", n, func_id, pkt_count*pkt_len*8 / (t[1]-t[0]))
+
+        for frame in itertools.chain.from_iterable(await tb.recv_port_frames(n*pkt_count)):
+            sb.receive(bytes(frame), get_time_from_sim_steps(frame.sim_time_sfd, 'ns'))
+
+        sb.log_report(tb.log)
+        sb.check()
+
+    tb.trace.close()
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+@cocotb.test(skip=os.getenv("PCAP_REPLAY") is None)
+async def run_test_pcap_replay(dut):
+
+    # PCAP_REPLAY: pcap or pcapng file; PCAP_REPLAY_PATH: "driver" to transmit through the
+    # driver TX path, "mac" to inject on the MAC RX side; flows are spread over
+    # PCAP_REPLAY_FUNCS functions by hash
+    pcap_file = os.getenv("PCAP_REPLAY")
+    path = os.getenv("PCAP_REPLAY_PATH", "driver")
+    func_count = int(os.getenv("PCAP_REPLAY_FUNCS", "1"))
+    speedup = float(os.getenv("PCAP_REPLAY_SPEEDUP", "1"))
+    rate_gbps = float(os.getenv("PCAP_REPLAY_RATE", "0"))
+    count = int(os.getenv("PCAP_REPLAY_COUNT", "0")) or None
+
+    tb = TB(dut, msix_count=msix_count_for(dut, func_count))
+
+    await tb.init()
+
+    tb.log.info("Init driver")
+    await tb.init_driver()
+
+    func_count = min(func_count, tb.driver.num_funcs)
+    drivers = [tb.driver] + await tb.driver.create_vf_drivers(range(1, func_count))
+
+    await mqnic.gather(*[d.interfaces[0].open(txq_count=1, rxq_count=1) for d in drivers])
+
+    for d in drivers:
+        d.interfaces[0].busy_poll_interval = 1000
+
+    sched = tb.driver.interfaces[0].sched_blocks[0].schedulers[0]
+    await sched.rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
+    for d in drivers:
+        interface = d.interfaces[0]
+        for q in interface.txq:
+            await sched.hw_regs.write_dword(4*interface.txq_res.get_physical_index(q.index), 0x00000003)
+
+    # wait for all writes to complete
+    await tb.driver.hw_regs.read_dword(0)
+
+    capture_dir = os.getenv("MQNIC_PCAP_CAPTURE")
+    if capture_dir:
+        tb.start_capture(capture_dir, drivers)
+
+    with mqnic_pcap.PcapReader(pcap_file) as reader:
+        tb.log.info("Replay %s (%s) via %s across %d functions", pcap_file, reader.format, path, func_count)
+
+        sim_time_start = get_sim_time('ns')
+        wall_time_start = time.perf_counter()
+
+        if path == "mac":
+            classifier = mqnic_pcap.FlowClassifier(hash_targets=list(range(len(tb.port_mac))))
+            sent = await mqnic_pcap.replay_to_macs(reader, tb.port_mac, classifier,
+                speedup=speedup, rate_gbps=rate_gbps or None, count=count)
+        else:
+            classifier = mqnic_pcap.FlowClassifier(hash_targets=list(range(func_count)))
+            sent = await mqnic_pcap.replay_to_interfaces(reader, [d.interfaces[0] for d in drivers], classifier,
+                speedup=speedup, rate_gbps=rate_gbps or None, count=count)
+
+        tb.log.info("Replayed %d packets: %.1f us simulated, %.3f s wall clock", sent,
+            (get_sim_time('ns') - sim_time_start) / 1000, time.perf_counter() - wall_time_start)
+
+        expected = [bytes(rec.data) for rec in itertools.islice(reader, sent)]
+
+    # drain what came out the other side
+    received = []
+    if path == "mac":
+        # give up once nothing has arrived on any function for 100 us
+        idle_start = get_sim_time('ns')
+        while len(received) < sent and get_sim_time('ns') - idle_start < 100000:
+            pkts = [pkt for d in drivers for pkt in d.interfaces[0].recv_many_nowait()]
+            if pkts:
+                received += [bytes(pkt.data) for pkt in pkts]
+                idle_start = get_sim_time('ns')
+            else:
+                await Timer(1, 'us')
+    else:
+        for d in drivers:
+            await d.interfaces[0].wait_tx_idle()
+        received = [bytes(frame) for frame in itertools.chain.from_iterable(await tb.recv_port_frames(sent))]
+
+    tb.log.info("Received %d of %d packets", len(received), sent)
+
+    assert len(received) == sent
+
+    # flows are spread over functions and ports, so only the order within a flow is kept;
+    # runt frames are padded to the Ethernet minimum on the way through
+    assert sorted(pkt.ljust(60, b'\x00') for pkt in received) == sorted(pkt.ljust(60, b'\x00') for pkt in expected)
+
+    tb.stop_capture()
+    tb.trace.close()
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+def jain_index(values):
+    # 1.0 when all values are equal, 1/n when one value takes everything
+    if not values or not any(values):
+        return 0.0
+    return sum(values)**2 / (len(values) * sum(v*v for v in values))
+
+
+async def configure_wrr(tb, drivers, weights):
+    # enable the scheduler and the TX queues of every driver, then set the function weights
+    sched = tb.driver.interfaces[0].sched_blocks[0].schedulers[0]
+    await sched.rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
+    for d in drivers:
+        interface = d.interfaces[0]
+        for q in interface.txq:
+            await sched.hw_regs.write_dword(4*interface.txq_res.get_physical_index(q.index), 0x00000003)
+
+    # function weights follow the queue state entries in the scheduler address space
+    ch_count = await sched.rb.read_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CH_COUNT)
+    for d, w in zip(drivers, weights):
+        await sched.hw_regs.write_dword(4*(ch_count + d.func_id), w)
+
+    # wait for all writes to complete
+    await tb.driver.hw_regs.read_dword(0)
+
+
+@cocotb.test(skip=os.getenv("SCENARIO") is None)
+async def run_test_scenario(dut):
+
+    # SCENARIO: JSON object with vms, weights (per function WRR weight), sizes (frame size or
+    # list of [weight, size]), load_gbps (total offered load, split evenly), duration_us,
+    # process ("poisson" or "cbr") and seed; results are written to SCENARIO_RESULTS
+    scenario = json.loads(os.getenv("SCENARIO"))
+    results_file = os.getenv("SCENARIO_RESULTS")
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'new_testbench'))
+    try:
+        import arrival
+    finally:
+        del sys.path[0]
+
+    tb = TB(dut, msix_count=msix_count_for(dut, scenario.get('vms', 1)))
+
+    await tb.init()
+
+    tb.log.info("Scenario: %s", scenario)
+
+    await tb.init_driver()
+
+    func_count = min(scenario.get('vms', 1), tb.driver.num_funcs)
+    weights = scenario.get('weights', [1])
+    weights = [weights[k % len(weights)] for k in range(func_count)]
+    duration_ns = scenario.get('duration_us', 50) * 1000
+    seed = scenario.get('seed', 0)
+
+    drivers = [tb.driver] + await tb.driver.create_vf_drivers(range(1, func_count))
+
+    await mqnic.gather(*[d.interfaces[0].open(txq_count=1, rxq_count=1) for d in drivers])
+
+    for d in drivers:
+        d.interfaces[0].busy_poll_interval = 1000
+
+    await configure_wrr(tb, drivers, weights)
+
+    sizes = scenario.get('sizes', 1514)
+    loads = arrival.split_load(scenario.get('load_gbps', 10), [1]*func_count)
+
+    sb = mqnic_scoreboard.Scoreboard()
+
+    async def run_func(d, load):
+        rng = arrival.stream_rng(seed, d.func_id, 'arrival')
+        size = arrival.SizeMix(sizes, arrival.stream_rng(seed, d.func_id, 'size')) if isinstance(sizes, list) else sizes
+        if scenario.get('process', 'poisson') == 'cbr':
+            process = arrival.CbrArrival(load, size)
+        else:
+            process = arrival.PoissonArrival(load, rng, size)
+
+        def packet_source(size):
+            eth = Ether(src='5A:51:52:53:%02X:%02X' % (d.func_id >> 8, d.func_id & 0xff), dst='DA:D1:D2:D3:D4:00')
+            ip = IP(src='192.168.1.100', dst='192.168.1.101')
+            udp = UDP(sport=d.func_id, dport=1)
+            return (eth / ip / udp / sb.make_payload(d.func_id, 0, max(size, 60)-42)).build()
+
+        return await arrival.offer_load(d.interfaces[0], 0, process, packet_source, arrival.SimTimer(), duration_ns)
+
+    sim_time_start = get_sim_time('ns')
+    wall_time_start = time.perf_counter()
+
+    offered = await mqnic.gather(*[run_func(d, load) for d, load in zip(drivers, loads)])
+
+    for d in drivers:
+        await d.interfaces[0].wait_tx_idle()
+
+    # throughput is measured up to the last frame on the wire, not the end of the drain
+    end = get_sim_time('ns')
+    func_bytes = {d.func_id: 0 for d in drivers}
+    for frame in itertools.chain.from_iterable(await tb.recv_port_frames(sum(stats.packets for stats in offered))):
+        t = get_time_from_sim_steps(frame.sim_time_sfd, 'ns')
+        end = max(end, t)
+        f = sb.receive(bytes(frame), t)
+        if f:
+            func_bytes[f.func] += len(frame.data)
+
+    elapsed = end - sim_time_start
+
+    sb.log_report(tb.log)
+
+    funcs = []
+    for d, w, stats in zip(drivers, weights, offered):
+        s = next(x for x in sb.get_func_summary() if x['func'] == d.func_id)
+        funcs.append({
+            'func': d.func_id,
+            'weight': w,
+            'offered_gbps': stats.offered_gbps(),
+            'throughput_gbps': func_bytes[d.func_id]*8 / elapsed,
+            'sent': s['sent'],
+            'received': s['received'],
+            'lost': s['lost'],
+            'latency_mean_ns': s['latency_mean'],
+            'latency_p99_ns': s['latency_p99'],
+        })
+
+    throughput = [f['throughput_gbps'] for f in funcs]
+    results = {
+        'scenario': scenario,
+        'sim_time_ns': elapsed,
+        'wall_time_s': time.perf_counter() - wall_time_start,
+        'offered_gbps': sum(f['offered_gbps'] for f in funcs),
+        'throughput_gbps': sum(throughput),
+        'jain': jain_index(throughput),
+        # fairness relative to the configured weights
+        'weighted_jain': jain_index([t / f['weight'] for t, f in zip(throughput, funcs)]),
+        'funcs': funcs,
+    }
+
+    tb.log.info("Scenario result: %.3f Gbps total, Jain %.3f, weighted Jain %.3f",
+        results['throughput_gbps'], results['jain'], results['weighted_jain'])
+
+    if results_file:
+        with open(results_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    tb.trace.close()
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+BENCHMARK_SIZES = [64, 128, 256, 512, 1024, 1514, 4096, 9014]
+BENCHMARK_FUNCS = [1, 2, 4]
+
+
+@cocotb.test(skip=os.getenv("BENCHMARK") is None)
+async def run_test_benchmark(dut):
+
+    # BENCHMARK: JSON object with sizes (frame sizes without FCS, capped at the interface MTU),
+    # funcs (function counts, PF first then VFs), duration_us per point and load (offered
+    # load as a multiple of the port line rate, above 1 to saturate); each point of the
+    # sweep is written to BENCHMARK_RESULTS (default benchmark.json) as it completes
+    bench = json.loads(os.getenv("BENCHMARK") or "{}")
+    results_file = os.getenv("BENCHMARK_RESULTS", "benchmark.json")
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'new_testbench'))
+    try:
+        import arrival
+    finally:
+        del sys.path[0]
+
+    tb = TB(dut, msix_count=msix_count_for(dut, max(bench.get('funcs', BENCHMARK_FUNCS))))
+
+    await tb.init()
+
+    await tb.init_driver()
+
+    func_counts = sorted({min(n, tb.driver.num_funcs) for n in bench.get('funcs', BENCHMARK_FUNCS)})
+    duration_ns = bench.get('duration_us', 50) * 1000
+    load = bench.get('load', 1.25)
+    line_gbps = tb.eth_speed / 1e9
+
+    drivers = [tb.driver] + await tb.driver.create_vf_drivers(range(1, func_counts[-1]))
+
+    await mqnic.gather(*[d.interfaces[0].open(txq_count=1, rxq_count=1) for d in drivers])
+
+    await configure_wrr(tb, drivers, [1]*len(drivers))
+
+    max_size = min(d.interfaces[0].max_tx_mtu for d in drivers) - 1
+    sizes = [max(min(size, max_size), 60) for size in bench.get('sizes', BENCHMARK_SIZES)]
+
+    results = {
+        'benchmark': bench,
+        'port_count': len(tb.port_mac),
+        'line_gbps': line_gbps,
+        'points': [],
+    }
+
+    for func_count in func_counts:
+        for size in sizes:
+            sb = mqnic_scoreboard.Scoreboard()
+
+            async def run_func(d):
+                # headers only depend on the function and size, so build them once; UDP checksum
+                # 0 as the payload changes every packet
+                eth = Ether(src='5A:51:52:53:%02X:%02X' % (d.func_id >> 8, d.func_id & 0xff), dst='DA:D1:D2:D3:D4:00')
+                ip = IP(src='192.168.1.100', dst='192.168.1.101')
+                udp = UDP(sport=d.func_id, dport=1, chksum=0)
+                hdr = (eth / ip / udp / bytes(size-42)).build()[:42]
+
+                def packet_source(size):
+                    return hdr + sb.make_payload(d.func_id, 0, size-42)
+
+                process = arrival.CbrArrival(load*line_gbps*len(tb.port_mac) / func_count, size)
+                return await arrival.offer_load(d.interfaces[0], 0, process, packet_source, arrival.SimTimer(), duration_ns)
+
+            sim_time_start = get_sim_time('ns')
+            wall_time_start = time.perf_counter()
+
+            offered = await mqnic.gather(*[run_func(d) for d in drivers[:func_count]])
+
+            for d in drivers[:func_count]:
+                await d.interfaces[0].wait_tx_idle()
+
+            # the point ends with the last frame on the wire, so neither the wait for frames
+            # still in the MAC pipeline nor the idle timeout after a loss counts
+            end = get_sim_time('ns')
+            port_frames = []
+            for received in await tb.recv_port_frames(sum(stats.packets for stats in offered)):
+                port_frames.append([])
+                for frame in received:
+                    t = get_time_from_sim_steps(frame.sim_time_sfd, 'ns')
+                    end = max(end, t)
+                    port_frames[-1].append((frame, sb.receive(bytes(frame), t)))
+
+            elapsed = end - sim_time_start
+            wall_time = time.perf_counter() - wall_time_start
+
+            ports = []
+            func_frames = {d.func_id: 0 for d in drivers[:func_count]}
+            func_bytes = {d.func_id: 0 for d in drivers[:func_count]}
+            for k, received in enumerate(port_frames):
+                frames = len(received)
+                nbytes = 0
+                for frame, f in received:
+                    nbytes += len(frame.data)
+                    if f:
+                        func_frames[f.func] += 1
+                        func_bytes[f.func] += len(frame.data)
+                ports.append({
+                    'port': k,
+                    'frames': frames,
+                    'gbps': nbytes*8 / elapsed,
+                    'mpps': frames*1e3 / elapsed,
+                    # share of the line rate including preamble, FCS and inter-frame gap
+                    'utilization': (nbytes + frames*arrival.ETH_WIRE_OVERHEAD)*8 / elapsed / line_gbps,
+                })
+
+            funcs = []
+            for d, stats in zip(drivers, offered):
+                s = next(x for x in sb.get_func_summary() if x['func'] == d.func_id)
+                funcs.append({
+                    'func': d.func_id,
+                    'offered_gbps': stats.offered_gbps(),
+                    'gbps': func_bytes[d.func_id]*8 / elapsed,
+                    'mpps': func_frames[d.func_id]*1e3 / elapsed,
+                    'sent': s['sent'],
+                    'lost': s['lost'],
+                    'latency_mean_ns': s['latency_mean'],
+                    'latency_p99_ns': s['latency_p99'],
+                })
+
+            point = {
+                'funcs': func_count,
+                'size': size,
+                'sim_time_ns': elapsed,
+                'wall_time_s': wall_time,
+                # simulator and testbench speed, to catch regressions in either
+                'sim_ns_per_wall_s': elapsed / wall_time if wall_time else None,
+                'gbps': sum(p['gbps'] for p in ports),
+                'mpps': sum(p['mpps'] for p in ports),
+                'lost': sum(f['lost'] for f in funcs),
+                'ports': ports,
+                'func_results': funcs,
+            }
+            results['points'].append(point)
+
+            tb.log.info("Benchmark: %d functions, %d byte frames: %.3f Gbps %.3f Mpps (%.1f%% of line rate), "
+                "%d lost, %.0f sim ns per wall s", func_count, size, point['gbps'], point['mpps'],
+                100*sum(p['utilization'] for p in ports) / len(ports), point['lost'], point['sim_ns_per_wall_s'] or 0)
+            for f in funcs:
+                tb.log.info("Benchmark: %d functions, %d byte frames: function %d %.3f Gbps %.3f Mpps",
+                    func_count, size, f['func'], f['gbps'], f['mpps'])
+
+            # rewritten after every point so a long sweep leaves partial results
+            with open(results_file, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    tb.trace.close()
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
 # cocotb-test
 
 tests_dir = os.path.dirname(__file__)
@@ -1113,7 +1832,8 @@ def test_mqnic_core_pcie_us(request, if_count, ports_per_if, axis_pcie_data_widt
 
     extra_env = {f'PARAM_{k}': str(v) for k, v in parameters.items()}
 
-    sim_build = os.path.join(tests_dir, "sim_build",
+    # SIM_BUILD gives concurrent runs of the same configuration separate build directories
+    sim_build = os.getenv("SIM_BUILD") or os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
     cocotb_test.simulator.run(
@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import collections
+import random
+
+try:
+    import cocotb
+    from cocotb.triggers import Event, Timer
+    from cocotb.utils import get_sim_time, get_sim_steps
+except ImportError:
+    cocotb = None
+    Event = None
+    Timer = None
+    get_sim_time = None
+    get_sim_steps = None
+
+
+# preamble, SFD, FCS and inter-frame gap
+ETH_WIRE_OVERHEAD = 24
+
+FABRIC_LOOPBACK = 'loopback'
+FABRIC_SWITCH = 'switch'
+
+
+def _frame_len(frame):
+    # EthMacFrame or bytes
+    return len(getattr(frame, 'data', frame))
+
+
+class FabricPort:
+    def __init__(self, fabric, index, mac, name, delay_ns, rate_bps, drop):
+        self.fabric = fabric
+        self.index = index
+        self.mac = mac
+        self.name = name
+
+        # egress link: propagation delay, serialization rate (None for no limit beyond the
+        # MAC's own line rate) and probability of dropping a frame
+        self.delay_ns = delay_ns
+        self.rate_bps = rate_bps
+        self.drop = drop
+
+        # (delivery time in steps, frame) in delivery order
+        self.queue = collections.deque()
+        self.queue_sync = Event()
+        self.busy_until = 0
+
+        self.rx_frames = 0
+        self.tx_frames = 0
+        self.tx_bytes = 0
+        self.dropped = 0
+
+        self._ingress_cr = None
+        self._egress_cr = None
+
+    def enqueue(self, frame):
+        if self.drop and self.fabric.rng.random() < self.drop:
+            self.dropped += 1
+            return
+
+        # frames leave back to back at the link rate, then arrive delay_ns later
+        now = get_sim_time()
+        start = max(now, self.busy_until)
+        if self.rate_bps:
+            start += round((_frame_len(frame) + ETH_WIRE_OVERHEAD) * 8 * 1e9 / self.rate_bps * self.fabric.steps_per_ns)
+        self.busy_until = start
+        self.queue.append((start + round(self.delay_ns * self.fabric.steps_per_ns), frame))
+        self.queue_sync.set()
+
+    async def _run_ingress(self):
+        # wakes only when the MAC has a transmitted frame
+        while True:
+            frame = await self.mac.tx.recv()
+            self.rx_frames += 1
+            self.fabric.forward(self, frame)
+
+    async def _run_egress(self):
+        while True:
+            while not self.queue:
+                self.queue_sync.clear()
+                await self.queue_sync.wait()
+
+            t, frame = self.queue[0]
+            steps = t - get_sim_time()
+            if steps > 0:
+                await Timer(steps, 'step')
+            self.queue.popleft()
+
+            self.tx_frames += 1
+            self.tx_bytes += _frame_len(frame)
+            await self.mac.rx.send(frame)
+
+    def start(self):
+        if self._egress_cr is None:
+            self._egress_cr = cocotb.start_soon(self._run_egress())
+        if self._ingress_cr is None:
+            self._ingress_cr = cocotb.start_soon(self._run_ingress())
+
+    def stop(self):
+        # frames already in the fabric are still delivered, the MAC TX queue is left alone
+        if self._ingress_cr is not None:
+            self._ingress_cr.kill()
+            self._ingress_cr = None
+
+
+class EthFabric:
+    def __init__(self, mode=FABRIC_LOOPBACK, hairpin=True, seed=None):
+        # connects EthMac ports, in loopback mode each port's TX goes back to its own RX, in
+        # switch mode frames are forwarded by destination MAC with source MAC learning and
+        # flooded while the destination is unknown; hairpin lets a switch send a frame back
+        # out of its ingress port, as a VEPA switch does for VF to VF traffic on one port
+        self.mode = mode
+        self.hairpin = hairpin
+        self.rng = random.Random(seed)
+        self.steps_per_ns = get_sim_steps(1, 'ns') if get_sim_time else 1
+
+        self.ports = []
+        self.mac_table = {}
+        self.flooded = 0
+        self._enabled = False
+
+    def add_port(self, mac, name=None, delay_ns=0, rate_bps=None, drop=0.0):
+        # mac is any object with tx.recv() and rx.send(), e.g. an EthMac; ports of several
+        # NIC instances can share one fabric
+        port = FabricPort(self, len(self.ports), mac, name or "port%d" % len(self.ports), delay_ns, rate_bps, drop)
+        self.ports.append(port)
+        if self._enabled:
+            port.start()
+        return port
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        # while disabled the fabric does not take frames from the MACs, so tests can receive
+        # from mac.tx directly
+        value = bool(value)
+        if value == self._enabled:
+            return
+        self._enabled = value
+        for port in self.ports:
+            if value:
+                port.start()
+            else:
+                port.stop()
+
+    def forward(self, ingress, frame):
+        if self.mode == FABRIC_LOOPBACK:
+            ingress.enqueue(frame)
+            return
+
+        data = bytes(frame)
+        dst = data[0:6]
+        src = data[6:12]
+
+        if not src[0] & 1:
+            self.mac_table[src] = ingress
+
+        egress = self.mac_table.get(dst) if not dst[0] & 1 else None
+        if egress is not None:
+            if egress is not ingress or self.hairpin:
+                egress.enqueue(frame)
+            return
+
+        # broadcast, multicast or unknown unicast
+        self.flooded += 1
+        for port in self.ports:
+            if port is not ingress or self.hairpin:
+                port.enqueue(data)
+
+    def get_stats(self):
+        return [{
+            'port': p.name,
+            'rx_frames': p.rx_frames,
+            'tx_frames': p.tx_frames,
+            'tx_bytes': p.tx_bytes,
+            'dropped': p.dropped,
+            'queued': len(p.queue),
+        } for p in self.ports]
+
+    def log_report(self, log):
+        for s in self.get_stats():
+            log.info("Fabric %s: %d frames in, %d frames (%d bytes) out, %d dropped, %d queued", s['port'],
+                s['rx_frames'], s['tx_frames'], s['tx_bytes'], s['dropped'], s['queued'])
+        if self.mode == FABRIC_SWITCH:
+            log.info("Fabric: %d MAC addresses learned, %d frames flooded", len(self.mac_table), self.flooded)
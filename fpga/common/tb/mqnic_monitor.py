@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import collections
+
+try:
+    import cocotb
+    from cocotb.triggers import RisingEdge
+    from cocotb.utils import get_sim_time
+except ImportError:
+    cocotb = None
+    get_sim_time = None
+
+from mqnic import Histogram
+
+
+def _bit(handle):
+    # unresolved (X/Z) bits read as 0
+    v = handle.value
+    return v.is_resolvable and v.integer
+
+
+# Triggers, evaluated once per clock cycle of their domain after the rising edge
+
+class Handshake:
+    # every cycle with valid, and ready when the interface has one
+    def __init__(self, valid, ready=None):
+        self.valid = valid
+        self.ready = ready
+
+    def fire(self):
+        return _bit(self.valid) and (self.ready is None or _bit(self.ready))
+
+
+class Rise:
+    # signal goes from 0 to 1, optionally only while qualifier is high
+    def __init__(self, signal, qualifier=None):
+        self.signal = signal
+        self.qualifier = qualifier
+        self.last = 0
+
+    def fire(self):
+        v = _bit(self.signal)
+        rose = v and not self.last
+        self.last = v
+        return rose and (self.qualifier is None or _bit(self.qualifier))
+
+
+class Change:
+    # any of the signals differs from the previous cycle
+    def __init__(self, *signals):
+        self.signals = signals
+        self.last = None
+
+    def fire(self):
+        v = tuple(str(s.value) for s in self.signals)
+        changed = self.last is not None and v != self.last
+        self.last = v
+        return changed
+
+
+class Every:
+    # one cycle in every n
+    def __init__(self, n):
+        self.n = n
+        self.count = 0
+
+    def fire(self):
+        self.count += 1
+        if self.count < self.n:
+            return False
+        self.count = 0
+        return True
+
+
+def field_slice(handle, lsb, width=None):
+    # reads bits [lsb, lsb+width) of a wide signal as a field
+    mask = (1 << width) - 1 if width else -1
+    return lambda: (handle.value.integer >> lsb) & mask
+
+
+def _field_reader(field):
+    if hasattr(field, 'value'):
+        return lambda: field.value.integer
+    return field
+
+
+# Sinks, each gets the list of field values of every firing
+
+class CounterSink:
+    def __init__(self):
+        self.count = 0
+
+    def record(self, values):
+        self.count += 1
+
+
+class HistogramSink:
+    # power-of-two histogram of one field, or of exact values when exact is set
+    def __init__(self, field=0, exact=False):
+        self.field = field
+        self.exact = exact
+        self.hist = collections.Counter() if exact else Histogram()
+
+    def record(self, values):
+        if self.exact:
+            self.hist[values[self.field]] += 1
+        else:
+            self.hist.add(values[self.field])
+
+
+class BufferSink:
+    # the last capacity firings as (sim time in ns, values)
+    def __init__(self, capacity=1024):
+        self.buf = collections.deque(maxlen=capacity)
+
+    def record(self, values):
+        self.buf.append((get_sim_time('ns'), values))
+
+
+class TraceSink:
+    # one event of a TraceComponent, see mqnic_trace.TraceRecorder
+    def __init__(self, trace, event):
+        self.trace = trace
+        self.event = event
+
+    def record(self, values):
+        self.trace.record(self.event, *values)
+
+
+class Monitor:
+    def __init__(self, name, trigger, fields, sinks):
+        self.name = name
+        self.trigger = trigger
+        self.fields = [_field_reader(f) for f in fields]
+        self.sinks = list(sinks)
+
+
+class MonitorRegistry:
+    def __init__(self):
+        # monitors of each clock domain, all evaluated by one coroutine per clock
+        self.domains = {}
+        self.monitors = {}
+        self.running = {}
+
+    def add(self, name, clock, trigger, fields=(), sinks=()):
+        # fields are signal handles or callables returning an int, e.g. field_slice()
+        if name in self.monitors:
+            raise Exception("Duplicate monitor %s" % name)
+        mon = Monitor(name, trigger, fields, sinks)
+        self.monitors[name] = mon
+        # a running domain picks up the new monitor on its next cycle
+        self.domains.setdefault(clock, []).append(mon)
+        return mon
+
+    def add_trace(self, trace, name, clock, events):
+        # events: list of (event name, trigger, [(field name, field)]), declared as one trace
+        # component; only events enabled in the trace get a monitor
+        comp = trace.component(name, [(ev, tuple(f for f, _ in fields)) for ev, _, fields in events])
+        mons = []
+        for k, (ev, trigger, fields) in enumerate(events):
+            if comp.enabled(k):
+                mons.append(self.add("%s.%s" % (name, ev), clock, trigger, [f for _, f in fields],
+                    [TraceSink(comp, k)]))
+        return mons
+
+    def get(self, name):
+        return self.monitors[name]
+
+    def start(self):
+        for clock, mons in self.domains.items():
+            if clock not in self.running:
+                self.running[clock] = cocotb.start_soon(self._run(clock, mons))
+
+    def stop(self):
+        for cr in self.running.values():
+            cr.kill()
+        self.running = {}
+
+    async def _run(self, clock, mons):
+        edge = RisingEdge(clock)
+        while True:
+            await edge
+            for mon in mons:
+                if mon.trigger.fire():
+                    values = [f() for f in mon.fields]
+                    for sink in mon.sinks:
+                        sink.record(values)
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+"""
+Streaming pcap/pcapng replay and capture for the NIC testbenches
+"""
+
+import argparse
+import collections
+import ipaddress
+import mmap
+import struct
+import sys
+import zlib
+
+try:
+    from cocotb.triggers import Timer
+    from cocotb.utils import get_sim_time, get_sim_steps, get_time_from_sim_steps
+except ImportError:
+    Timer = None
+    get_sim_time = None
+    get_sim_steps = None
+    get_time_from_sim_steps = None
+
+
+LINKTYPE_ETHERNET = 1
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAP_HEADER = struct.Struct("<LHHlLLL")
+PCAP_RECORD = struct.Struct("<LLLL")
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPT_IF_TSRESOL = 9
+
+# preamble, SFD, FCS and inter-frame gap
+ETH_WIRE_OVERHEAD = 24
+
+ETH_TYPE_IPV4 = 0x0800
+ETH_TYPE_IPV6 = 0x86dd
+ETH_TYPE_VLAN = (0x8100, 0x88a8)
+
+# time_ns: capture timestamp, data: memoryview into the mapped file, orig_len: length on the wire
+PcapRecord = collections.namedtuple('PcapRecord', ['time_ns', 'data', 'orig_len', 'interface'])
+
+FlowKey = collections.namedtuple('FlowKey', ['src_mac', 'dst_mac', 'vlan', 'eth_type',
+    'src_ip', 'dst_ip', 'proto', 'sport', 'dport'])
+
+
+class PcapReader:
+    def __init__(self, path):
+        # the file is memory-mapped and records are yielded lazily as memoryview slices of the
+        # mapping, so traces far larger than RAM can be replayed; copy a record's data to keep
+        # it past close()
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise Exception("Empty capture file: %s" % path)
+        self.view = memoryview(self.map)
+
+        magic = self.map[0:4]
+        if struct.unpack("<L", magic)[0] == PCAPNG_SHB:
+            self.format = 'pcapng'
+            self.linktype = None
+        else:
+            for endian in "<>":
+                value, = struct.unpack(endian+"L", magic)
+                if value in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                    break
+            else:
+                self.close()
+                raise Exception("Not a pcap or pcapng file: %s" % path)
+            self.format = 'pcap'
+            self.endian = endian
+            self.ts_scale = 1 if value == PCAP_MAGIC_NS else 1000
+            _, _, _, _, _, self.snaplen, self.linktype = struct.unpack_from(endian+PCAP_HEADER.format[1:], self.map, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.map is None:
+            return
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # records still reference the mapping, it is unmapped once they are released
+            pass
+        self.file.close()
+        self.map = None
+
+    def __iter__(self):
+        if self.format == 'pcap':
+            return self._iter_pcap()
+        return self._iter_pcapng()
+
+    def _iter_pcap(self):
+        rec = struct.Struct(self.endian+PCAP_RECORD.format[1:])
+        view = self.view
+        offset = PCAP_HEADER.size
+        end = len(view)
+        scale = self.ts_scale
+
+        while offset + rec.size <= end:
+            ts_sec, ts_frac, caplen, orig_len = rec.unpack_from(view, offset)
+            offset += rec.size
+            if offset + caplen > end:
+                break
+            yield PcapRecord(ts_sec*1000000000 + ts_frac*scale, view[offset:offset+caplen], orig_len, 0)
+            offset += caplen
+
+    def _iter_pcapng(self):
+        view = self.view
+        offset = 0
+        end = len(view)
+        endian = "<"
+        # per-interface (link type, ns per timestamp unit)
+        interfaces = []
+        last_time = 0
+
+        while offset + 12 <= end:
+            block_type, = struct.unpack_from(endian+"L", view, offset)
+
+            if block_type == PCAPNG_SHB:
+                # each section header sets the byte order for its section
+                bom, = struct.unpack_from("<L", view, offset+8)
+                endian = "<" if bom == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                interfaces = []
+
+            block_len, = struct.unpack_from(endian+"L", view, offset+4)
+            if block_len < 12 or offset + block_len > end:
+                break
+            body = offset + 8
+
+            if block_type == PCAPNG_IDB:
+                linktype, = struct.unpack_from(endian+"H", view, body)
+                interfaces.append([linktype, self._pcapng_tsresol(view, body+8, offset+block_len-4, endian)])
+                if self.linktype is None:
+                    self.linktype = linktype
+            elif block_type == PCAPNG_EPB:
+                iface, ts_hi, ts_lo, caplen, orig_len = struct.unpack_from(endian+"LLLLL", view, body)
+                last_time = int(((ts_hi << 32) | ts_lo) * interfaces[iface][1])
+                yield PcapRecord(last_time, view[body+20:body+20+caplen], orig_len, iface)
+            elif block_type == PCAPNG_SPB:
+                # simple packets carry no timestamp, reuse the previous one
+                orig_len, = struct.unpack_from(endian+"L", view, body)
+                caplen = min(orig_len, block_len-16)
+                yield PcapRecord(last_time, view[body+4:body+4+caplen], orig_len, 0)
+
+            offset += block_len
+
+    @staticmethod
+    def _pcapng_tsresol(view, offset, end, endian):
+        # ns per timestamp unit, microseconds unless an if_tsresol option says otherwise
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(endian+"HH", view, offset)
+            if code == 0:
+                break
+            if code == PCAPNG_OPT_IF_TSRESOL:
+                res = view[offset+4]
+                if res & 0x80:
+                    return 1e9 / 2**(res & 0x7f)
+                return 1e9 / 10**res
+            offset += 4 + ((length + 3) & ~3)
+        return 1000
+
+
+class PcapWriter:
+    def __init__(self, path, snaplen=65535, linktype=LINKTYPE_ETHERNET, buffer_size=1 << 20):
+        # nanosecond-resolution classic pcap, written through a buffer as packets arrive
+        self.path = path
+        self.snaplen = snaplen
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(PCAP_HEADER.pack(PCAP_MAGIC_NS, 2, 4, 0, 0, snaplen, linktype))
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data, time_ns=None):
+        # timestamps default to the current sim time
+        if time_ns is None:
+            time_ns = get_sim_time('ns')
+        time_ns = int(time_ns)
+        orig_len = len(data)
+        caplen = min(orig_len, self.snaplen)
+        self.file.write(PCAP_RECORD.pack(time_ns // 1000000000, time_ns % 1000000000, caplen, orig_len))
+        self.file.write(data[:caplen])
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def parse_flow(data):
+    # Ethernet (with optional VLAN tags), IPv4/IPv6, TCP/UDP ports; missing layers are None
+    n = len(data)
+    if n < 14:
+        return FlowKey(None, None, None, None, None, None, None, None, None)
+
+    dst_mac = bytes(data[0:6])
+    src_mac = bytes(data[6:12])
+    eth_type, = struct.unpack_from(">H", data, 12)
+    offset = 14
+    vlan = None
+
+    while eth_type in ETH_TYPE_VLAN and offset + 4 <= n:
+        tci, eth_type = struct.unpack_from(">HH", data, offset)
+        if vlan is None:
+            vlan = tci & 0xfff
+        offset += 4
+
+    src_ip = dst_ip = proto = sport = dport = None
+
+    if eth_type == ETH_TYPE_IPV4 and offset + 20 <= n:
+        ihl = (data[offset] & 0xf) * 4
+        proto = data[offset+9]
+        src_ip = bytes(data[offset+12:offset+16])
+        dst_ip = bytes(data[offset+16:offset+20])
+        # ports are only present in the first fragment
+        frag, = struct.unpack_from(">H", data, offset+6)
+        offset = offset + ihl if not frag & 0x1fff else n
+    elif eth_type == ETH_TYPE_IPV6 and offset + 40 <= n:
+        proto = data[offset+6]
+        src_ip = bytes(data[offset+8:offset+24])
+        dst_ip = bytes(data[offset+24:offset+40])
+        offset += 40
+
+    if proto in (6, 17) and offset + 4 <= n:
+        sport, dport = struct.unpack_from(">HH", data, offset)
+
+    return FlowKey(src_mac, dst_mac, vlan, eth_type, src_ip, dst_ip, proto, sport, dport)
+
+
+def _mac_bytes(mac):
+    if isinstance(mac, bytes):
+        return mac
+    return bytes.fromhex(mac.replace(':', '').replace('-', ''))
+
+
+class FlowRule:
+    def __init__(self, target, src_mac=None, dst_mac=None, vlan=None, eth_type=None,
+            src_ip=None, dst_ip=None, proto=None, sport=None, dport=None):
+        # fields left as None match anything; IP fields take addresses or networks,
+        # ports take a single port or a (first, last) range
+        self.target = target
+        self.checks = []
+
+        for name, value in (('src_mac', src_mac), ('dst_mac', dst_mac)):
+            if value is not None:
+                self.checks.append((FlowKey._fields.index(name), lambda x, v=_mac_bytes(value): x == v))
+        for name, value in (('vlan', vlan), ('eth_type', eth_type), ('proto', proto)):
+            if value is not None:
+                self.checks.append((FlowKey._fields.index(name), lambda x, v=value: x == v))
+        for name, value in (('src_ip', src_ip), ('dst_ip', dst_ip)):
+            if value is not None:
+                net = ipaddress.ip_network(value, strict=False)
+                self.checks.append((FlowKey._fields.index(name),
+                    lambda x, net=net: x is not None and len(x) == net.max_prefixlen//8 and ipaddress.ip_address(x) in net))
+        for name, value in (('sport', sport), ('dport', dport)):
+            if value is not None:
+                lo, hi = value if isinstance(value, tuple) else (value, value)
+                self.checks.append((FlowKey._fields.index(name), lambda x, lo=lo, hi=hi: x is not None and lo <= x <= hi))
+
+    def match(self, key):
+        return all(check(key[index]) for index, check in self.checks)
+
+
+class FlowClassifier:
+    def __init__(self, rules=None, default=0, hash_targets=None):
+        # first matching rule wins; unmatched flows go to default, or are spread over
+        # hash_targets by a hash of the flow key so every flow sticks to one target
+        self.rules = list(rules or [])
+        self.default = default
+        self.hash_targets = hash_targets
+        # decisions are cached per flow, so rules are evaluated once per flow, not per packet
+        self.cache = {}
+
+    def add_rule(self, target, **fields):
+        self.rules.append(FlowRule(target, **fields))
+        self.cache.clear()
+
+    def classify_key(self, key):
+        target = self.cache.get(key)
+        if target is None:
+            for rule in self.rules:
+                if rule.match(key):
+                    target = rule.target
+                    break
+            else:
+                if self.hash_targets:
+                    h = zlib.crc32(repr(key[2:]).encode())
+                    target = self.hash_targets[h % len(self.hash_targets)]
+                else:
+                    target = self.default
+            self.cache[key] = target
+        return target
+
+    def classify(self, data):
+        return self.classify_key(parse_flow(data))
+
+
+def replay_schedule(records, speedup=1.0, rate_gbps=None, loop=1):
+    # yields (offset in ns from the start of the replay, record); capture timestamps are
+    # compressed by speedup, or with rate_gbps the packets are paced back to back at that
+    # line rate; records must be re-iterable (a PcapReader is) when loop > 1
+    t = 0.0
+    for k in range(loop):
+        first = None
+        base = t
+        for rec in records:
+            if rate_gbps:
+                yield t, rec
+                t += (len(rec.data) + ETH_WIRE_OVERHEAD) * 8 / rate_gbps
+            else:
+                if first is None:
+                    first = rec.time_ns
+                t = base + (rec.time_ns - first) / speedup
+                yield t, rec
+        if not rate_gbps and first is not None:
+            # next pass starts just after the last packet of this one
+            t += 1
+
+
+async def _wait_until(start, t_ns):
+    # absolute scheduling against sim time, so step rounding does not accumulate
+    steps = start + round(t_ns * get_sim_steps(1, 'ns')) - get_sim_time()
+    if steps > 0:
+        await Timer(steps, 'step')
+
+
+async def replay(records, send, classifier=None, speedup=1.0, rate_gbps=None, loop=1, count=None):
+    # calls send(data, target) for each record at its scheduled sim time, target comes from
+    # the classifier (None without one); returns the number of packets sent
+    start = get_sim_time()
+    sent = 0
+    for t, rec in replay_schedule(records, speedup, rate_gbps, loop):
+        if count is not None and sent >= count:
+            break
+        await _wait_until(start, t)
+        await send(rec.data, classifier.classify(rec.data) if classifier else None)
+        sent += 1
+    return sent
+
+
+async def replay_to_interfaces(records, interfaces, classifier=None, tx_ring=0, **kwargs):
+    # inject through the driver TX path; interfaces is indexed by the classifier target,
+    # e.g. one per VF driver
+    async def send(data, target):
+        await interfaces[target or 0].start_xmit(data, tx_ring)
+    return await replay(records, send, classifier, **kwargs)
+
+
+async def replay_to_macs(records, macs, classifier=None, **kwargs):
+    # inject on the wire through EthMac.rx, macs is indexed by the classifier target
+    async def send(data, target):
+        await macs[target or 0].rx.send(bytes(data))
+    return await replay(records, send, classifier, **kwargs)
+
+
+class PcapTap:
+    def __init__(self, sink, writer):
+        # wraps a frame source such as EthMac.tx and writes every frame received from it to
+        # writer, timestamped with the frame start time when the source provides it
+        self.sink = sink
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+    def _capture(self, frame):
+        if frame is not None:
+            t = getattr(frame, 'sim_time_sfd', None)
+            self.writer.write(bytes(frame), get_time_from_sim_steps(t, 'ns') if t else None)
+        return frame
+
+    async def recv(self, *args, **kwargs):
+        return self._capture(await self.sink.recv(*args, **kwargs))
+
+    def recv_nowait(self, *args, **kwargs):
+        return self._capture(self.sink.recv_nowait(*args, **kwargs))
+
+
+def tap_mac_tx(mac, writer):
+    # capture MAC TX output without changing how tests receive from mac.tx
+    mac.tx = PcapTap(mac.tx, writer)
+    return mac.tx
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('pcap', type=str, help="pcap or pcapng file")
+    parser.add_argument('-n', '--count', type=int, help="number of packets to list")
+
+    args = parser.parse_args()
+
+    try:
+        with PcapReader(args.pcap) as reader:
+            packets = 0
+            total = 0
+            first = last = None
+            flows = set()
+            for k, rec in enumerate(reader):
+                if args.count is not None and k < args.count:
+                    key = parse_flow(rec.data)
+                    print("%d ns len %d %s" % (rec.time_ns, rec.orig_len, key))
+                packets += 1
+                total += rec.orig_len
+                flows.add(parse_flow(rec.data)[2:])
+                if first is None:
+                    first = rec.time_ns
+                last = rec.time_ns
+                del rec
+
+            print("%s: %s, link type %s, %d packets, %d bytes, %d flows" % (args.pcap, reader.format, reader.linktype,
+                packets, total, len(flows)))
+            if packets > 1 and last > first:
+                print("duration %.6f s, average %.3f Gbps" % ((last-first)/1e9, total*8/(last-first)))
+    except IOError as ex:
+        print(ex)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import array
+import struct
+import zlib
+
+try:
+    from cocotb.utils import get_sim_time
+except ImportError:
+    get_sim_time = None
+
+from mqnic import Histogram
+
+
+# magic, source function, flow, sequence number, TX sim time in ns
+SCOREBOARD_MAGIC = 0x5342
+SCOREBOARD_TAG = struct.Struct("<HHHIQ")
+
+# Ethernet, IPv4 and UDP headers without options
+SCOREBOARD_TAG_OFFSET = 42
+
+SCOREBOARD_PATTERN = bytes(x % 256 for x in range(16384+256))
+
+
+class ScoreboardFlow:
+    def __init__(self, func, flow):
+        self.func = func
+        self.flow = flow
+
+        # per sequence number, indexed directly
+        self.crc = array.array('L')
+        self.length = array.array('L')
+        self.received = bytearray()
+
+        self.rx_count = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.corrupted = 0
+        self.max_seq = -1
+
+    @property
+    def sent(self):
+        return len(self.crc)
+
+    @property
+    def lost(self):
+        return self.sent - self.rx_count
+
+    def to_dict(self):
+        return {
+            'func': self.func,
+            'flow': self.flow,
+            'sent': self.sent,
+            'received': self.rx_count,
+            'lost': self.lost,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'corrupted': self.corrupted,
+        }
+
+
+class Scoreboard:
+    def __init__(self, tag_offset=SCOREBOARD_TAG_OFFSET):
+        # every payload starts with a tag, received frames are matched by looking the tag up
+        # at tag_offset, so checking is O(1) per packet regardless of how many are in flight
+        self.tag_offset = tag_offset
+        self.flows = {}
+        self.latency = {}
+        self.unknown = 0
+
+    def get_flow(self, func, flow):
+        f = self.flows.get((func, flow))
+        if f is None:
+            f = ScoreboardFlow(func, flow)
+            self.flows[(func, flow)] = f
+            if func not in self.latency:
+                self.latency[func] = Histogram()
+        return f
+
+    def make_payload(self, func, flow, length, tx_time=None):
+        # tagged payload of length bytes with the next sequence number of the flow; the
+        # expected contents are recorded as a CRC, so the payload itself is not kept
+        f = self.get_flow(func, flow)
+        seq = f.sent
+
+        if tx_time is None:
+            tx_time = get_sim_time('ns')
+
+        fill = length - SCOREBOARD_TAG.size
+        if fill < 0 or fill > len(SCOREBOARD_PATTERN) - 256:
+            raise Exception("Scoreboard payload length %d out of range" % length)
+
+        payload = SCOREBOARD_TAG.pack(SCOREBOARD_MAGIC, func, flow, seq, int(tx_time)) + \
+            SCOREBOARD_PATTERN[seq % 256:seq % 256 + fill]
+
+        f.crc.append(zlib.crc32(payload))
+        f.length.append(length)
+        f.received.append(0)
+        return payload
+
+    def receive(self, data, rx_time=None):
+        # returns the flow the frame belongs to, or None for frames without a valid tag
+        off = self.tag_offset
+        if len(data) < off + SCOREBOARD_TAG.size:
+            self.unknown += 1
+            return None
+
+        magic, func, flow, seq, tx_time = SCOREBOARD_TAG.unpack_from(data, off)
+        f = self.flows.get((func, flow))
+        if magic != SCOREBOARD_MAGIC or f is None or seq >= f.sent:
+            self.unknown += 1
+            return None
+
+        if f.received[seq]:
+            f.duplicates += 1
+            return f
+
+        f.received[seq] = 1
+        f.rx_count += 1
+
+        # arriving behind a later packet of the same flow; packets of different flows or
+        # queues may interleave freely, e.g. under the WRR scheduler
+        if seq < f.max_seq:
+            f.reordered += 1
+        else:
+            f.max_seq = seq
+
+        if zlib.crc32(data[off:off+f.length[seq]]) != f.crc[seq]:
+            f.corrupted += 1
+
+        if rx_time is None:
+            rx_time = get_sim_time('ns')
+        self.latency[func].add(rx_time - tx_time)
+
+        return f
+
+    def receive_many(self, pkts):
+        # mqnic Packets, latency measured to the driver handing them out
+        for pkt in pkts:
+            self.receive(pkt.data, pkt.rx_time)
+
+    def pending(self):
+        return sum(f.lost for f in self.flows.values())
+
+    def get_func_summary(self):
+        funcs = {}
+        for f in self.flows.values():
+            s = funcs.get(f.func)
+            if s is None:
+                s = {'func': f.func, 'flows': 0, 'sent': 0, 'received': 0, 'lost': 0, 'duplicates': 0,
+                    'reordered': 0, 'corrupted': 0}
+                funcs[f.func] = s
+            s['flows'] += 1
+            for key, value in f.to_dict().items():
+                if key not in ('func', 'flow'):
+                    s[key] += value
+
+        for func, s in funcs.items():
+            lat = self.latency[func]
+            s['latency_mean'] = lat.mean()
+            s['latency_p50'] = lat.percentile(50)
+            s['latency_p99'] = lat.percentile(99)
+            s['latency_max'] = lat.max
+
+        return [funcs[k] for k in sorted(funcs)]
+
+    def log_report(self, log):
+        for s in self.get_func_summary():
+            log.info("Scoreboard function %d: %d flows, %d/%d received, %d lost, %d duplicates, %d reordered, "
+                "%d corrupted, latency mean %.1f ns p50 %d ns p99 %d ns", s['func'], s['flows'], s['received'],
+                s['sent'], s['lost'], s['duplicates'], s['reordered'], s['corrupted'], s['latency_mean'],
+                s['latency_p50'], s['latency_p99'])
+
+        for f in self.flows.values():
+            if f.lost or f.duplicates or f.corrupted:
+                log.warning("Scoreboard function %d flow %d: %s", f.func, f.flow, f.to_dict())
+
+        if self.unknown:
+            log.warning("Scoreboard: %d frames without a valid tag", self.unknown)
+
+    def check(self, allow_loss=False, allow_reorder=True):
+        # reordering is expected across flows and only reported within one unless disallowed
+        errors = []
+        for f in self.flows.values():
+            if f.lost and not allow_loss:
+                errors.append("function %d flow %d lost %d of %d" % (f.func, f.flow, f.lost, f.sent))
+            if f.duplicates:
+                errors.append("function %d flow %d has %d duplicates" % (f.func, f.flow, f.duplicates))
+            if f.corrupted:
+                errors.append("function %d flow %d has %d corrupted packets" % (f.func, f.flow, f.corrupted))
+            if f.reordered and not allow_reorder:
+                errors.append("function %d flow %d has %d reordered packets" % (f.func, f.flow, f.reordered))
+        if self.unknown:
+            errors.append("%d frames without a valid tag" % self.unknown)
+        if errors:
+            raise Exception("Scoreboard check failed: " + "; ".join(errors))
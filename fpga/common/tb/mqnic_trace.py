@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+"""
+Decodes binary testbench traces recorded with TraceRecorder into text or CSV
+"""
+
+import argparse
+import csv
+import fnmatch
+import json
+import mmap
+import os
+import struct
+import sys
+
+try:
+    from cocotb.utils import get_sim_time, get_sim_steps
+except ImportError:
+    get_sim_time = None
+    get_sim_steps = None
+
+
+TRACE_MAGIC = b'MQTRACE1'
+TRACE_HEADER_SIZE = 65536
+
+# magic, header size, record size, capacity, records written, metadata length
+TRACE_HEADER = struct.Struct("<8sLLQQL")
+
+# sim time (steps), component, event, 8 unsigned fields
+TRACE_FIELDS = 8
+TRACE_RECORD = struct.Struct("<QHH4x%dQ" % TRACE_FIELDS)
+TRACE_PAD = (0,)*TRACE_FIELDS
+
+TRACE_EVENT_ALL = 2**64-1
+
+
+class TraceComponent:
+    def __init__(self, trace, index, name, events):
+        self.trace = trace
+        self.index = index
+        self.name = name
+        self.events = events
+
+        # bit n enables event type n
+        self.event_mask = 0
+        # record one in every sample events
+        self.sample = 1
+        self.sample_count = 0
+
+    def enabled(self, event=None):
+        if event is None:
+            return bool(self.event_mask)
+        return bool((self.event_mask >> event) & 1)
+
+    def record(self, event, *fields):
+        if not (self.event_mask >> event) & 1:
+            return
+
+        if self.sample > 1:
+            self.sample_count += 1
+            if self.sample_count < self.sample:
+                return
+            self.sample_count = 0
+
+        self.trace.write(self.index, event, fields)
+
+
+class TraceRecorder:
+    def __init__(self, path=None, capacity=1 << 20, enable=None, sample=None, time_func=None):
+        # records go into a preallocated ring, a memory-mapped file when a path is given,
+        # the oldest records are overwritten once capacity is reached
+        self.path = path
+        self.capacity = capacity
+        self.count = 0
+
+        self.components = []
+        self.component_map = {}
+
+        # (pattern, event mask) and (pattern, sample) rules applied to components as they register
+        self.enable_rules = []
+        self.sample_rules = []
+
+        # time_func returns the current time in steps, sim time by default
+        if time_func is None:
+            time_func = get_sim_time
+            steps_per_ns = get_sim_steps(1, 'ns') if capacity else 1
+        else:
+            steps_per_ns = 1
+        self.time_func = time_func
+        self.steps_per_ns = steps_per_ns
+
+        size = TRACE_HEADER_SIZE + capacity*TRACE_RECORD.size
+
+        self.file = None
+        if path:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+            self.buf = mmap.mmap(self.file.fileno(), size)
+        else:
+            self.buf = bytearray(size)
+
+        if enable:
+            self.set_enable(enable)
+        if sample:
+            self.set_sample(sample)
+
+        self.write_header()
+
+    @classmethod
+    def from_env(cls, prefix="MQNIC_TRACE"):
+        # MQNIC_TRACE="pattern[:mask],..." enables tracing, MQNIC_TRACE_FILE sets the output file
+        # (default mqnic.trace), MQNIC_TRACE_CAPACITY the ring size in records and
+        # MQNIC_TRACE_SAMPLE="pattern:n,..." the sampling
+        enable = os.getenv(prefix)
+        if not enable:
+            return cls(capacity=0)
+        return cls(os.getenv(prefix+"_FILE", "mqnic.trace"), int(os.getenv(prefix+"_CAPACITY", str(1 << 20))),
+            enable, os.getenv(prefix+"_SAMPLE"))
+
+    def component(self, name, events):
+        # events: list of (event name, field names), event type is the list index
+        comp = self.component_map.get(name)
+        if comp:
+            return comp
+
+        comp = TraceComponent(self, len(self.components), name, events)
+
+        if self.capacity:
+            for pattern, mask in self.enable_rules:
+                if fnmatch.fnmatchcase(name, pattern):
+                    comp.event_mask = mask
+            for pattern, sample in self.sample_rules:
+                if fnmatch.fnmatchcase(name, pattern):
+                    comp.sample = sample
+
+        self.components.append(comp)
+        self.component_map[name] = comp
+        return comp
+
+    def set_enable(self, rules, mask=TRACE_EVENT_ALL):
+        # rules: "pattern[:mask],..." or a single pattern with mask
+        for rule in rules.split(','):
+            pattern, _, m = rule.strip().partition(':')
+            m = int(m, 0) if m else mask
+            self.enable_rules.append((pattern, m))
+            for comp in self.components:
+                if self.capacity and fnmatch.fnmatchcase(comp.name, pattern):
+                    comp.event_mask = m
+
+    def set_sample(self, rules, sample=1):
+        for rule in rules.split(','):
+            pattern, _, n = rule.strip().partition(':')
+            n = int(n) if n else sample
+            self.sample_rules.append((pattern, n))
+            for comp in self.components:
+                if fnmatch.fnmatchcase(comp.name, pattern):
+                    comp.sample = n
+
+    def write(self, comp, event, fields):
+        TRACE_RECORD.pack_into(self.buf, TRACE_HEADER_SIZE + (self.count % self.capacity)*TRACE_RECORD.size,
+            self.time_func(), comp, event, *fields, *TRACE_PAD[len(fields):])
+        self.count += 1
+
+    def get_metadata(self):
+        return {
+            'steps_per_ns': self.steps_per_ns,
+            'components': [{'name': c.name, 'events': [[e, list(f)] for e, f in c.events]} for c in self.components],
+        }
+
+    def write_header(self):
+        meta = json.dumps(self.get_metadata()).encode()
+        if TRACE_HEADER.size + len(meta) > TRACE_HEADER_SIZE:
+            raise Exception("Trace metadata too large")
+        TRACE_HEADER.pack_into(self.buf, 0, TRACE_MAGIC, TRACE_HEADER_SIZE, TRACE_RECORD.size,
+            self.capacity, self.count, len(meta))
+        self.buf[TRACE_HEADER.size:TRACE_HEADER.size+len(meta)] = meta
+
+    def flush(self):
+        self.write_header()
+        if self.file:
+            self.buf.flush()
+
+    def save(self, path):
+        # write an in-memory trace out, trimmed to the records actually written
+        self.write_header()
+        with open(path, 'wb') as f:
+            f.write(self.buf[:TRACE_HEADER_SIZE + min(self.count, self.capacity)*TRACE_RECORD.size])
+
+    def close(self):
+        self.flush()
+        if self.file:
+            self.buf.close()
+            self.file.close()
+            self.file = None
+
+
+class TraceReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+
+        magic, header_size, record_size, self.capacity, self.count, meta_len = TRACE_HEADER.unpack_from(self.data, 0)
+
+        if magic != TRACE_MAGIC:
+            raise Exception("Not a trace file: %s" % path)
+        if record_size != TRACE_RECORD.size:
+            raise Exception("Unsupported trace record size %d" % record_size)
+
+        self.header_size = header_size
+
+        meta = json.loads(self.data[TRACE_HEADER.size:TRACE_HEADER.size+meta_len])
+        self.steps_per_ns = meta['steps_per_ns']
+        self.components = [(c['name'], c['events']) for c in meta['components']]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __iter__(self):
+        # oldest record first, accounting for ring wrap
+        n = len(self)
+        start = self.count - n
+        for k in range(start, start+n):
+            yield TRACE_RECORD.unpack_from(self.data, self.header_size + (k % self.capacity)*TRACE_RECORD.size)
+
+    def decode(self, component=None, event=None):
+        # yields (time in ns, component name, event name, [(field name, value)])
+        for t, comp, ev, *fields in self:
+            name, events = self.components[comp]
+            if component and not fnmatch.fnmatchcase(name, component):
+                continue
+            ev_name, field_names = events[ev]
+            if event and ev_name != event:
+                continue
+            yield t / self.steps_per_ns, name, ev_name, list(zip(field_names, fields))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('trace', type=str, help="trace file")
+    parser.add_argument('-f', '--format', type=str, default='text', choices=['text', 'csv'], help="output format")
+    parser.add_argument('-c', '--component', type=str, help="component name pattern")
+    parser.add_argument('-e', '--event', type=str, help="event name")
+    parser.add_argument('-o', '--output', type=str, help="output file name")
+
+    args = parser.parse_args()
+
+    try:
+        reader = TraceReader(args.trace)
+        f = open(args.output, 'w', newline='') if args.output else sys.stdout
+
+        try:
+            if args.format == 'csv':
+                w = csv.writer(f)
+                w.writerow(['time_ns', 'component', 'event'] + [x % k for k in range(TRACE_FIELDS) for x in ('field%d', 'value%d')])
+                for t, comp, ev, fields in reader.decode(args.component, args.event):
+                    w.writerow([t, comp, ev] + [x for field in fields for x in field])
+            else:
+                for t, comp, ev, fields in reader.decode(args.component, args.event):
+                    f.write("%.3f ns %s %s %s\n" % (t, comp, ev, ' '.join("%s=%d" % x for x in fields)))
+        finally:
+            if f is not sys.stdout:
+                f.close()
+    except IOError as ex:
+        print(ex)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import ipaddress
+import os
+import struct
+import sys
+
+import pytest
+
+try:
+    import mqnic_pcap
+except ImportError:
+    # attempt import from current directory
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
+    try:
+        import mqnic_pcap
+    finally:
+        del sys.path[0]
+
+
+def mac(s):
+    return bytes.fromhex(s.replace(':', ''))
+
+
+def udp4_frame(src_ip='192.168.1.100', dst_ip='192.168.1.101', sport=1, dport=2, payload=b'', vlan=None, frag=0):
+    ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 28+len(payload), 0, frag, 64, 17, 0,
+        ipaddress.ip_address(src_ip).packed, ipaddress.ip_address(dst_ip).packed)
+    udp = struct.pack(">HHHH", sport, dport, 8+len(payload), 0)
+    tag = struct.pack(">HH", 0x8100, vlan) if vlan is not None else b''
+    return mac('da:d1:d2:d3:d4:00') + mac('5a:51:52:53:54:55') + tag + struct.pack(">H", 0x0800) + ip + udp + payload
+
+
+def tcp6_frame(src_ip='fd00::1', dst_ip='fd00::2', sport=1000, dport=80):
+    ip = struct.pack(">LHBB16s16s", 0x60000000, 20, 6, 64,
+        ipaddress.ip_address(src_ip).packed, ipaddress.ip_address(dst_ip).packed)
+    tcp = struct.pack(">HHLLHHHH", sport, dport, 0, 0, 0x5000, 0, 0, 0)
+    return mac('da:d1:d2:d3:d4:00') + mac('5a:51:52:53:54:55') + struct.pack(">H", 0x86dd) + ip + tcp
+
+
+def pcapng_block(block_type, body, endian="<"):
+    body += bytes(-len(body) % 4)
+    return struct.pack(endian+"LL", block_type, len(body)+12) + body + struct.pack(endian+"L", len(body)+12)
+
+
+def write_pcapng(path, packets, endian="<", tsresol=None):
+    # packets: (timestamp in interface units or None for a simple packet block, data)
+    with open(path, 'wb') as f:
+        f.write(pcapng_block(mqnic_pcap.PCAPNG_SHB, struct.pack(endian+"LHHq", mqnic_pcap.PCAPNG_BYTE_ORDER_MAGIC,
+            1, 0, -1), endian))
+        opts = b''
+        if tsresol is not None:
+            opts = struct.pack(endian+"HH", mqnic_pcap.PCAPNG_OPT_IF_TSRESOL, 1) + bytes([tsresol, 0, 0, 0]) + bytes(4)
+        f.write(pcapng_block(mqnic_pcap.PCAPNG_IDB, struct.pack(endian+"HHL", mqnic_pcap.LINKTYPE_ETHERNET, 0, 0) + opts,
+            endian))
+        for ts, data in packets:
+            if ts is None:
+                f.write(pcapng_block(mqnic_pcap.PCAPNG_SPB, struct.pack(endian+"L", len(data)) + data, endian))
+            else:
+                f.write(pcapng_block(mqnic_pcap.PCAPNG_EPB, struct.pack(endian+"LLLLL", 0, ts >> 32, ts & 0xffffffff,
+                    len(data), len(data)) + data, endian))
+
+
+def read_all(path):
+    with mqnic_pcap.PcapReader(path) as reader:
+        records = [(rec.time_ns, bytes(rec.data), rec.orig_len) for rec in reader]
+        return reader.format, reader.linktype, records
+
+
+def test_pcap_round_trip(tmp_path):
+    path = str(tmp_path / "trace.pcap")
+    frames = [udp4_frame(sport=k, payload=bytes([k])*k) for k in range(1, 20)]
+
+    with mqnic_pcap.PcapWriter(path) as writer:
+        for k, frame in enumerate(frames):
+            writer.write(frame, 1500000000 + 1234*k)
+
+    fmt, linktype, records = read_all(path)
+    assert fmt == 'pcap'
+    assert linktype == mqnic_pcap.LINKTYPE_ETHERNET
+    assert records == [(1500000000 + 1234*k, frame, len(frame)) for k, frame in enumerate(frames)]
+
+
+def test_pcap_snaplen(tmp_path):
+    path = str(tmp_path / "trace.pcap")
+    frame = udp4_frame(payload=bytes(200))
+
+    with mqnic_pcap.PcapWriter(path, snaplen=64) as writer:
+        writer.write(frame, 0)
+
+    fmt, linktype, records = read_all(path)
+    assert records == [(0, frame[:64], len(frame))]
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_pcap_us_timestamps(tmp_path, endian):
+    path = str(tmp_path / "trace.pcap")
+    frame = udp4_frame()
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack(endian+"LHHlLLL", mqnic_pcap.PCAP_MAGIC_US, 2, 4, 0, 0, 65535, mqnic_pcap.LINKTYPE_ETHERNET))
+        f.write(struct.pack(endian+"LLLL", 3, 250, len(frame), len(frame)) + frame)
+
+    fmt, linktype, records = read_all(path)
+    assert records == [(3000250000, frame, len(frame))]
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_pcapng_round_trip(tmp_path, endian):
+    path = str(tmp_path / "trace.pcapng")
+    frames = [udp4_frame(sport=k) for k in range(4)]
+
+    write_pcapng(path, [(10, frames[0]), (25, frames[1]), (None, frames[2]), ((1 << 32) + 7, frames[3])], endian)
+
+    fmt, linktype, records = read_all(path)
+    assert fmt == 'pcapng'
+    assert linktype == mqnic_pcap.LINKTYPE_ETHERNET
+    # microsecond units by default, simple packets reuse the previous timestamp
+    assert records == [
+        (10000, frames[0], len(frames[0])),
+        (25000, frames[1], len(frames[1])),
+        (25000, frames[2], len(frames[2])),
+        (((1 << 32) + 7) * 1000, frames[3], len(frames[3])),
+    ]
+
+
+def test_pcapng_tsresol(tmp_path):
+    path = str(tmp_path / "trace.pcapng")
+    frame = udp4_frame()
+
+    write_pcapng(path, [(123456789, frame)], tsresol=9)
+
+    fmt, linktype, records = read_all(path)
+    assert records == [(123456789, frame, len(frame))]
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / "trace.pcap"
+    path.write_bytes(bytes(64))
+
+    with pytest.raises(Exception):
+        mqnic_pcap.PcapReader(str(path))
+
+
+def test_parse_flow():
+    key = mqnic_pcap.parse_flow(udp4_frame(sport=1234, dport=80, vlan=5))
+    assert key.vlan == 5
+    assert key.eth_type == mqnic_pcap.ETH_TYPE_IPV4
+    assert key.src_ip == ipaddress.ip_address('192.168.1.100').packed
+    assert (key.proto, key.sport, key.dport) == (17, 1234, 80)
+
+    key = mqnic_pcap.parse_flow(tcp6_frame())
+    assert key.eth_type == mqnic_pcap.ETH_TYPE_IPV6
+    assert key.dst_ip == ipaddress.ip_address('fd00::2').packed
+    assert (key.proto, key.sport, key.dport) == (6, 1000, 80)
+
+    # later fragments carry no ports
+    key = mqnic_pcap.parse_flow(udp4_frame(frag=100))
+    assert key.proto == 17
+    assert key.sport is None and key.dport is None
+
+    assert mqnic_pcap.parse_flow(bytes(10)) == mqnic_pcap.FlowKey(*[None]*9)
+
+
+def test_classifier_rules():
+    classifier = mqnic_pcap.FlowClassifier(default=9)
+    classifier.add_rule(1, dst_ip='192.168.1.0/24', dport=(1000, 1999))
+    classifier.add_rule(2, src_mac='5a:51:52:53:54:55', proto=17)
+    classifier.add_rule(3, dst_ip='fd00::/64')
+
+    # first matching rule wins
+    assert classifier.classify(udp4_frame(dport=1500)) == 1
+    assert classifier.classify(udp4_frame(dport=2000)) == 2
+    assert classifier.classify(tcp6_frame()) == 3
+    assert classifier.classify(tcp6_frame(dst_ip='fd01::2')) == 9
+
+    # decisions are cached per flow and dropped when the rules change
+    assert len(classifier.cache) == 4
+    classifier.add_rule(4)
+    assert not classifier.cache
+
+
+def test_classifier_hash():
+    classifier = mqnic_pcap.FlowClassifier(hash_targets=[0, 1, 2, 3])
+
+    targets = {}
+    for k in range(64):
+        frame = udp4_frame(sport=k)
+        targets[k] = classifier.classify(frame)
+        # every packet of a flow goes to the same target
+        assert classifier.classify(udp4_frame(sport=k, payload=b'x')) == targets[k]
+
+    assert set(targets.values()) == {0, 1, 2, 3}
+
+
+def records(times, length=100):
+    return [mqnic_pcap.PcapRecord(t, bytes(length), length, 0) for t in times]
+
+
+def test_replay_schedule_speedup():
+    recs = records([1000, 3000, 7000])
+
+    assert [t for t, rec in mqnic_pcap.replay_schedule(recs)] == [0, 2000, 6000]
+    assert [t for t, rec in mqnic_pcap.replay_schedule(recs, speedup=2)] == [0, 1000, 3000]
+
+
+def test_replay_schedule_rate():
+    recs = records([0, 0, 0], length=101)
+
+    # 125 wire bytes per packet at 10 Gbps is 100 ns
+    assert [t for t, rec in mqnic_pcap.replay_schedule(recs, rate_gbps=10)] == [0, 100, 200]
+
+
+def test_replay_schedule_loop():
+    recs = records([500, 1500])
+
+    schedule = list(mqnic_pcap.replay_schedule(recs, loop=3))
+    assert [t for t, rec in schedule] == [0, 1000, 1001, 2001, 2002, 3002]
+    assert [rec for t, rec in schedule] == recs*3
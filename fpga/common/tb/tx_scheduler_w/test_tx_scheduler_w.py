@@ -2,8 +2,6 @@ import logging
 import os
 import math
 import random 
-import matplotlib.pyplot as plt 
-from matplotlib.patches import Patch
 
 import numpy as np
 
@@ -14,6 +12,7 @@ import logging
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
 from cocotb.regression import TestFactory
+from cocotb.utils import get_sim_time
 
 import cocotb_test.simulator
 import pytest
@@ -21,6 +20,11 @@ import pytest
 from cocotbext.axi import AxiLiteBus, AxiLiteMaster
 from cocotbext.axi.stream import define_stream
 
+from tx_scheduler_w_model import TxSchedulerWModel, TxSchedulerWScoreboard, expected_transmit_counts
+from tx_scheduler_w_metrics import TxSchedulerWMetrics, wrr_max_gap
+from tx_scheduler_w_trace import TxSchedulerWTrace
+from tx_scheduler_w_responder import TxEngineResponder, completion_exponential, line_rate_decisions_per_cycle
+
 # axis stream slave interface, doorbell input
 DoorbellBus, DoorbellTransaction, DoorbellSource, DoorbellSink, DoorbellMonitor = define_stream("Doorbell", signals=["queue","func", "valid"], optional_signals=["ready"])
 
@@ -38,7 +42,7 @@ class TB(object):
 
         self.log = logging.getLogger("cocotb.tb")
 
-        cocotb.start_soon(Clock(dut.clk, 4, units="ns").start())
+        cocotb.start_soon(Clock(dut.clk, CLK_PERIOD_NS, units="ns").start())
 
         # set an axil master
         self.axil_master = AxiLiteMaster(AxiLiteBus.from_prefix(dut, "s_axil"),dut.clk, dut.rst)
@@ -73,6 +77,8 @@ class TB(object):
 
 
 
+CLK_PERIOD_NS = 4
+
 QUEUE_ENABLED_QUEUE_STATE = 0x01
 QUEUE_DISABLED_QUEUE_STATE = 0x0
 FUNC_ENABLED_FUNC_STATE = 0x01
@@ -80,7 +86,65 @@ QUEUE_SCHED_ACTIVE_STATE = 0x01010000
 QUEUE_EN_SCHED_ACTIVE_STATE = 0x01010001
 
 
-# plots actual # transmits per queue and func vs expected. (func will pop up first, then queue after closing the figure)
+def queues_per_func(queue_count, num_funcs):
+     # the scheduler maps a queue to its func by shifting, with NUM_FUNCS rounded up to a power of 2
+     return queue_count >> (num_funcs-1).bit_length()
+
+def random_weights(n, low=1, high=255):
+     return [random.randint(low, high) for i in range(n)]
+
+async def axil_write_burst(tb, writes):
+     # all writes issued back to back, then wait for every response
+     events = [tb.axil_master.init_write(addr, data.to_bytes(4, 'little')) for addr, data in writes]
+     for event in events:
+          await event.wait()
+
+async def axil_read_burst(tb, addrs):
+     events = [tb.axil_master.init_read(addr, 4) for addr in addrs]
+     values = []
+     for event in events:
+          await event.wait()
+          values.append(int.from_bytes(event.data.data, 'little'))
+     return values
+
+async def configure_scheduler(tb, queue_weight_list, func_weight_list, queues=None, funcs=None,
+          queue_state=QUEUE_ENABLED_QUEUE_STATE, func_state=FUNC_ENABLED_FUNC_STATE, verify=True):
+     dut = tb.dut
+     queue_count = dut.QUEUE_COUNT.value
+     max_num_funcs = dut.MAX_NUM_FUNCS.value
+
+     if queues is None:
+          queues = range(len(queue_weight_list))
+     if funcs is None:
+          funcs = range(len(func_weight_list))
+
+     func_start_addr = queue_count*4
+     queue_weight_start_addr = func_start_addr + max_num_funcs*4
+     func_ram_start_addr = queue_weight_start_addr + queue_count*4
+
+     # (writes, mask of the bits read back) per region, in the order the tests always used
+     regions = [
+          ([(q*4, queue_state) for q in queues], 0x3),
+          ([(func_start_addr + f*4, w) for f, w in enumerate(func_weight_list)], 0xff),
+          ([(queue_weight_start_addr + q*4, w) for q, w in enumerate(queue_weight_list)], 0xff),
+          ([(func_ram_start_addr + f*4, func_state) for f in funcs], 0x3),
+     ]
+
+     # the scheduler decodes which ram a write or read completes to from the address on the bus
+     # at that time, so bursts must not cross into the next region before they drain
+     for writes, mask in regions:
+          await axil_write_burst(tb, writes)
+
+     if verify:
+          for writes, mask in regions:
+               values = await axil_read_burst(tb, [addr for addr, data in writes])
+               for (addr, data), value in zip(writes, values):
+                    assert value & mask == data & mask, f"readback of 0x{addr:x}: 0x{value:x} != 0x{data:x}"
+
+# Each test records a transmit trace (see tx_scheduler_w_trace.py) under traces/ or $TX_SCHED_TRACE_DIR,
+# plot them afterwards with tx_scheduler_w_plot.py (--show for the figures, otherwise an HTML report).
+
+# plots actual # transmits per queue and func vs expected.
 # note that there may be slight gaps between expected vs actual depending on how evenly the num_packets is divided by the various weights.
 # running time: ~10 minutes
 # note, the weights are displayed under each func/queue's bar in parentheses
@@ -98,56 +162,30 @@ async def basic_bar_test(dut):
 
      await RisingEdge(dut.clk)
 
-     num_queues = dut.QUEUE_COUNT.value
      num_funcs = dut.NUM_FUNCS.value
+     # queues past the last func's block are unused when NUM_FUNCS is not a power of 2
+     num_queues = num_funcs*queues_per_func(dut.QUEUE_COUNT.value, num_funcs)
 
-     # enable all queues, read back enabled
-        # parameters = {}
-     for i in range(num_queues):
-          await tb.axil_master.write_dword((i*4), QUEUE_ENABLED_QUEUE_STATE)
-          assert await tb.axil_master.read_dword(i*4)== QUEUE_ENABLED_QUEUE_STATE
-    
-     func_start_addr = (num_queues)*4
-     func_end_addr = func_start_addr + ((dut.MAX_NUM_FUNCS.value)*4)
-
-     queue_weight_start_addr = func_end_addr
-     queue_weight_end_addr = queue_weight_start_addr + ((num_queues)*4)
-
-     func_ram_start_addr = queue_weight_end_addr
-     func_ram_end_addr = func_ram_start_addr + ((num_funcs)*4)
-
-     
-     queue_weight_list = []
-     func_weight_list = []
-
-     for i in range(num_queues):
-          queue_weight_list.append(random.randint(1,255))
-
-     for i in range(num_funcs):
-          func_weight_list.append(random.randint(1,255))
+     queue_weight_list = random_weights(num_queues)
+     func_weight_list = random_weights(num_funcs)
 
-     # write and read to func weights
-     for i in range(func_start_addr, func_start_addr+(num_funcs*4), 4):
-          func_id  = int((i/4)-dut.QUEUE_COUNT.value)
-          await tb.axil_master.write_dword(i, func_weight_list[func_id])
-          assert await tb.axil_master.read_dword(i) ==  func_weight_list[func_id]
-
-     # write and read to queue weights
-     for i in range(queue_weight_start_addr, queue_weight_end_addr, 4):
-          queue_id = int((i/4)-(dut.QUEUE_COUNT.value+dut.MAX_NUM_FUNCS.value))
-          await tb.axil_master.write_dword(i, queue_weight_list[queue_id])
-          assert await tb.axil_master.read_dword(i) == queue_weight_list[queue_id]
-
-     # enable all funcs, read back enabled
-     for i in range(func_ram_start_addr, func_ram_end_addr, 4):
-          await tb.axil_master.write_dword(i, FUNC_ENABLED_FUNC_STATE)
-          assert await tb.axil_master.read_dword(i) == FUNC_ENABLED_FUNC_STATE
+     # enable all queues and funcs and write the weights, read back at the end
+     await configure_scheduler(tb, queue_weight_list, func_weight_list)
 
      num_queues_per_func = num_queues/num_funcs
 
+     # reference model with the same configuration, follows the DUT request by request
+     model = TxSchedulerWModel(num_queues, num_funcs, op_table_size=dut.OP_TABLE_SIZE.value)
+     model.set_func_weights(func_weight_list)
+     model.set_queue_weights(queue_weight_list)
+     model.enable_queues(range(num_queues))
+     model.enable_funcs(range(num_funcs))
+     scoreboard = TxSchedulerWScoreboard(model, tb.log)
+
      # send doorbell reqeusts for all queues
      for i in range(num_queues):
           await tb.doorbell_source.send(DoorbellTransaction(queue = i, func=int(math.floor((i/num_queues_per_func)))))
+          scoreboard.doorbell(i, int(math.floor((i/num_queues_per_func))))
 
      fixed_val = []
      for i in range(num_funcs):
@@ -156,13 +194,14 @@ async def basic_bar_test(dut):
      num_packets = 35000
 
      func_expected_list, queue_expected_list= get_expected_transmit_nums(num_packets, func_weight_list, queue_weight_list, num_queues_per_func)
-     func_actual_list, queue_actual_list = await get_actual_transmit_nums_bar(dut, num_packets, num_funcs, num_queues)
-     
-     # plot packets per func
-     plot_bars(num_funcs, num_queues, func_expected_list, func_actual_list, 1, func_weight_list)
+     trace = new_trace(dut, "basic_bar", num_funcs, num_queues, func_weight_list, queue_weight_list)
+     func_actual_list, queue_actual_list = await get_actual_transmit_nums_bar(dut, num_packets, num_funcs, num_queues, scoreboard, trace)
+     save_trace(trace, func_expected=func_expected_list, queue_expected=queue_expected_list)
 
-     # plot packets per queue
-     plot_bars(num_funcs, num_queues, queue_expected_list, queue_actual_list, 0, queue_weight_list)
+     # the DUT may serve a few requests before all doorbells are in, so allow one turn of
+     # each level plus a full op table of deviation from the model
+     scoreboard.log_report()
+     scoreboard.check(max(func_weight_list)+16, max(func_weight_list)+max(queue_weight_list)+16)
 
 # in beginning, only send doorbell for even-indexed queues
 # halfway through the transmits, activate the rest of the queues by sending doorbells
@@ -184,50 +223,15 @@ async def doorbell1_test(dut):
 
      await RisingEdge(dut.clk)
 
-     num_queues = dut.QUEUE_COUNT.value
      num_funcs = dut.NUM_FUNCS.value
+     # queues past the last func's block are unused when NUM_FUNCS is not a power of 2
+     num_queues = num_funcs*queues_per_func(dut.QUEUE_COUNT.value, num_funcs)
 
-     # enable all queues, read back enabled
-        # parameters = {}
-     for i in range(num_queues):
-          await tb.axil_master.write_dword((i*4), QUEUE_ENABLED_QUEUE_STATE)
-          assert await tb.axil_master.read_dword(i*4)== QUEUE_ENABLED_QUEUE_STATE
-    
-     func_start_addr = (num_queues)*4
-     func_end_addr = func_start_addr + ((dut.MAX_NUM_FUNCS.value)*4)
-
-     queue_weight_start_addr = func_end_addr
-     queue_weight_end_addr = queue_weight_start_addr + ((num_queues)*4)
-
-     func_ram_start_addr = queue_weight_end_addr
-     func_ram_end_addr = func_ram_start_addr + ((num_funcs)*4)
-
-     
-     queue_weight_list = []
-     func_weight_list = []
-
-     for i in range(num_queues):
-          queue_weight_list.append(random.randint(1,255))
-
-     for i in range(num_funcs):
-          func_weight_list.append(random.randint(1,255))
-
-     # write and read to func weights
-     for i in range(func_start_addr, func_start_addr+(num_funcs*4), 4):
-          func_id  = int((i/4)-dut.QUEUE_COUNT.value)
-          await tb.axil_master.write_dword(i, func_weight_list[func_id])
-          assert await tb.axil_master.read_dword(i) ==  func_weight_list[func_id]
+     queue_weight_list = random_weights(num_queues)
+     func_weight_list = random_weights(num_funcs)
 
-     # write and read to queue weights
-     for i in range(queue_weight_start_addr, queue_weight_end_addr, 4):
-          queue_id = int((i/4)-(dut.QUEUE_COUNT.value+dut.MAX_NUM_FUNCS.value))
-          await tb.axil_master.write_dword(i, queue_weight_list[queue_id])
-          assert await tb.axil_master.read_dword(i) == queue_weight_list[queue_id]
-
-     # enable all funcs, read back enabled
-     for i in range(func_ram_start_addr, func_ram_end_addr, 4):
-          await tb.axil_master.write_dword(i, FUNC_ENABLED_FUNC_STATE)
-          assert await tb.axil_master.read_dword(i) == FUNC_ENABLED_FUNC_STATE
+     # enable all queues and funcs and write the weights, read back at the end
+     await configure_scheduler(tb, queue_weight_list, func_weight_list)
 
      num_queues_per_func = num_queues/num_funcs
 
@@ -243,13 +247,9 @@ async def doorbell1_test(dut):
      num_packets = 50000
 
      func_expected_list, queue_expected_list= get_expected_transmit_nums(num_packets, func_weight_list, queue_weight_list, num_queues_per_func)
-     func_actual_list, queue_actual_list = await get_actual_transmit_nums_doorbell1(dut, num_packets, num_funcs, num_queues)
-     
-     # plot packets per func
-     plot_bars(num_funcs, num_queues, func_expected_list, func_actual_list, 1, func_weight_list)
-
-     # plot packets per queue
-     plot_bars(num_funcs, num_queues, queue_expected_list, queue_actual_list, 0, queue_weight_list)
+     trace = new_trace(dut, "doorbell1", num_funcs, num_queues, func_weight_list, queue_weight_list)
+     func_actual_list, queue_actual_list = await get_actual_transmit_nums_doorbell1(dut, num_packets, num_funcs, num_queues, trace)
+     save_trace(trace, func_expected=func_expected_list, queue_expected=queue_expected_list)
 
 
 # Initially, first queue of each func is activeted (doorbells only sent for these).
@@ -272,49 +272,15 @@ async def doorbell3_test(dut):
 
      await RisingEdge(dut.clk)
 
-     num_queues = dut.QUEUE_COUNT.value
      num_funcs = dut.NUM_FUNCS.value
+     # queues past the last func's block are unused when NUM_FUNCS is not a power of 2
+     num_queues = num_funcs*queues_per_func(dut.QUEUE_COUNT.value, num_funcs)
 
-     # enable all queues, read back enabled
-     for i in range(num_queues):
-          await tb.axil_master.write_dword((i*4), QUEUE_ENABLED_QUEUE_STATE)
-          assert await tb.axil_master.read_dword(i*4)== QUEUE_ENABLED_QUEUE_STATE
-    
-     func_start_addr = (num_queues)*4
-     func_end_addr = func_start_addr + ((dut.MAX_NUM_FUNCS.value)*4)
-
-     queue_weight_start_addr = func_end_addr
-     queue_weight_end_addr = queue_weight_start_addr + ((num_queues)*4)
-
-     func_ram_start_addr = queue_weight_end_addr
-     func_ram_end_addr = func_ram_start_addr + ((num_funcs)*4)
-
-     
-     queue_weight_list = []
-     func_weight_list = []
-
-     for i in range(num_queues):
-          queue_weight_list.append(random.randint(1,255))
+     queue_weight_list = random_weights(num_queues)
+     func_weight_list = random_weights(num_funcs)
 
-     for i in range(num_funcs):
-          func_weight_list.append(random.randint(1,255))
-
-     # write and read to func weights
-     for i in range(func_start_addr, func_start_addr+(num_funcs*4), 4):
-          func_id  = int((i/4)-dut.QUEUE_COUNT.value)
-          await tb.axil_master.write_dword(i, func_weight_list[func_id])
-          assert await tb.axil_master.read_dword(i) ==  func_weight_list[func_id]
-
-     # write and read to queue weights
-     for i in range(queue_weight_start_addr, queue_weight_end_addr, 4):
-          queue_id = int((i/4)-(dut.QUEUE_COUNT.value+dut.MAX_NUM_FUNCS.value))
-          await tb.axil_master.write_dword(i, queue_weight_list[queue_id])
-          assert await tb.axil_master.read_dword(i) == queue_weight_list[queue_id]
-
-     # enable all funcs, read back enabled
-     for i in range(func_ram_start_addr, func_ram_end_addr, 4):
-          await tb.axil_master.write_dword(i, FUNC_ENABLED_FUNC_STATE)
-          assert await tb.axil_master.read_dword(i) == FUNC_ENABLED_FUNC_STATE
+     # enable all queues and funcs and write the weights, read back at the end
+     await configure_scheduler(tb, queue_weight_list, func_weight_list)
 
      num_queues_per_func = num_queues/num_funcs
 
@@ -326,13 +292,9 @@ async def doorbell3_test(dut):
      num_packets = 75000
 
      func_expected_list, queue_expected_list= get_expected_transmit_nums(num_packets, func_weight_list, queue_weight_list, num_queues_per_func)
-     func_actual_list, queue_actual_list = await get_actual_transmit_nums_doorbell3(dut, num_packets, num_funcs, num_queues)
-     
-     # plot packets per func
-     plot_bars(num_funcs, num_queues, func_expected_list, func_actual_list, 1, func_weight_list)
-
-     # plot packets per queue
-     plot_bars(num_funcs, num_queues, queue_expected_list, queue_actual_list, 0, queue_weight_list)
+     trace = new_trace(dut, "doorbell3", num_funcs, num_queues, func_weight_list, queue_weight_list)
+     func_actual_list, queue_actual_list = await get_actual_transmit_nums_doorbell3(dut, num_packets, num_funcs, num_queues, trace)
+     save_trace(trace, func_expected=func_expected_list, queue_expected=queue_expected_list)
 
 # For first half of packets transmitted, for (num_queues/2) equally spaced times, picks a random queue
 # in op_table_queue to force inactive (via failed transmit status responses).
@@ -354,49 +316,15 @@ async def inactive1_test(dut):
 
      await RisingEdge(dut.clk)
 
-     num_queues = dut.QUEUE_COUNT.value
      num_funcs = dut.NUM_FUNCS.value
+     # queues past the last func's block are unused when NUM_FUNCS is not a power of 2
+     num_queues = num_funcs*queues_per_func(dut.QUEUE_COUNT.value, num_funcs)
 
-     # enable all queues, read back enabled
-     for i in range(num_queues):
-          await tb.axil_master.write_dword((i*4), QUEUE_ENABLED_QUEUE_STATE)
-          assert await tb.axil_master.read_dword(i*4)== QUEUE_ENABLED_QUEUE_STATE
-    
-     func_start_addr = (num_queues)*4
-     func_end_addr = func_start_addr + ((dut.MAX_NUM_FUNCS.value)*4)
+     queue_weight_list = random_weights(num_queues)
+     func_weight_list = random_weights(num_funcs)
 
-     queue_weight_start_addr = func_end_addr
-     queue_weight_end_addr = queue_weight_start_addr + ((num_queues)*4)
-
-     func_ram_start_addr = queue_weight_end_addr
-     func_ram_end_addr = func_ram_start_addr + ((num_funcs)*4)
-
-     
-     queue_weight_list = []
-     func_weight_list = []
-
-     for i in range(num_queues):
-          queue_weight_list.append(random.randint(1,255))
-
-     for i in range(num_funcs):
-          func_weight_list.append(random.randint(1,255))
-
-     # write and read to func weights
-     for i in range(func_start_addr, func_start_addr+(num_funcs*4), 4):
-          func_id  = int((i/4)-dut.QUEUE_COUNT.value)
-          await tb.axil_master.write_dword(i, func_weight_list[func_id])
-          assert await tb.axil_master.read_dword(i) ==  func_weight_list[func_id]
-
-     # write and read to queue weights
-     for i in range(queue_weight_start_addr, queue_weight_end_addr, 4):
-          queue_id = int((i/4)-(dut.QUEUE_COUNT.value+dut.MAX_NUM_FUNCS.value))
-          await tb.axil_master.write_dword(i, queue_weight_list[queue_id])
-          assert await tb.axil_master.read_dword(i) == queue_weight_list[queue_id]
-
-     # enable all funcs, read back enabled
-     for i in range(func_ram_start_addr, func_ram_end_addr, 4):
-          await tb.axil_master.write_dword(i, FUNC_ENABLED_FUNC_STATE)
-          assert await tb.axil_master.read_dword(i) == FUNC_ENABLED_FUNC_STATE
+     # enable all queues and funcs and write the weights, read back at the end
+     await configure_scheduler(tb, queue_weight_list, func_weight_list)
 
      num_queues_per_func = num_queues/num_funcs
 
@@ -406,27 +334,18 @@ async def inactive1_test(dut):
 
      num_packets = 40000
 
-     x = []
-     l0 = []
-     l1 = []
-     l2 = []
-     l3 = []
-     l4 = []
-     l5 = []
-     l6 = []
-     l7 = []
-     l8 = []
-     l9 = []
-     l10 = []
-     l11 = []
-     l12 = []
-     l13 = []
-     l14 = []
-     l15 = []
-
-     func_actual_list, queue_actual_list, inactive_list = await get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, x, l0, l1, l2, l3, l4, l5, l6, l7, l8, l9, l10, l11, l12, l13, l14, l15)
-
-     plot_lines1(x, inactive_list, l0, l1, l2, l3, l4, l5, l6, l7, l8, l9, l10, l11, l12, l13, l14, l15)
+     # window of at least a few full rounds, a window that is not a whole number of rounds is
+     # off by up to one turn (255/4096) per func
+     metrics = TxSchedulerWMetrics(num_queues, num_funcs, func_weight_list, window=max(4*sum(func_weight_list), 4096),
+          share_tolerance=0.1, starvation_threshold=wrr_max_gap(func_weight_list, queue_weight_list, int(num_queues_per_func)))
+     metrics.set_queues_active(range(num_queues))
+
+     trace = new_trace(dut, "inactive1", num_funcs, num_queues, func_weight_list, queue_weight_list)
+     func_actual_list, queue_actual_list, inactive_list = await get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, metrics, trace)
+     save_trace(trace, inactive_queues=inactive_list)
+
+     metrics.log_report(tb.log)
+     metrics.check(max_share_error=0.1, min_jain=0.9)
 
 
 # Only 1/4 of the queues are active at a time. They become inactive 
@@ -448,115 +367,133 @@ async def inactive2_test(dut):
 
      await RisingEdge(dut.clk)
 
-     num_queues = dut.QUEUE_COUNT.value
      num_funcs = dut.NUM_FUNCS.value
+     # queues past the last func's block are unused when NUM_FUNCS is not a power of 2
+     num_queues = num_funcs*queues_per_func(dut.QUEUE_COUNT.value, num_funcs)
 
-     # enable first group of queues, read back enabled
-        # parameters = {}
-     for i in range(int(num_queues/4)):
-          await tb.axil_master.write_dword((i*4), QUEUE_ENABLED_QUEUE_STATE)
-          assert await tb.axil_master.read_dword(i*4)== QUEUE_ENABLED_QUEUE_STATE
-    
-     func_start_addr = (num_queues)*4
-     func_end_addr = func_start_addr + ((dut.MAX_NUM_FUNCS.value)*4)
-
-     queue_weight_start_addr = func_end_addr
-     queue_weight_end_addr = queue_weight_start_addr + ((num_queues)*4)
+     queue_weight_list = random_weights(num_queues)
+     func_weight_list = random_weights(num_funcs)
 
-     func_ram_start_addr = queue_weight_end_addr
-     func_ram_end_addr = func_ram_start_addr + ((num_funcs)*4)
+     # enable first group of queues and all funcs and write the weights, read back at the end
+     await configure_scheduler(tb, queue_weight_list, func_weight_list, queues=range(int(num_queues/4)))
 
-     
-     queue_weight_list = []
-     func_weight_list = []
+     num_queues_per_func = num_queues/num_funcs
 
+     # send doorbell reqeusts for all queues
      for i in range(num_queues):
-          queue_weight_list.append(random.randint(1,255))
+          await tb.doorbell_source.send(DoorbellTransaction(queue = i, func=int(math.floor((i/num_queues_per_func)))))
 
-     for i in range(num_funcs):
-          func_weight_list.append(random.randint(1,255))
 
-     # write and read to func weights
-     for i in range(func_start_addr, func_start_addr+(num_funcs*4), 4):
-          func_id  = int((i/4)-dut.QUEUE_COUNT.value)
-          await tb.axil_master.write_dword(i, func_weight_list[func_id])
-          assert await tb.axil_master.read_dword(i) ==  func_weight_list[func_id]
+     num_packets = 40000
+
+     # at most 2 funcs are active at a time, so 2048 is several rounds yet short enough to
+     # settle well within the num_packets/8 transmits between group swaps
+     metrics = TxSchedulerWMetrics(num_queues, num_funcs, func_weight_list, window=2048, share_tolerance=0.15,
+          starvation_threshold=wrr_max_gap(func_weight_list, queue_weight_list, int(num_queues_per_func)))
+     metrics.set_queues_active(range(int(num_queues/4)))
 
-     # write and read to queue weights
-     for i in range(queue_weight_start_addr, queue_weight_end_addr, 4):
-          queue_id = int((i/4)-(dut.QUEUE_COUNT.value+dut.MAX_NUM_FUNCS.value))
-          await tb.axil_master.write_dword(i, queue_weight_list[queue_id])
-          assert await tb.axil_master.read_dword(i) == queue_weight_list[queue_id]
+     trace = new_trace(dut, "inactive2", num_funcs, num_queues, func_weight_list, queue_weight_list)
+     i_val = await get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, metrics, trace)
+     save_trace(trace)
 
-     # enable all funcs, read back enabled
-     for i in range(func_ram_start_addr, func_ram_end_addr, 4):
-          await tb.axil_master.write_dword(i, FUNC_ENABLED_FUNC_STATE)
-          assert await tb.axil_master.read_dword(i) == FUNC_ENABLED_FUNC_STATE
+     assert i_val==39999
+
+     # every group swap is an event, shares have to settle within two windows of it
+     metrics.log_report(tb.log)
+     metrics.check(max_share_error=0.15, min_jain=0.9, max_convergence=2*metrics.window)
+
+# measures how many scheduling decisions per clock the scheduler sustains with all queues
+# backlogged, against a tx_engine model with pipeline latency, random completion times and
+# random backpressure, and compares it to line rate at minimum packet size.
+# the environment overrides the tx_engine model and the line rate:
+# TX_SCHED_TX_LATENCY, TX_SCHED_TX_COMPLETION_MEAN, TX_SCHED_TX_BACKPRESSURE,
+# TX_SCHED_LINE_RATE_GBPS and TX_SCHED_MAX_DOORBELL_LATENCY (each checked only when set), TX_SCHED_PACKET_BYTES
+async def throughput_test(dut):
+     tb = TB(dut)
+
+     await tb.reset()
+
+     dut.enable.value = 1
+
+     await RisingEdge(dut.clk)
+
+     num_funcs = dut.NUM_FUNCS.value
+     num_queues = num_funcs*queues_per_func(dut.QUEUE_COUNT.value, num_funcs)
+     op_table_size = dut.OP_TABLE_SIZE.value
+
+     queue_weight_list = random_weights(num_queues)
+     func_weight_list = random_weights(num_funcs)
+
+     await configure_scheduler(tb, queue_weight_list, func_weight_list)
 
      num_queues_per_func = num_queues/num_funcs
 
-     # send doorbell reqeusts for all queues
+     trace = new_trace(dut, "throughput", num_funcs, num_queues, func_weight_list, queue_weight_list)
+     responder = TxEngineResponder(dut, tb.txrq_sink, op_table_size,
+          pipeline_latency=int(os.environ.get('TX_SCHED_TX_LATENCY', 8)),
+          completion=completion_exponential(float(os.environ.get('TX_SCHED_TX_COMPLETION_MEAN', 4))),
+          backpressure=float(os.environ.get('TX_SCHED_TX_BACKPRESSURE', 0.0)),
+          clk_period_ns=CLK_PERIOD_NS, trace=trace)
+     responder.start()
+
+     # doorbells for all queues, the responder times each one to the queue's first grant
      for i in range(num_queues):
           await tb.doorbell_source.send(DoorbellTransaction(queue = i, func=int(math.floor((i/num_queues_per_func)))))
 
+     num_packets = 20000
 
-     num_packets = 40000
+     await responder.wait_decisions(num_packets)
+     responder.stop()
+     save_trace(trace)
 
-     x = []
-     l0 = []
-     l1 = []
-     l2 = []
-     l3 = []
-     l4 = []
-     l5 = []
-     l6 = []
-     l7 = []
-     l8 = []
-     l9 = []
-     l10 = []
-     l11 = []
-     l12 = []
-     l13 = []
-     l14 = []
-     l15 = []
-
-     i_val = await get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, x, l0, l1, l2, l3, l4, l5, l6, l7, l8, l9, l10, l11, l12, l13, l14, l15)
+     responder.log_report(tb.log)
 
-     assert i_val==39999
+     packet_bytes = int(os.environ.get('TX_SCHED_PACKET_BYTES', 64))
+     line_rate = os.environ.get('TX_SCHED_LINE_RATE_GBPS')
+     required = line_rate_decisions_per_cycle(float(line_rate or 100), packet_bytes, CLK_PERIOD_NS)
+     tb.log.info("Line rate of %s Gbps at %d bytes needs %.4f decisions/cycle", line_rate or 100, packet_bytes, required)
 
-     plot_lines(x, l0, l1, l2, l3, l4, l5, l6, l7, l8, l9, l10, l11, l12, l13, l14, l15)
+     max_doorbell_latency = os.environ.get('TX_SCHED_MAX_DOORBELL_LATENCY')
+     responder.check(min_decisions_per_cycle=required if line_rate else None,
+          max_doorbell_latency=int(max_doorbell_latency) if max_doorbell_latency else None)
 
-async def get_actual_transmit_nums_bar(dut, num_packets, num_funcs, num_queues):
+async def get_actual_transmit_nums_bar(dut, num_packets, num_funcs, num_queues, scoreboard=None, trace=None):
 
      tb = TB(dut)
 
      func_transmit_count = [0]*num_funcs
      queue_transmit_count = [0]*num_queues
 
-     op_table_active = [0]*16
+     op_table_size = dut.OP_TABLE_SIZE.value
+     op_table_active = [0]*op_table_size
      num_active_ops = 0
 
      for i in range(num_packets):
 
-          if(num_active_ops==16):
-               num_active_ops -= await send_tr_resps(dut, op_table_active)
+          if(num_active_ops==op_table_size):
+               num_active_ops -= await send_tr_resps(dut, op_table_active, scoreboard, trace)
 
           resp = await tb.txrq_sink.recv()
+          if trace is not None:
+               trace.record_request(get_cycle(), int(resp.func), int(resp.queue), int(resp.tag))
           func_transmit_count[int(resp.func)] += 1
           queue_transmit_count[int(resp.queue)] += 1
+          if scoreboard is not None:
+               scoreboard.request(int(resp.queue), int(resp.func), int(resp.tag))
           op_table_active[int(resp.tag)] = 1
           num_active_ops +=1
 
      return func_transmit_count, queue_transmit_count
 
-async def get_actual_transmit_nums_doorbell1(dut, num_packets, num_funcs, num_queues):
+async def get_actual_transmit_nums_doorbell1(dut, num_packets, num_funcs, num_queues, trace=None):
 
      tb = TB(dut)
 
      func_transmit_count = [0]*num_funcs
      queue_transmit_count = [0]*num_queues
 
-     op_table_active = [0]*16
+     op_table_size = dut.OP_TABLE_SIZE.value
+     op_table_active = [0]*op_table_size
      num_active_ops = 0
 
      num_queues_per_func = num_queues/num_funcs
@@ -567,10 +504,12 @@ async def get_actual_transmit_nums_doorbell1(dut, num_packets, num_funcs, num_qu
                for i in range(num_queues):
                     await tb.doorbell_source.send(DoorbellTransaction(queue = i, func=int(math.floor((i/num_queues_per_func)))))
 
-          if(num_active_ops==16):
-               num_active_ops -= await send_tr_resps(dut, op_table_active)
+          if(num_active_ops==op_table_size):
+               num_active_ops -= await send_tr_resps(dut, op_table_active, trace=trace)
 
           resp = await tb.txrq_sink.recv()
+          if trace is not None:
+               trace.record_request(get_cycle(), int(resp.func), int(resp.queue), int(resp.tag))
           func_transmit_count[int(resp.func)] += 1
           queue_transmit_count[int(resp.queue)] += 1
           op_table_active[int(resp.tag)] = 1
@@ -578,14 +517,15 @@ async def get_actual_transmit_nums_doorbell1(dut, num_packets, num_funcs, num_qu
 
      return func_transmit_count, queue_transmit_count
 
-async def get_actual_transmit_nums_doorbell3(dut, num_packets, num_funcs, num_queues):
+async def get_actual_transmit_nums_doorbell3(dut, num_packets, num_funcs, num_queues, trace=None):
 
      tb = TB(dut)
 
      func_transmit_count = [0]*num_funcs
      queue_transmit_count = [0]*num_queues
 
-     op_table_active = [0]*16
+     op_table_size = dut.OP_TABLE_SIZE.value
+     op_table_active = [0]*op_table_size
      num_active_ops = 0
 
      num_queues_per_func = num_queues/num_funcs
@@ -619,10 +559,12 @@ async def get_actual_transmit_nums_doorbell3(dut, num_packets, num_funcs, num_qu
                     inactive_queue_list.pop(rand_queue_spot)
                     
 
-          if(num_active_ops==16):
-               num_active_ops -= await send_tr_resps(dut, op_table_active)
+          if(num_active_ops==op_table_size):
+               num_active_ops -= await send_tr_resps(dut, op_table_active, trace=trace)
 
           resp = await tb.txrq_sink.recv()
+          if trace is not None:
+               trace.record_request(get_cycle(), int(resp.func), int(resp.queue), int(resp.tag))
           func_transmit_count[int(resp.func)] += 1
           queue_transmit_count[int(resp.queue)] += 1
           op_table_active[int(resp.tag)] = 1
@@ -630,16 +572,17 @@ async def get_actual_transmit_nums_doorbell3(dut, num_packets, num_funcs, num_qu
 
      return func_transmit_count, queue_transmit_count
 
-async def get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, x, y0, y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11, y12, y13, y14, y15):
+async def get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, metrics, trace=None):
 
      tb = TB(dut)
 
      func_transmit_count = [0]*num_funcs
      queue_transmit_count = [0]*num_queues
 
-     op_table_active = [0]*16
-     op_table_func = [0]*16
-     op_table_queue = [0]*16
+     op_table_size = dut.OP_TABLE_SIZE.value
+     op_table_active = [0]*op_table_size
+     op_table_func = [0]*op_table_size
+     op_table_queue = [0]*op_table_size
 
 
      num_active_ops = 0
@@ -655,29 +598,32 @@ async def get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, x,
 
      for i in range(num_packets):
 
-          if(num_active_ops==16):
-               num_active_ops -= await send_tr_resps(dut, op_table_active)
+          if(num_active_ops==op_table_size):
+               num_active_ops -= await send_tr_resps(dut, op_table_active, trace=trace)
 
           resp = await tb.txrq_sink.recv()
+          if trace is not None:
+               trace.record_request(get_cycle(), int(resp.func), int(resp.queue), int(resp.tag))
           func_transmit_count[int(resp.func)] += 1
           queue_transmit_count[int(resp.queue)] += 1
           op_table_active[int(resp.tag)] = 1
           op_table_func[int(resp.tag)]=int(resp.func)
           op_table_queue[int(resp.tag)]=[int(resp.queue)]
           num_active_ops +=1
+          metrics.record(int(resp.queue), int(resp.func))
 
           # well after desired queues have been marked as inactive  (numpackets/2 + 300), wake them up
           if(i==((num_packets)/2)+300):
                saved_inactive_list = [int(element) for element in inactive_queue_list]
+               metrics.set_queues_active(saved_inactive_list)
+               metrics.mark_event("wake up")
+               if trace is not None:
+                    trace.mark("wake up")
                await wake_up_queues(dut, inactive_queue_list, num_queues_per_func)
 
-          if(i%40==0):
-          # to cut down on time, only update lines every 40 transmits
-               update_queue_line_data(num_queues, queue_transmit_count, i, x, y0, y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11, y12, y13, y14, y15)
-
           # if queue counter >0, trying to mark queue as inactive by failing all it's transmits until failed status sets in, fail this one
           if(min(queue_counter, func_counter)>0 and last_failed_queue==int(resp.queue) and i<((num_packets)/2)+3):
-               await send_tr_resp_fail(dut, op_table_active, resp.tag)
+               await send_tr_resp_fail(dut, op_table_active, resp.tag, trace)
                queue_counter = int(dut.queue_counter_next.value)
                func_counter = int(dut.func_counter_next.value)
                if(queue_counter==0 or func_counter ==0):
@@ -687,15 +633,19 @@ async def get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, x,
 
           # for (num_queues/2) evenly spaced times in first half of num packets sent, pick a queue to become inactive
           if(i%((num_packets/2)/(num_queues/2))==0 and i<(num_packets/2)):
-               await send_tr_resp_fail(dut, op_table_active, resp.tag)
+               await send_tr_resp_fail(dut, op_table_active, resp.tag, trace)
 
                # search for any current ops for this queue and also fail those
-               for k in range(16):
+               for k in range(op_table_size):
                     if(op_table_active[k]==1 and op_table_queue[k]==resp.queue):
-                         await send_tr_resp_fail(dut, op_table_active, k)
+                         await send_tr_resp_fail(dut, op_table_active, k, trace)
 
                # add queue to inactive list
                inactive_queue_list.append(resp.queue)
+               metrics.set_queue_active(int(resp.queue), False)
+               metrics.mark_event("deactivate")
+               if trace is not None:
+                    trace.mark("deactivate", queue=int(resp.queue))
 
                # save current queue counter so we can fail any remaining transmits from this queue
                queue_counter = int(dut.queue_counter_next.value)
@@ -708,106 +658,24 @@ async def get_actual_transmit_nums1(dut, num_packets, num_funcs, num_queues, x,
 
 def get_expected_transmit_nums(num_packets, func_weight_list, queue_weight_list, num_queues_per_func):
 
-     func_return_list = []
-     queue_return_list = []
-
-     func_weight_sum = sum(func_weight_list)
-     queue_weight_sum_per_func = []
-
-     for i in range(len(func_weight_list)):
-          func_return_list.append(math.floor((func_weight_list[i]/func_weight_sum)*num_packets))
-          start = int(i*num_queues_per_func)
-          end = int(start+num_queues_per_func)
-          queue_weight_sum_per_func.append(sum(queue_weight_list[start:end]))
-
-     for i in range(len(queue_weight_list)):
-          func = math.floor(i/num_queues_per_func)
-          queue_return_list.append(math.floor((queue_weight_list[i]/queue_weight_sum_per_func[func])*func_return_list[func]))
-
-     return func_return_list, queue_return_list
-
-def plot_bars(num_funcs, num_queues, expected_val, actual_val, plot_funcs, weight_list):
-     # plot expected func bandwidths
-
-     if (plot_funcs == 1):
-          x_axis_labels = [f'{j}\n({weight_list[j]})' for j in range(0,num_funcs)]
-          plt.xlabel("Function")
-          plt.ylabel("# Packets Transmitted")
-          plt.title(f'Packets Transmitted Per Function ({num_queues} Queues)')
-     else:
-          x_axis_labels = [f'{j}\n({weight_list[j]})' for j in range(0,num_queues)]
-          plt.xlabel("Queue")
-          plt.ylabel("# Packets Transmitted")
-          plt.title(f'Packets Transmitted Per Queue ({num_funcs} Funcs)')
-     
-     bars_expected = plt.bar(x_axis_labels, expected_val, color='gray')
-
+     # exact counts from the reference model with all queues backlogged and doorbells sent in
+     # queue order, rather than weight ratios rounded down
+     func_counts, queue_counts = expected_transmit_counts(num_packets, func_weight_list, queue_weight_list)
 
-     # Display bar values at the top of each bar
-     for bar_e in bars_expected:
-          yval = bar_e.get_height()
-          plt.text(bar_e.get_x() + bar_e.get_width() / 2, yval, round(yval, 2), ha='center', va='bottom', color="dimgray")
+     return func_counts.tolist(), queue_counts.tolist()
 
+def get_cycle():
+     return int(get_sim_time('ns')) // CLK_PERIOD_NS
 
-     bars_actual = plt.bar(x_axis_labels, actual_val, color='powderblue', alpha = 0.7)
-     # Display bar values at the top of each bar
-     for bar_a in bars_actual:
-          plt.text(bar_a.get_x() + bar_a.get_width() / 2, bar_a.get_height()/2, bar_a.get_height(), ha='center', va='bottom', color="black")
+def new_trace(dut, test, num_funcs, num_queues, func_weight_list, queue_weight_list):
+     return TxSchedulerWTrace(dut.OP_TABLE_SIZE.value, test=test, num_funcs=num_funcs, num_queues=num_queues,
+          func_weights=func_weight_list, queue_weights=queue_weight_list)
 
-     categories = ['Expected', 'Actual']
-     colors = ['gray', 'powderblue']
-
-     # Create legend handles
-     legend_handles = [Patch(color=color, label=category) for color, category in zip(colors, categories)]
-
-     # Create a legend
-     plt.legend(handles=legend_handles, loc='upper center')
-
-     plt.show()
-
-def plot_lines1(x, inactive_list, *args):
-
-     for i,y in enumerate(args):
-          if (len(y)>0):
-               plt.plot(x, y, label=f'Queue {i}')
-
-               # display the ending val of each line
-               plt.text(x[-1] + 0.1, y[-1], f'{y[-1]:.0f}', fontsize=8, verticalalignment='center')
-
-     plt.xlim(min(x), max(x) + 35)  # Adjust the value as needed
-
-     plt.xlabel('Time (in # total packets)')
-     plt.ylabel('# packets transmitted')
-     plt.title('Queue Packet Transmissions Across Time')
-
-     text_to_display = f"in. queues: \n" + '\n'.join(map(str, inactive_list))
-
-     max_x_val = x[len(x)-1]
-     plt.text(max_x_val + 30, 5, text_to_display, fontsize=8, verticalalignment='center')
-     plt.legend()
-
-     
-     plt.grid(which='both')
-
-     plt.show()
-def plot_lines(x, *args):
-
-     for i,y in enumerate(args):
-          if (len(y)>0):
-               plt.plot(x, y, label=f'Queue {i}')
-
-               # display the ending val of each line
-               plt.text(x[-1] + 0.1, y[-1], f'{y[-1]:.0f}', fontsize=8, verticalalignment='center')
-
-     plt.xlabel('Time (in # total packets)')
-     plt.ylabel('# packets transmitted')
-     plt.title('Queue Packet Transmissions Across Time')
-
-     plt.legend()
-
-     plt.grid(which='both')
-
-     plt.show()
+def save_trace(trace, **meta):
+     # one file per test and parameter set, e.g. traces/doorbell3-q16-f8.npy
+     trace_dir = os.environ.get('TX_SCHED_TRACE_DIR', os.path.join(tests_dir, 'traces'))
+     name = f"{trace.meta['test']}-q{trace.meta['num_queues']}-f{trace.meta['num_funcs']}.npy"
+     trace.save(os.path.join(trace_dir, name), **meta)
 
 async def disable_queue(dut, queue_idx):
     tb = TB(dut)
@@ -828,14 +696,15 @@ async def wake_up_queues(dut, queue_list, num_queues_per_func):
           await tb.doorbell_source.send(DoorbellTransaction(queue = queue_idx, func=int(math.floor((queue_idx/num_queues_per_func)))))
           queue_list.pop(0)
 
-async def get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, x, y0, y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11, y12, y13, y14, y15):
+async def get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, metrics, trace=None):
 
      tb = TB(dut)
 
 
-     op_table_active = [0]*16
-     op_table_func = [0]*16
-     op_table_queue = [0]*16
+     op_table_size = dut.OP_TABLE_SIZE.value
+     op_table_active = [0]*op_table_size
+     op_table_func = [0]*op_table_size
+     op_table_queue = [0]*op_table_size
 
      num_active_ops = 0
 
@@ -850,23 +719,25 @@ async def get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, x,
 
      for i in range(num_packets):
 
-          if(num_active_ops==16):
-               num_active_ops -= await send_tr_resps(dut, op_table_active)
+          if(num_active_ops==op_table_size):
+               num_active_ops -= await send_tr_resps(dut, op_table_active, trace=trace)
 
           resp = await tb.txrq_sink.recv()
+          if trace is not None:
+               trace.record_request(get_cycle(), int(resp.func), int(resp.queue), int(resp.tag))
           op_table_active[int(resp.tag)] = 1
           op_table_func[int(resp.tag)]=int(resp.func)
           op_table_queue[int(resp.tag)]=[int(resp.queue)]
           queue_transmit_counts[int(resp.queue)] += 1
           num_active_ops +=1
-
-          # update line data every 40th transmit
-          if(i%40==0):
-            update_queue_line_data(num_queues, queue_transmit_counts, i, x, y0, y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11, y12, y13, y14, y15)
+          metrics.record(int(resp.queue), int(resp.func))
 
           # for (num_packets/8) evenly spaced times (i>0 since first interval set up initially) 
           # disable current group of queues, enable next
           if(i%(num_packets/8)==0 and i>0):
+               metrics.mark_event("swap queue group")
+               if trace is not None:
+                    trace.mark("swap queue group")
                for j in range(int(num_queues/4)):
                     num_queues_per_group = int(num_queues/4)
                     next_queue_idx = (active_queue_list[j]+num_queues_per_group)%num_queues
@@ -874,6 +745,8 @@ async def get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, x,
                     print("disabling queue %d, enabling queue %d \n", active_queue_list[j], next_queue_idx)
                     await disable_queue(dut, active_queue_list[j])
                     await enable_queue(dut, next_queue_idx)
+                    metrics.set_queue_active(active_queue_list[j], False)
+                    metrics.set_queue_active(next_queue_idx, True)
                     active_queue_list[j]= next_queue_idx
 
           
@@ -883,18 +756,7 @@ async def get_actual_transmit_nums2(dut, num_packets, num_funcs, num_queues, x,
 
 
 
-def update_queue_line_data(num_queues, transmit_counts, time_tick, x, y0, y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11, y12, y13, y14, y15):
-
-     # for all other queues, add a point that's equal to the last point for y-data
-     for i in range(num_queues):
-        # copy current transmit counts to line data
-        line_name = locals()[f'y{i}']
-        line_name.append(transmit_counts[i])
-          
-     # append time_tick (equivalent to current total packet count) to x data of line
-     x.append(time_tick)
-
-async def send_tr_resp_fail(dut, active_list, tag):
+async def send_tr_resp_fail(dut, active_list, tag, trace=None):
 
      # send failed response for given tag
      dut.s_axis_tx_req_status_len.setimmediatevalue(0)
@@ -902,6 +764,8 @@ async def send_tr_resp_fail(dut, active_list, tag):
      dut.s_axis_tx_req_status_valid.setimmediatevalue(1)
      await RisingEdge(dut.clk)
      dut.s_axis_tx_req_status_valid.setimmediatevalue(0)
+     if trace is not None:
+          trace.record_status(int(tag), 0)
 
      # mark tag as inactive/not in use
      active_list[tag]=0
@@ -909,21 +773,27 @@ async def send_tr_resp_fail(dut, active_list, tag):
      # return number of transmit responses sent
      return 1
         
-async def send_tr_resps(dut, active_list):
+async def send_tr_resps(dut, active_list, scoreboard=None, trace=None):
 
-     # starting at rand index 0-15
-     start = random.randint(0,15)
+     op_table_size = len(active_list)
 
-     # send successful status for 1-16 queues as long as index valid
-     num_responses = random.randint(1,16)
+     # starting at rand index 0 to op table size - 1
+     start = random.randint(0,op_table_size-1)
+
+     # send successful status for 1 to op table size queues as long as index valid
+     num_responses = random.randint(1,op_table_size)
 
      k=0
-     while((start+k)<16 and k<num_responses):
+     while((start+k)<op_table_size and k<num_responses):
           dut.s_axis_tx_req_status_len.setimmediatevalue(4)
           dut.s_axis_tx_req_status_tag.setimmediatevalue((start+k))
           dut.s_axis_tx_req_status_valid.setimmediatevalue(1)
           await RisingEdge(dut.clk)
           dut.s_axis_tx_req_status_valid.setimmediatevalue(0)
+          if scoreboard is not None:
+               scoreboard.tx_status(start+k, 4)
+          if trace is not None:
+               trace.record_status(start+k, 4)
           # mark tag as inactive/not in use
           active_list[k]=0
 
@@ -933,12 +803,15 @@ async def send_tr_resps(dut, active_list):
 
 
 if cocotb.SIM_NAME:
-     #factory = TestFactory(basic_bar_test)
-     #factory = TestFactory(doorbell1_test)
-     factory = TestFactory(doorbell3_test)
-     #factory = TestFactory(inactive1_test)
-     #factory = TestFactory(inactive2_test)
-     factory.generate_tests()
+     # the transmit count tests take 10-25 minutes per parameter set, so only the throughput test
+     # runs by default; set TX_SCHED_LONG_TESTS=1 to add them and TESTCASE to pick a subset,
+     # e.g. TESTCASE=doorbell3_test_001
+     tests = [throughput_test]
+     if os.environ.get('TX_SCHED_LONG_TESTS'):
+          tests += [basic_bar_test, doorbell1_test, doorbell3_test, inactive1_test, inactive2_test]
+     for test in tests:
+          factory = TestFactory(test)
+          factory.generate_tests()
 
 
 # cocotb-test
@@ -951,9 +824,13 @@ axis_rtl_dir = os.path.abspath(os.path.join(lib_dir, 'axis', 'rtl'))
 eth_rtl_dir = os.path.abspath(os.path.join(lib_dir, 'eth', 'rtl'))
 pcie_rtl_dir = os.path.abspath(os.path.join(lib_dir, 'pcie', 'rtl'))
 
-# only use up to 32 queues for bar graphs (else too many lines)
-@pytest.mark.parametrize("queue_index_width", [4,5])
-@pytest.mark.parametrize("num_vfs", [1,7])
+scheduler_configs = [(1, 4), (7, 4), (1, 5), (7, 5)]
+
+# OS4C scale is opt in, set TX_SCHED_FULL_SCALE=1 to add 252 VFs with 256 and 512 queues
+if os.environ.get('TX_SCHED_FULL_SCALE'):
+    scheduler_configs += [(252, 8), (252, 9)]
+
+@pytest.mark.parametrize(("num_vfs", "queue_index_width"), scheduler_configs)
 
 # @pytest.mark.parametrize("queue_index_width", [3,4])
 # @pytest.mark.parametrize("num_vfs", [1,7])
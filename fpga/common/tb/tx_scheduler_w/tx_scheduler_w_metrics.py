@@ -0,0 +1,232 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import numpy as np
+
+
+def jain_index(x):
+    # Jain's fairness index, 1 when all entries are equal, 1/n when one entry gets everything
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0:
+        return 1.0
+    s = (x*x).sum()
+    if s == 0:
+        return 1.0
+    return float(x.sum()**2 / (len(x)*s))
+
+
+def wrr_max_gap(func_weights, queue_weights, queues_per_func):
+    # upper bound on transmits between two services of a backlogged queue: the other queues
+    # of its function take their weights out of that function's turns, and a full round of
+    # every function's weight passes between two turns of the same function
+    func_weights = np.asarray(func_weights, dtype=np.int64)
+    queue_weights = np.asarray(queue_weights, dtype=np.int64)
+    round_len = int(func_weights.sum())
+    func_queue_weights = queue_weights.reshape(len(func_weights), queues_per_func)
+    others = func_queue_weights.sum(axis=1)[:, np.newaxis] - func_queue_weights
+    turns = -(-others // np.maximum(func_weights, 1)[:, np.newaxis]) + 1
+    return (turns * round_len).reshape(-1)
+
+
+class TxSchedulerWMetrics:
+    def __init__(self, queue_count, num_funcs, func_weights=None, queue_funcs=None, window=4096,
+            sample_interval=40, max_samples=4096, share_tolerance=0.05, starvation_threshold=None,
+            queue_history=False):
+        # fairness metrics over a stream of transmit requests; every record() is O(1) over
+        # preallocated arrays, the O(num_funcs) fairness figures are computed once per sample;
+        # samples keep per function counts, per queue counts only with queue_history as they
+        # take max_samples*queue_count entries
+        self.queue_count = queue_count
+        self.num_funcs = num_funcs
+
+        # owning function of each queue, contiguous blocks of queues by default
+        if queue_funcs is None:
+            queue_funcs = np.arange(queue_count) // max(queue_count // num_funcs, 1)
+        self.queue_func = np.minimum(np.asarray(queue_funcs, dtype=np.int64), num_funcs-1)
+
+        if func_weights is None:
+            func_weights = np.ones(num_funcs)
+        self.func_weight = np.asarray(func_weights, dtype=np.float64)
+
+        self.count = 0
+        self.queue_tx_count = np.zeros(queue_count, dtype=np.int64)
+        self.func_tx_count = np.zeros(num_funcs, dtype=np.int64)
+
+        # sliding window of the last functions served
+        self.window = window
+        self.window_funcs = np.full(window, -1, dtype=np.int64)
+        self.window_pos = 0
+        self.window_count = np.zeros(num_funcs, dtype=np.int64)
+
+        # queues expected to be served, as marked by the test
+        self.queue_active = np.zeros(queue_count, dtype=bool)
+        self.func_active_queues = np.zeros(num_funcs, dtype=np.int64)
+
+        # transmits between two services of an active queue
+        self.starvation_threshold = starvation_threshold
+        self.queue_last = np.zeros(queue_count, dtype=np.int64)
+        self.queue_max_gap = np.zeros(queue_count, dtype=np.int64)
+        self.queue_starved = np.zeros(queue_count, dtype=np.int64)
+
+        # samples of the per function (and optionally per queue) counts and fairness, thinned
+        # by half when full
+        self.sample_interval = sample_interval
+        self.max_samples = max_samples
+        self.num_samples = 0
+        self.sample_x = np.zeros(max_samples, dtype=np.int64)
+        self.sample_func_count = np.zeros((max_samples, num_funcs), dtype=np.uint32)
+        self.sample_queue_count = np.zeros((max_samples, queue_count), dtype=np.uint32) if queue_history else None
+        self.sample_share_error = np.zeros(max_samples, dtype=np.float64)
+        self.sample_jain = np.zeros(max_samples, dtype=np.float64)
+        self.sample_steady = np.zeros(max_samples, dtype=bool)
+
+        # events such as doorbells and reactivations, and how long until shares settle again
+        self.share_tolerance = share_tolerance
+        self.events = []
+        self.pending_events = []
+
+    def set_queue_active(self, queue, active=True):
+        if self.queue_active[queue] == active:
+            return
+        self.queue_active[queue] = active
+        func = self.queue_func[queue]
+        self.func_active_queues[func] += 1 if active else -1
+        if active:
+            # gap counted from when the queue has work again
+            self.queue_last[queue] = self.count
+
+    def set_queues_active(self, queues, active=True):
+        for q in queues:
+            self.set_queue_active(int(q), active)
+
+    def mark_event(self, name):
+        event = {'name': name, 'index': self.count, 'converged': None}
+        self.events.append(event)
+        self.pending_events.append(event)
+
+    def record(self, queue, func=None):
+        if func is None:
+            func = self.queue_func[queue]
+        i = self.count
+
+        if self.queue_active[queue]:
+            gap = i - self.queue_last[queue]
+            if gap > self.queue_max_gap[queue]:
+                self.queue_max_gap[queue] = gap
+            if self.starvation_threshold is not None and gap > self.starvation_threshold[queue]:
+                self.queue_starved[queue] += 1
+        self.queue_last[queue] = i
+
+        self.queue_tx_count[queue] += 1
+        self.func_tx_count[func] += 1
+
+        old = self.window_funcs[self.window_pos]
+        if old >= 0:
+            self.window_count[old] -= 1
+        self.window_funcs[self.window_pos] = func
+        self.window_count[func] += 1
+        self.window_pos = (self.window_pos + 1) % self.window
+
+        self.count = i + 1
+        if self.count % self.sample_interval == 0:
+            self._sample()
+
+    def expected_share(self):
+        w = self.func_weight * (self.func_active_queues > 0)
+        total = w.sum()
+        return w / total if total else w
+
+    def window_share_error(self):
+        filled = min(self.count, self.window)
+        if not filled:
+            return 0.0
+        return float(np.abs(self.window_count / filled - self.expected_share()).max())
+
+    def window_jain(self):
+        # over active functions, each function's window count normalised by its weight
+        active = self.func_active_queues > 0
+        return jain_index(self.window_count[active] / self.func_weight[active])
+
+    def _sample(self):
+        if self.num_samples == self.max_samples:
+            keep = slice(1, self.max_samples, 2)
+            n = self.max_samples // 2
+            for a in (self.sample_x, self.sample_func_count, self.sample_queue_count, self.sample_share_error,
+                    self.sample_jain, self.sample_steady):
+                if a is not None:
+                    a[:n] = a[keep]
+            self.num_samples = n
+            self.sample_interval *= 2
+            if self.count % self.sample_interval:
+                return
+
+        k = self.num_samples
+        error = self.window_share_error()
+        full = self.count >= self.window
+
+        if self.pending_events and full and error <= self.share_tolerance:
+            for event in self.pending_events:
+                event['converged'] = self.count - event['index']
+            self.pending_events = []
+
+        self.sample_x[k] = self.count
+        self.sample_func_count[k] = self.func_tx_count
+        if self.sample_queue_count is not None:
+            self.sample_queue_count[k] = self.queue_tx_count
+        self.sample_share_error[k] = error
+        self.sample_jain[k] = self.window_jain()
+        self.sample_steady[k] = full and not self.pending_events
+        self.num_samples = k + 1
+
+    def history(self, queues=False):
+        # (transmit index, per function counts) of every sample, for plotting; per queue
+        # counts with queues, which needs queue_history
+        n = self.num_samples
+        if not queues:
+            return self.sample_x[:n], self.sample_func_count[:n]
+        if self.sample_queue_count is None:
+            raise Exception("Per queue history not recorded, enable queue_history")
+        return self.sample_x[:n], self.sample_queue_count[:n]
+
+    def summary(self):
+        n = self.num_samples
+        steady = self.sample_steady[:n]
+        convergence = [e['converged'] for e in self.events if e['converged'] is not None]
+        return {
+            'transmits': self.count,
+            'jain': self.window_jain(),
+            'min_steady_jain': float(self.sample_jain[:n][steady].min()) if steady.any() else None,
+            'max_steady_share_error': float(self.sample_share_error[:n][steady].max()) if steady.any() else None,
+            'events': len(self.events),
+            'unconverged_events': len(self.pending_events),
+            'max_convergence': max(convergence) if convergence else None,
+            'max_gap': int(self.queue_max_gap.max()),
+            'max_gap_queue': int(self.queue_max_gap.argmax()),
+            'starved': int(self.queue_starved.sum()),
+        }
+
+    def log_report(self, log):
+        s = self.summary()
+        log.info("Scheduler metrics: %d transmits, jain %.4f (min steady %s), max steady share error %s, "
+            "%d events (%d unconverged, max convergence %s transmits), max gap %d (queue %d), %d starved",
+            s['transmits'], s['jain'], s['min_steady_jain'], s['max_steady_share_error'], s['events'],
+            s['unconverged_events'], s['max_convergence'], s['max_gap'], s['max_gap_queue'], s['starved'])
+
+    def check(self, max_share_error=None, min_jain=None, max_convergence=None, max_starved=0):
+        s = self.summary()
+        errors = []
+        if max_share_error is not None and s['max_steady_share_error'] is not None and \
+                s['max_steady_share_error'] > max_share_error:
+            errors.append("share error %.4f exceeds %.4f" % (s['max_steady_share_error'], max_share_error))
+        if min_jain is not None and s['min_steady_jain'] is not None and s['min_steady_jain'] < min_jain:
+            errors.append("jain index %.4f below %.4f" % (s['min_steady_jain'], min_jain))
+        if max_convergence is not None:
+            if s['unconverged_events']:
+                errors.append("%d events never converged" % s['unconverged_events'])
+            if s['max_convergence'] is not None and s['max_convergence'] > max_convergence:
+                errors.append("convergence took %d transmits, limit %d" % (s['max_convergence'], max_convergence))
+        if max_starved is not None and s['starved'] > max_starved:
+            errors.append("%d starvation intervals, max gap %d on queue %d" % (s['starved'], s['max_gap'],
+                s['max_gap_queue']))
+        if errors:
+            raise Exception("Scheduler metrics check failed: " + "; ".join(errors))
@@ -0,0 +1,402 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import collections
+import heapq
+
+import numpy as np
+
+
+MAX_NUM_FUNCS = 256
+WEIGHT_MASK = 0xff
+
+# requests the scoreboard queues up before running them through the model
+SCOREBOARD_BATCH = 1024
+
+
+def periodic_counts(n, weights):
+    # transmits per entry after n turns of a weighted round robin that serves each entry
+    # weights[k] times in order; n and the result may carry extra leading dimensions
+    weights = np.asarray(weights, dtype=np.int64)
+    n = np.asarray(n, dtype=np.int64)[..., np.newaxis]
+    period = weights.sum()
+    if period == 0:
+        return np.zeros(n.shape[:-1] + weights.shape, dtype=np.int64)
+    start = np.cumsum(weights) - weights
+    return (n // period) * weights + np.clip(n % period - start, 0, weights)
+
+
+def expected_transmit_counts(num_packets, func_weights, queue_weights, func_order=None, queue_order=None):
+    # exact per function and per queue transmit counts for num_packets transmits with every
+    # queue backlogged; the queue counter of a function is saved when its turn ends and
+    # restored on its next turn, so the queue level rotation of a function depends only on
+    # how many transmits that function got, and both levels reduce to periodic_counts
+    func_weights = np.asarray(func_weights, dtype=np.int64)
+    queue_weights = np.asarray(queue_weights, dtype=np.int64)
+    num_funcs = len(func_weights)
+    queues_per_func = len(queue_weights) // num_funcs
+
+    if func_order is None:
+        func_order = np.arange(num_funcs)
+    func_order = np.asarray(func_order)
+
+    func_counts = np.zeros(num_funcs, dtype=np.int64)
+    func_counts[func_order] = periodic_counts(num_packets, func_weights[func_order])
+
+    queue_counts = np.zeros(len(queue_weights), dtype=np.int64)
+    for f in range(num_funcs):
+        if queue_order is None:
+            order = np.arange(f*queues_per_func, (f+1)*queues_per_func)
+        else:
+            order = np.asarray(queue_order[f])
+        if len(order):
+            queue_counts[order] = periodic_counts(func_counts[f], queue_weights[order])
+
+    return func_counts, queue_counts
+
+
+class TxSchedulerWModel:
+    def __init__(self, queue_count, num_funcs, op_table_size=16, max_num_funcs=MAX_NUM_FUNCS):
+        # reference model of tx_scheduler_w at the level of scheduler decisions: one call to
+        # step() makes the decisions the scheduler pipeline makes until it issues the next
+        # transmit request, pipeline hazards and the cycles between decisions are not modeled
+        self.queue_count = queue_count
+        self.num_funcs = num_funcs
+        self.queues_per_func = queue_count // num_funcs
+        self.op_table_size = op_table_size
+        self.max_num_funcs = max_num_funcs
+
+        # weight rams
+        self.queue_weight = np.zeros(queue_count, dtype=np.int64)
+        self.func_weight = np.zeros(max_num_funcs, dtype=np.int64)
+
+        # queue ram and func ram state bits
+        self.queue_enabled = np.zeros(queue_count, dtype=bool)
+        self.queue_active = np.zeros(queue_count, dtype=bool)
+        self.queue_scheduled = np.zeros(queue_count, dtype=bool)
+        self.func_enabled = np.zeros(num_funcs, dtype=bool)
+        self.func_active = np.zeros(num_funcs, dtype=bool)
+        self.func_scheduled = np.zeros(num_funcs, dtype=bool)
+        self.func_counterloc = np.zeros(num_funcs, dtype=bool)
+        self.func_last_queue_count = np.zeros(num_funcs, dtype=np.int64)
+        self.active_queue_count = np.zeros(num_funcs, dtype=np.int64)
+
+        # func round robin fifo and one fifo of scheduled queues per func
+        self.func_fifo = collections.deque()
+        self.queue_fifos = [collections.deque() for f in range(num_funcs)]
+
+        self.func_counter = 0
+        self.queue_counter = 0
+
+        # op table, outstanding operations of each queue oldest first
+        self.op_active = np.zeros(op_table_size, dtype=bool)
+        self.op_queue = np.zeros(op_table_size, dtype=np.int64)
+        self.op_func = np.zeros(op_table_size, dtype=np.int64)
+        self.op_doorbell = np.zeros(op_table_size, dtype=bool)
+        self.queue_ops = [collections.deque() for q in range(queue_count)]
+        # free tags as a min heap, the lowest free entry is allocated first like the op table
+        self.free_tags = list(range(op_table_size))
+
+        self.func_tx_count = np.zeros(num_funcs, dtype=np.int64)
+        self.queue_tx_count = np.zeros(queue_count, dtype=np.int64)
+        self.transmit_count = 0
+        self.descheduled_count = 0
+
+    def func_of(self, queue):
+        return queue // self.queues_per_func
+
+    def ops_in_flight(self):
+        return int(np.count_nonzero(self.op_active))
+
+    def _schedule_queue(self, queue, func):
+        self.queue_scheduled[queue] = True
+        self.queue_fifos[func].append(queue)
+        self.active_queue_count[func] += 1
+
+    def _schedule_func(self, func):
+        self.func_scheduled[func] = True
+        self.func_fifo.append(func)
+
+    # configuration, same address map as the AXI lite interface
+
+    def axil_write(self, addr, data):
+        index = addr >> 2
+        if index < self.queue_count:
+            self.write_queue_state(index, data)
+        elif index < self.queue_count + self.max_num_funcs:
+            self.func_weight[index - self.queue_count] = data & WEIGHT_MASK
+        elif index < 2*self.queue_count + self.max_num_funcs:
+            self.queue_weight[index - self.queue_count - self.max_num_funcs] = data & WEIGHT_MASK
+        elif index < 2*self.queue_count + self.max_num_funcs + self.num_funcs:
+            self.write_func_state(index - 2*self.queue_count - self.max_num_funcs, data)
+        else:
+            raise Exception("Invalid scheduler address 0x%x" % addr)
+
+    def write_queue_state(self, queue, data):
+        func = self.func_of(queue)
+        self.queue_enabled[queue] = bool(data & 1)
+        if self.queue_enabled[queue] and self.queue_active[queue] and not self.queue_scheduled[queue]:
+            self._schedule_queue(queue, func)
+            if not self.func_scheduled[func]:
+                self._schedule_func(func)
+
+    def write_func_state(self, func, data):
+        self.func_enabled[func] = bool(data & 1)
+        if self.func_enabled[func] and self.func_active[func] and not self.func_scheduled[func]:
+            self._schedule_func(func)
+
+    def set_queue_weights(self, weights, start=0):
+        weights = np.asarray(weights, dtype=np.int64)
+        self.queue_weight[start:start+len(weights)] = weights & WEIGHT_MASK
+
+    def set_func_weights(self, weights, start=0):
+        weights = np.asarray(weights, dtype=np.int64)
+        self.func_weight[start:start+len(weights)] = weights & WEIGHT_MASK
+
+    def enable_queues(self, queues, enable=True):
+        for q in queues:
+            self.write_queue_state(int(q), int(enable))
+
+    def enable_funcs(self, funcs, enable=True):
+        for f in funcs:
+            self.write_func_state(int(f), int(enable))
+
+    # stream inputs
+
+    def doorbell(self, queue, func=None):
+        if func is None:
+            func = self.func_of(queue)
+
+        self.queue_active[queue] = True
+        self.func_active[func] = True
+
+        if self.queue_enabled[queue] and not self.queue_scheduled[queue]:
+            self._schedule_queue(queue, func)
+
+        if self.func_enabled[func] and not self.func_scheduled[func] and self.active_queue_count[func]:
+            self._schedule_func(func)
+            self.func_counterloc[func] = False
+
+        # doorbell while an operation is outstanding, recorded so the queue stays active
+        if self.queue_ops[queue]:
+            self.op_doorbell[self.queue_ops[queue][-1]] = True
+
+    def tx_status(self, tag, length):
+        if not self.op_active[tag]:
+            raise Exception("Transmit status for inactive tag %d" % tag)
+
+        queue = int(self.op_queue[tag])
+        func = int(self.op_func[tag])
+        ops = self.queue_ops[queue]
+        status = length != 0 or self.op_doorbell[tag]
+
+        # a doorbell recorded on a later operation moves to the one before it
+        k = ops.index(tag)
+        if k > 0 and self.op_doorbell[tag]:
+            self.op_doorbell[ops[k-1]] = True
+        del ops[k]
+        self.op_active[tag] = False
+        self.op_doorbell[tag] = False
+        heapq.heappush(self.free_tags, tag)
+
+        if status:
+            self.queue_active[queue] = True
+            # only the queue is rescheduled, the func is left to a later doorbell
+            if self.queue_enabled[queue] and not self.queue_scheduled[queue]:
+                self._schedule_queue(queue, func)
+        else:
+            self.queue_active[queue] = False
+
+    # scheduling
+
+    def step(self):
+        # next transmit request as (queue, func, tag), or None when the scheduler would stall
+        while True:
+            if not self.func_fifo:
+                return None
+            func = self.func_fifo[0]
+            queues = self.queue_fifos[func]
+
+            if self.func_counter == 0:
+                # new func's turn, resume its queue counter if its last turn was cut short
+                if not queues:
+                    return None
+                self.func_counter = int(self.func_weight[func])
+                if self.func_counterloc[func]:
+                    self.queue_counter = int(self.func_last_queue_count[func])
+                else:
+                    self.queue_counter = int(self.queue_weight[queues[0]])
+                if self.func_counter == 0:
+                    return None
+                continue
+
+            if self.queue_counter == 0:
+                if self.active_queue_count[func]:
+                    if not queues:
+                        return None
+                    self.queue_counter = int(self.queue_weight[queues[0]])
+                    if self.queue_counter == 0:
+                        return None
+                else:
+                    # no active queues left, move on to the next func
+                    self.func_fifo.popleft()
+                    self.func_scheduled[func] = False
+                    self.func_counter = 0
+                continue
+
+            if not queues or not self.free_tags:
+                return None
+
+            queue = queues[0]
+
+            if not (self.queue_enabled[queue] and self.queue_active[queue] and self.queue_scheduled[queue]):
+                # deschedule, the op table entry is released again right away
+                queues.popleft()
+                if self.queue_scheduled[queue]:
+                    self.active_queue_count[func] -= 1
+                self.queue_scheduled[queue] = False
+                self.queue_counter = 0
+                self.descheduled_count += 1
+                continue
+
+            tag = heapq.heappop(self.free_tags)
+            self.op_active[tag] = True
+            self.op_queue[tag] = queue
+            self.op_func[tag] = func
+            self.op_doorbell[tag] = False
+            self.queue_ops[queue].append(tag)
+
+            if self.queue_counter == 1:
+                queues.rotate(-1)
+            if self.func_counter == 1:
+                self.func_fifo.rotate(-1)
+                self.func_counterloc[func] = True
+                self.func_last_queue_count[func] = self.queue_counter - 1
+
+            self.queue_counter -= 1
+            self.func_counter -= 1
+
+            self.func_tx_count[func] += 1
+            self.queue_tx_count[queue] += 1
+            self.transmit_count += 1
+            return queue, func, tag
+
+    def run(self, num_packets, status_len=1):
+        # num_packets requests with each one completed before the next, returns the requests
+        requests = np.full((num_packets, 3), -1, dtype=np.int64)
+        for k in range(num_packets):
+            req = self.step()
+            if req is None:
+                return requests[:k]
+            requests[k] = req
+            self.tx_status(req[2], status_len)
+        return requests
+
+
+def _update_deviation(deviation, actual, expected):
+    # adds one per actual and subtracts one per expected (-1 for none) entry of a batch of
+    # requests to deviation, returns the largest magnitude reached after any request; only
+    # the entries a batch touches change, so their trajectories are all that is needed
+    steps = np.tile(np.arange(len(actual)), 2)
+    entries = np.concatenate([actual, expected])
+    delta = np.concatenate([np.ones(len(actual), dtype=np.int64), -np.ones(len(expected), dtype=np.int64)])
+    keep = entries >= 0
+    steps, entries, delta = steps[keep], entries[keep], delta[keep]
+
+    # running sum per entry in request order, starting from the entry's current value
+    order = np.lexsort((steps, entries))
+    steps, entries, delta = steps[order], entries[order], delta[order]
+    total = np.cumsum(delta)
+    first = np.flatnonzero(np.r_[True, entries[1:] != entries[:-1]])
+    before = np.repeat(total[first] - delta[first], np.diff(np.r_[first, len(entries)]))
+    value = deviation[entries] + total - before
+
+    # only the value after both halves of a request counts
+    last = np.r_[(entries[1:] != entries[:-1]) | (steps[1:] != steps[:-1]), True]
+
+    np.add.at(deviation, entries, delta)
+    return int(np.abs(value[last]).max())
+
+
+class TxSchedulerWScoreboard:
+    def __init__(self, model, log=None):
+        # follows the DUT's transmit requests and compares each with the model's next decision;
+        # the running difference between actual and expected counts is what is checked, since
+        # pipeline timing can legitimately reorder decisions around doorbells
+        self.model = model
+        self.log = log
+
+        self.func_deviation = np.zeros(model.num_funcs, dtype=np.int64)
+        self.queue_deviation = np.zeros(model.queue_count, dtype=np.int64)
+        self.max_func_deviation = 0
+        self.max_queue_deviation = 0
+
+        self.count = 0
+        self.order_mismatches = 0
+        self.tag_mismatches = 0
+        self.unexpected = 0
+
+        # requests not yet run through the model, flushed before anything else changes its state
+        self.pending = []
+
+    def doorbell(self, queue, func=None):
+        self.flush()
+        self.model.doorbell(queue, func)
+
+    def tx_status(self, tag, length):
+        self.flush()
+        if self.model.op_active[tag]:
+            self.model.tx_status(tag, length)
+
+    def request(self, queue, func, tag):
+        self.pending.append((queue, func, tag))
+        if len(self.pending) >= SCOREBOARD_BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        actual = np.array(self.pending, dtype=np.int64)
+        self.pending = []
+        n = len(actual)
+
+        # the model decides one request at a time, everything after that is done on arrays
+        expected = np.full((n, 3), -1, dtype=np.int64)
+        for k in range(n):
+            req = self.model.step()
+            if req is None:
+                if self.log:
+                    self.log.warning("Scheduler model: unexpected request queue %d func %d tag %d", *actual[k])
+            else:
+                expected[k] = req
+
+        valid = expected[:, 0] >= 0
+        self.count += n
+        self.unexpected += n - int(np.count_nonzero(valid))
+        self.order_mismatches += int(np.count_nonzero(valid & np.any(expected[:, :2] != actual[:, :2], axis=1)))
+        self.tag_mismatches += int(np.count_nonzero(valid & (expected[:, 2] != actual[:, 2])))
+
+        self.max_func_deviation = max(self.max_func_deviation,
+            _update_deviation(self.func_deviation, actual[:, 1], expected[:, 1]))
+        self.max_queue_deviation = max(self.max_queue_deviation,
+            _update_deviation(self.queue_deviation, actual[:, 0], expected[:, 0]))
+
+    def log_report(self, log=None):
+        self.flush()
+        log = log or self.log
+        log.info("Scheduler model: %d requests, %d order mismatches, %d tag mismatches, %d unexpected, "
+            "max deviation %d per func %d per queue", self.count, self.order_mismatches, self.tag_mismatches,
+            self.unexpected, self.max_func_deviation, self.max_queue_deviation)
+
+    def check(self, max_func_deviation, max_queue_deviation):
+        self.flush()
+        errors = []
+        if self.unexpected:
+            errors.append("%d requests the model did not expect" % self.unexpected)
+        if self.max_func_deviation > max_func_deviation:
+            errors.append("func deviation %d exceeds %d" % (self.max_func_deviation, max_func_deviation))
+        if self.max_queue_deviation > max_queue_deviation:
+            errors.append("queue deviation %d exceeds %d" % (self.max_queue_deviation, max_queue_deviation))
+        if errors:
+            raise Exception("Scheduler model check failed: " + "; ".join(errors))
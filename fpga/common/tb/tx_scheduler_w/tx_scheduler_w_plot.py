@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import argparse
+import base64
+import html
+import io
+import os
+
+import numpy as np
+
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.patches import Patch
+
+from tx_scheduler_w_metrics import jain_index
+from tx_scheduler_w_trace import STATUS_FAILED, STATUS_PENDING, cumulative_counts, load_trace
+
+
+def trace_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def get_sizes(rows, meta):
+    num_funcs = meta.get('num_funcs') or (int(rows['func'].max())+1 if len(rows) else 1)
+    num_queues = meta.get('num_queues') or (int(rows['queue'].max())+1 if len(rows) else 1)
+    return num_funcs, num_queues
+
+
+def windowed_fairness(rows, num_funcs, func_weights, window, step):
+    # per sample: request index, weighted Jain index and max share error over the last window
+    # requests, with the expected share taken over the functions served in that window
+    n = len(rows)
+    if n < window:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    x = np.arange(window, n+1, step)
+    funcs = rows['func'].astype(np.int64)
+    counts = cumulative_counts(funcs, num_funcs, x) - cumulative_counts(funcs, num_funcs, x - window)
+    weights = np.asarray(func_weights, dtype=np.float64)
+
+    jain = np.zeros(len(x))
+    error = np.zeros(len(x))
+    for k in range(len(x)):
+        served = counts[k] > 0
+        jain[k] = jain_index(counts[k][served] / weights[served])
+        expected = weights * served
+        error[k] = np.abs(counts[k] / window - expected / expected.sum()).max()
+    return x, jain, error
+
+
+def summarize(rows, meta, window):
+    num_funcs, num_queues = get_sizes(rows, meta)
+    func_weights = meta.get('func_weights') or [1]*num_funcs
+    queue_weights = meta.get('queue_weights') or [1]*num_queues
+
+    s = {
+        'test': meta.get('test', ''),
+        'num_funcs': num_funcs,
+        'num_queues': num_queues,
+        'transmits': len(rows),
+        'cycles': int(rows['cycle'][-1] - rows['cycle'][0]) + 1 if len(rows) else 0,
+        'failed': int(np.count_nonzero(rows['status'] == STATUS_FAILED)),
+        'pending': int(np.count_nonzero(rows['status'] == STATUS_PENDING)),
+        'func_counts': np.bincount(rows['func'], minlength=num_funcs)[:num_funcs],
+        'queue_counts': np.bincount(rows['queue'], minlength=num_queues)[:num_queues],
+        'func_weights': func_weights,
+        'queue_weights': queue_weights,
+    }
+    s['requests_per_cycle'] = s['transmits'] / s['cycles'] if s['cycles'] else 0.0
+
+    # the bar tests store the counts expected with every queue backlogged
+    s['func_expected'] = meta.get('func_expected')
+    s['queue_expected'] = meta.get('queue_expected')
+
+    x, jain, error = windowed_fairness(rows, num_funcs, func_weights, window, max(window // 8, 1))
+    s['fairness'] = (x, jain, error)
+    s['min_jain'] = float(jain.min()) if len(jain) else None
+    s['max_share_error'] = float(error.max()) if len(error) else None
+    return s
+
+
+def plot_bars(s, plot_funcs):
+    fig = plt.figure()
+
+    if plot_funcs:
+        weight_list = s['func_weights']
+        actual_val = s['func_counts']
+        expected_val = s['func_expected']
+        x_axis_labels = [f'{j}\n({weight_list[j]})' for j in range(0, s['num_funcs'])]
+        plt.xlabel("Function")
+        plt.ylabel("# Packets Transmitted")
+        plt.title(f'Packets Transmitted Per Function ({s["num_queues"]} Queues)')
+    else:
+        weight_list = s['queue_weights']
+        actual_val = s['queue_counts']
+        expected_val = s['queue_expected']
+        x_axis_labels = [f'{j}\n({weight_list[j]})' for j in range(0, s['num_queues'])]
+        plt.xlabel("Queue")
+        plt.ylabel("# Packets Transmitted")
+        plt.title(f'Packets Transmitted Per Queue ({s["num_funcs"]} Funcs)')
+
+    categories = ['Actual']
+    colors = ['powderblue']
+
+    if expected_val is not None:
+        bars_expected = plt.bar(x_axis_labels, expected_val, color='gray')
+
+        # Display bar values at the top of each bar
+        for bar_e in bars_expected:
+            yval = bar_e.get_height()
+            plt.text(bar_e.get_x() + bar_e.get_width() / 2, yval, round(yval, 2), ha='center', va='bottom', color="dimgray")
+
+        categories.insert(0, 'Expected')
+        colors.insert(0, 'gray')
+
+    bars_actual = plt.bar(x_axis_labels, actual_val, color='powderblue', alpha=0.7)
+    # Display bar values at the top of each bar
+    for bar_a in bars_actual:
+        plt.text(bar_a.get_x() + bar_a.get_width() / 2, bar_a.get_height()/2, bar_a.get_height(), ha='center', va='bottom', color="black")
+
+    legend_handles = [Patch(color=color, label=category) for color, category in zip(colors, categories)]
+    plt.legend(handles=legend_handles, loc='upper center')
+
+    return fig
+
+
+def plot_lines(rows, meta, s, points=1000):
+    fig = plt.figure()
+
+    n = len(rows)
+    x = np.unique(np.linspace(0, n, min(points, n+1)).astype(np.int64))
+    counts = cumulative_counts(rows['queue'].astype(np.int64), s['num_queues'], x)
+
+    for i in range(s['num_queues']):
+        y = counts[:, i]
+        plt.plot(x, y, label=f'Queue {i}')
+
+        # display the ending val of each line
+        plt.text(x[-1] + 0.1, y[-1], f'{y[-1]:.0f}', fontsize=8, verticalalignment='center')
+
+    for event in meta.get('events', []):
+        plt.axvline(event['index'], color='lightgray', linestyle='--', linewidth=0.8)
+
+    plt.xlabel('Time (in # total packets)')
+    plt.ylabel('# packets transmitted')
+    plt.title('Queue Packet Transmissions Across Time')
+
+    inactive_list = meta.get('inactive_queues')
+    if inactive_list:
+        text_to_display = "in. queues: \n" + '\n'.join(map(str, inactive_list))
+        plt.xlim(0, x[-1] + 35)
+        plt.text(x[-1] + 30, 5, text_to_display, fontsize=8, verticalalignment='center')
+
+    if s['num_queues'] <= 16:
+        plt.legend()
+    plt.grid(which='both')
+
+    return fig
+
+
+def plot_fairness(s, meta):
+    fig, ax1 = plt.subplots()
+    x, jain, error = s['fairness']
+
+    ax1.plot(x, jain, color='tab:blue', label="Jain's index")
+    ax1.set_xlabel('Time (in # total packets)')
+    ax1.set_ylabel("Weighted Jain's index", color='tab:blue')
+    ax1.set_ylim(0, 1.05)
+
+    ax2 = ax1.twinx()
+    ax2.plot(x, error, color='tab:orange', label='Max share error')
+    ax2.set_ylabel('Max share error', color='tab:orange')
+
+    for event in meta.get('events', []):
+        ax1.axvline(event['index'], color='lightgray', linestyle='--', linewidth=0.8)
+
+    ax1.set_title('Function Fairness Over a Sliding Window')
+    ax1.grid(which='both')
+
+    return fig
+
+
+def fig_to_html(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return '<img src="data:image/png;base64,%s">' % base64.b64encode(buf.getvalue()).decode()
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '%.4f' % value
+    return html.escape(str(value))
+
+
+SUMMARY_COLUMNS = ['test', 'num_funcs', 'num_queues', 'transmits', 'cycles', 'requests_per_cycle', 'failed',
+    'pending', 'min_jain', 'max_share_error']
+
+
+def write_report(path, traces, window):
+    # one summary row per trace for comparing runs or RTL revisions, then the plots of each
+    out = ['<html><head><meta charset="utf-8"><title>tx_scheduler_w traces</title>',
+        '<style>body{font-family:sans-serif} table{border-collapse:collapse} '
+        'td,th{border:1px solid #ccc;padding:2px 6px;text-align:right}</style></head><body>',
+        '<h1>tx_scheduler_w traces</h1>', '<p>Fairness over a sliding window of %d requests.</p>' % window,
+        '<table><tr><th>trace</th>' + ''.join('<th>%s</th>' % c for c in SUMMARY_COLUMNS) + '</tr>']
+
+    for name, rows, meta, s in traces:
+        out.append('<tr><td><a href="#%s">%s</a></td>' % (html.escape(name), html.escape(name)) +
+            ''.join('<td>%s</td>' % format_value(s[c]) for c in SUMMARY_COLUMNS) + '</tr>')
+    out.append('</table>')
+
+    for name, rows, meta, s in traces:
+        out.append('<h2 id="%s">%s</h2>' % (html.escape(name), html.escape(name)))
+        if meta.get('events'):
+            out.append('<p>%d events: %s</p>' % (len(meta['events']),
+                html.escape(', '.join('%s@%d' % (e['name'], e['index']) for e in meta['events'][:50]))))
+        for fig in make_figures(rows, meta, s):
+            out.append(fig_to_html(fig))
+            plt.close(fig)
+
+    out.append('</body></html>')
+    with open(path, 'w') as f:
+        f.write('\n'.join(out))
+
+
+def make_figures(rows, meta, s):
+    figs = []
+    if len(rows):
+        figs.append(plot_bars(s, 1))
+        figs.append(plot_bars(s, 0))
+        figs.append(plot_lines(rows, meta, s))
+        if len(s['fairness'][0]):
+            figs.append(plot_fairness(s, meta))
+    return figs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plots and summarises tx_scheduler_w transmit traces")
+    parser.add_argument('traces', nargs='+', help="Trace files (.npy or .parquet)")
+    parser.add_argument('--out', default='tx_scheduler_w_report.html', help="HTML report to write")
+    parser.add_argument('--window', type=int, default=4096, help="Sliding window in requests for fairness")
+    parser.add_argument('--show', action='store_true', help="Show the figures of each trace instead of writing a report")
+    args = parser.parse_args()
+
+    if not args.show:
+        matplotlib.use('Agg')
+
+    traces = []
+    for path in args.traces:
+        rows, meta = load_trace(path)
+        traces.append((trace_name(path), rows, meta, summarize(rows, meta, args.window)))
+
+    if args.show:
+        for name, rows, meta, s in traces:
+            make_figures(rows, meta, s)
+            plt.show()
+        return
+
+    write_report(args.out, traces, args.window)
+    print("Wrote %s (%d traces)" % (args.out, len(traces)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import heapq
+import random
+
+import numpy as np
+
+import cocotb
+from cocotb.triggers import Event, RisingEdge
+from cocotb.utils import get_sim_time
+
+
+def line_rate_decisions_per_cycle(rate_gbps=100, packet_bytes=64, clk_period_ns=4, overhead_bytes=20):
+    # scheduler decisions per clock needed for line rate, one decision per packet; the
+    # overhead is preamble, SFD and inter-frame gap, 0.595 for 100G at 64 bytes and 250 MHz
+    return rate_gbps / ((packet_bytes + overhead_bytes) * 8) * clk_period_ns
+
+
+# completion time distributions, each returns the cycles a request spends in the tx_engine
+# after the pipeline latency
+
+def completion_fixed(cycles=0):
+    return lambda rng: cycles
+
+
+def completion_uniform(low, high):
+    return lambda rng: rng.randint(low, high)
+
+
+def completion_exponential(mean):
+    return lambda rng: int(rng.expovariate(1.0 / mean)) if mean else 0
+
+
+class TxEngineResponder:
+    def __init__(self, dut, txrq_sink, op_table_size, pipeline_latency=4, completion=None,
+            max_outstanding=None, backpressure=0.0, length=64, clk_period_ns=4, seed=None,
+            scoreboard=None, trace=None):
+        # stands in for the tx_engine: accepts transmit requests, optionally throttling the
+        # request stream, and returns one status per request pipeline_latency plus a drawn
+        # completion time later, at most one status per cycle as the status port has no ready
+        self.dut = dut
+        self.sink = txrq_sink
+        self.op_table_size = op_table_size
+        self.pipeline_latency = pipeline_latency
+        self.completion = completion or completion_fixed(0)
+        self.max_outstanding = op_table_size if max_outstanding is None else max_outstanding
+        self.backpressure = backpressure
+        self.length = length
+        self.clk_period_ns = clk_period_ns
+        self.rng = random.Random(seed)
+        self.scoreboard = scoreboard
+        self.trace = trace
+
+        queue_count = dut.QUEUE_COUNT.value
+
+        # (due cycle, sequence, tag) of each outstanding request
+        self.pending = []
+        self.seq = 0
+        self.tag_active = np.zeros(op_table_size, dtype=bool)
+        self.outstanding = 0
+
+        self.cycles = 0
+        self.first_grant_cycle = None
+        self.decisions = 0
+        self.completions = 0
+        self.backpressure_cycles = 0
+        self.stall_cycles = 0
+        self.max_decisions = 0
+        self.done = Event()
+
+        # cycles spent at each op table occupancy, counted from the first grant
+        self.occupancy_cycles = np.zeros(op_table_size+1, dtype=np.int64)
+
+        # cycle of the doorbell that made each queue pending, -1 once it has been granted
+        self.doorbell_cycle = np.full(queue_count, -1, dtype=np.int64)
+        self.doorbell_latency = []
+
+        self._run_cr = None
+
+    def start(self):
+        if self._run_cr is None:
+            self._run_cr = cocotb.start_soon(self._run())
+
+    def stop(self):
+        if self._run_cr is not None:
+            self._run_cr.kill()
+            self._run_cr = None
+        self.dut.s_axis_tx_req_status_valid.value = 0
+        self.sink.pause = False
+
+    async def wait_decisions(self, decisions):
+        # returns once the scheduler has issued this many requests since start()
+        self.max_decisions = decisions
+        if self.decisions < decisions:
+            self.done.clear()
+            await self.done.wait()
+
+    async def _run(self):
+        dut = self.dut
+        cycle = int(get_sim_time('ns')) // self.clk_period_ns
+
+        while True:
+            await RisingEdge(dut.clk)
+            cycle += 1
+
+            if dut.rst.value:
+                continue
+
+            self.cycles += 1
+
+            # doorbells have no ready, every valid cycle is a doorbell
+            if dut.s_axis_doorbell_valid.value:
+                queue = int(dut.s_axis_doorbell_queue.value)
+                if self.doorbell_cycle[queue] < 0:
+                    self.doorbell_cycle[queue] = cycle
+
+            # request handshake, the sink keeps its own copy which is not needed here
+            valid = dut.m_axis_tx_req_valid.value
+            ready = dut.m_axis_tx_req_ready.value
+            if valid and ready:
+                self._request(cycle, int(dut.m_axis_tx_req_queue.value), int(dut.m_axis_tx_req_func.value),
+                    int(dut.m_axis_tx_req_tag.value))
+                while not self.sink.empty():
+                    self.sink.recv_nowait()
+            elif valid:
+                self.stall_cycles += 1
+
+            if self.first_grant_cycle is not None:
+                self.occupancy_cycles[min(self.outstanding, self.op_table_size)] += 1
+
+            # at most one status per cycle, the earliest one that is due
+            if self.pending and self.pending[0][0] <= cycle:
+                due, seq, tag = heapq.heappop(self.pending)
+                self._status(tag)
+            else:
+                dut.s_axis_tx_req_status_valid.value = 0
+
+            # the sink applies this from the next edge, so stop one request early
+            throttle = self.backpressure and self.rng.random() < self.backpressure
+            self.sink.pause = throttle or self.outstanding + 1 >= self.max_outstanding
+            if throttle and self.first_grant_cycle is not None:
+                self.backpressure_cycles += 1
+
+    def _request(self, cycle, queue, func, tag):
+        if self.first_grant_cycle is None:
+            self.first_grant_cycle = cycle
+
+        if self.tag_active[tag]:
+            raise Exception("Tag %d reissued while outstanding" % tag)
+        self.tag_active[tag] = True
+        self.outstanding += 1
+        if self.outstanding > self.op_table_size:
+            raise Exception("%d requests outstanding, op table holds %d" % (self.outstanding, self.op_table_size))
+
+        if self.doorbell_cycle[queue] >= 0:
+            self.doorbell_latency.append(cycle - self.doorbell_cycle[queue])
+            self.doorbell_cycle[queue] = -1
+
+        if self.scoreboard is not None:
+            self.scoreboard.request(queue, func, tag)
+        if self.trace is not None:
+            self.trace.record_request(cycle, func, queue, tag)
+
+        due = cycle + self.pipeline_latency + self.completion(self.rng)
+        heapq.heappush(self.pending, (due, self.seq, tag))
+        self.seq += 1
+
+        self.decisions += 1
+        if self.max_decisions and self.decisions >= self.max_decisions:
+            self.done.set()
+
+    def _status(self, tag):
+        dut = self.dut
+        dut.s_axis_tx_req_status_len.value = self.length
+        dut.s_axis_tx_req_status_tag.value = tag
+        dut.s_axis_tx_req_status_valid.value = 1
+
+        self.tag_active[tag] = False
+        self.outstanding -= 1
+        self.completions += 1
+
+        if self.scoreboard is not None:
+            self.scoreboard.tx_status(tag, self.length)
+        if self.trace is not None:
+            self.trace.record_status(tag, self.length)
+
+    def summary(self):
+        cycles = self.occupancy_cycles.sum()
+        throttled = self.backpressure_cycles
+        latency = np.asarray(self.doorbell_latency, dtype=np.int64)
+        occupancy = np.arange(self.op_table_size+1)
+        return {
+            'decisions': self.decisions,
+            'completions': self.completions,
+            'cycles': int(cycles),
+            # decisions per clock from the first grant, and over the cycles not throttled
+            'decisions_per_cycle': self.decisions / cycles if cycles else 0.0,
+            'unthrottled_decisions_per_cycle': self.decisions / (cycles - throttled) if cycles > throttled else 0.0,
+            'stall_cycles': self.stall_cycles,
+            'backpressure_cycles': throttled,
+            'mean_occupancy': float((occupancy * self.occupancy_cycles).sum() / cycles) if cycles else 0.0,
+            'max_occupancy': int(occupancy[self.occupancy_cycles > 0].max()) if cycles else 0,
+            'full_fraction': float(self.occupancy_cycles[-1] / cycles) if cycles else 0.0,
+            'doorbells_granted': len(latency),
+            'mean_doorbell_latency': float(latency.mean()) if len(latency) else None,
+            'p99_doorbell_latency': float(np.percentile(latency, 99)) if len(latency) else None,
+            'max_doorbell_latency': int(latency.max()) if len(latency) else None,
+        }
+
+    def log_report(self, log):
+        s = self.summary()
+        log.info("tx_engine responder: %d decisions in %d cycles, %.4f decisions/cycle (%.4f unthrottled), "
+            "%d stall and %d backpressure cycles", s['decisions'], s['cycles'], s['decisions_per_cycle'],
+            s['unthrottled_decisions_per_cycle'], s['stall_cycles'], s['backpressure_cycles'])
+        log.info("Op table occupancy: mean %.2f, max %d of %d, full %.1f%% of cycles", s['mean_occupancy'],
+            s['max_occupancy'], self.op_table_size, 100*s['full_fraction'])
+        log.info("Doorbell to first grant: %d granted, mean %s, p99 %s, max %s cycles", s['doorbells_granted'],
+            s['mean_doorbell_latency'], s['p99_doorbell_latency'], s['max_doorbell_latency'])
+
+    def check(self, min_decisions_per_cycle=None, max_doorbell_latency=None):
+        s = self.summary()
+        errors = []
+        if min_decisions_per_cycle is not None and s['unthrottled_decisions_per_cycle'] < min_decisions_per_cycle:
+            errors.append("%.4f decisions/cycle below %.4f" % (s['unthrottled_decisions_per_cycle'],
+                min_decisions_per_cycle))
+        if max_doorbell_latency is not None and s['max_doorbell_latency'] is not None and \
+                s['max_doorbell_latency'] > max_doorbell_latency:
+            errors.append("doorbell to first grant took %d cycles, limit %d" % (s['max_doorbell_latency'],
+                max_doorbell_latency))
+        if errors:
+            raise Exception("tx_engine responder check failed: " + "; ".join(errors))
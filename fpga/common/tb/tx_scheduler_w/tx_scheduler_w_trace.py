@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import json
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# one row per transmit request, status filled in when the request completes
+TRACE_DTYPE = np.dtype([
+    ('cycle', '<u8'),
+    ('func', '<u2'),
+    ('queue', '<u4'),
+    ('tag', '<u2'),
+    ('status', 'i1'),
+])
+
+STATUS_PENDING = -1
+STATUS_FAILED = 0
+STATUS_OK = 1
+
+
+class TxSchedulerWTrace:
+    def __init__(self, op_table_size, capacity=65536, **meta):
+        self.rows = np.zeros(capacity, dtype=TRACE_DTYPE)
+        self.count = 0
+        # row of the outstanding request of each tag, sized to the DUT's OP_TABLE_SIZE
+        self.tag_row = np.full(op_table_size, -1, dtype=np.int64)
+        self.meta = dict(meta, op_table_size=op_table_size)
+        self.events = []
+
+    def record_request(self, cycle, func, queue, tag):
+        if self.count == len(self.rows):
+            self.rows = np.resize(self.rows, 2*len(self.rows))
+        self.rows[self.count] = (cycle, func, queue, tag, STATUS_PENDING)
+        self.tag_row[tag] = self.count
+        self.count += 1
+
+    def record_status(self, tag, length):
+        k = self.tag_row[tag]
+        if k >= 0:
+            self.rows['status'][k] = STATUS_OK if length else STATUS_FAILED
+            self.tag_row[tag] = -1
+
+    def mark(self, name, **kwargs):
+        # annotation at the current request index, drawn as a marker by the plotting tool
+        self.events.append(dict(name=name, index=self.count, **kwargs))
+
+    def get_rows(self):
+        return self.rows[:self.count]
+
+    def save(self, path, **meta):
+        meta = dict(self.meta, **meta)
+        meta['events'] = self.events
+        save_trace(path, self.get_rows(), meta)
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot store %r in trace metadata" % type(value))
+
+
+def save_trace(path, rows, meta):
+    # the rows go to .npy or .parquet by extension, the metadata to a .json next to them
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    base, ext = os.path.splitext(path)
+    if ext == '.parquet':
+        if pyarrow is None:
+            raise Exception("Writing %s requires pyarrow" % path)
+        table = pyarrow.table({name: rows[name] for name in TRACE_DTYPE.names})
+        pyarrow.parquet.write_table(table, path)
+    else:
+        np.save(path, rows)
+    with open(base + '.json', 'w') as f:
+        json.dump(meta, f, indent=2, default=_to_json)
+
+
+def load_trace(path):
+    base, ext = os.path.splitext(path)
+    if ext == '.parquet':
+        if pyarrow is None:
+            raise Exception("Reading %s requires pyarrow" % path)
+        table = pyarrow.parquet.read_table(path)
+        rows = np.zeros(table.num_rows, dtype=TRACE_DTYPE)
+        for name in TRACE_DTYPE.names:
+            rows[name] = table.column(name).to_numpy()
+    else:
+        rows = np.load(path)
+    meta = {}
+    if os.path.exists(base + '.json'):
+        with open(base + '.json') as f:
+            meta = json.load(f)
+    return rows, meta
+
+
+def cumulative_counts(ids, num_ids, x):
+    # transmits of each id among the first x[k] rows, shape (len(x), num_ids)
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    bounds = np.searchsorted(sorted_ids, np.arange(num_ids+1))
+    counts = np.zeros((len(x), num_ids), dtype=np.int64)
+    for i in range(num_ids):
+        counts[:, i] = np.searchsorted(order[bounds[i]:bounds[i+1]], x)
+    return counts
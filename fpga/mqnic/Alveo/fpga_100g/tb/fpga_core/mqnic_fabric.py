@@ -0,0 +1 @@
+../../../../../common/tb/mqnic_fabric.py
\ No newline at end of file
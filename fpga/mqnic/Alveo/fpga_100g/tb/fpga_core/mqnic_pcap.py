@@ -0,0 +1 @@
+../../../../../common/tb/mqnic_pcap.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../../../common/tb/mqnic_scoreboard.py
\ No newline at end of file
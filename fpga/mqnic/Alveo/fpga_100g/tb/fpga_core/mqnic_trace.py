@@ -0,0 +1 @@
+../../../../../common/tb/mqnic_trace.py
\ No newline at end of file